@@ -0,0 +1,147 @@
+from calendar import monthrange
+
+from columnar import to_cents
+
+# Fields /api/summary can group by, in the order of LedgerRollup cell keys
+SUMMARY_FIELDS = ('category', 'type', 'month')
+
+
+class LedgerTotals:
+    # Running sums per (category, type) cell, kept in integer cents so that
+    # adding and removing the same transaction always cancels out exactly.
+
+    def __init__(self):
+        self.cells = {}
+
+    def add(self, category, transaction_type, cents, count=1):
+        cell = self.cells.get((category, transaction_type))
+        if cell is None:
+            cell = self.cells[(category, transaction_type)] = [0, 0]
+        cell[0] += cents
+        cell[1] += count
+
+    def remove(self, category, transaction_type, cents):
+        key = (category, transaction_type)
+        cell = self.cells.get(key)
+        if cell is None:
+            return
+        cell[0] -= cents
+        cell[1] -= 1
+        if cell[1] == 0:
+            del self.cells[key]
+
+    def rows(self):
+        return [(category, transaction_type, cents / 100, count)
+                for (category, transaction_type), (cents, count) in self.cells.items()]
+
+
+def summarize_totals(rows):
+    # Builds the /api/balance payload from (category, type, total, count) rows
+    by_type = {'income': 0.0, 'expense': 0.0}
+    by_category = {}
+    count = 0
+    for category, transaction_type, total, cell_count in rows:
+        by_type[transaction_type] = by_type.get(transaction_type, 0.0) + total
+        entry = by_category.get(category)
+        if entry is None:
+            entry = by_category[category] = {'category': category, 'income': 0.0, 'expense': 0.0, 'count': 0}
+        entry[transaction_type] = entry.get(transaction_type, 0.0) + total
+        entry['count'] += cell_count
+        count += cell_count
+    for entry in by_category.values():
+        entry['net'] = round(entry['income'] - entry['expense'], 2)
+    return {
+        'income': round(by_type['income'], 2),
+        'expense': round(by_type['expense'], 2),
+        'balance': round(by_type['income'] - by_type['expense'], 2),
+        'count': count,
+        'by_type': {t: round(total, 2) for t, total in by_type.items()},
+        'by_category': sorted(by_category.values(), key=lambda e: (e['category'] is None, e['category'] or '')),
+    }
+
+
+class LedgerRollup:
+    # Sum, count, min and max of the amounts in cents per (category, type,
+    # month) cell, updated as transactions are added and removed. Removing
+    # a cell's smallest or largest amount leaves both bounds unknown (None)
+    # until they are counted again from the cell's rows.
+
+    def __init__(self, transactions=()):
+        # Built in one pass over the transactions: a hash aggregation
+        self.cells = {}
+        for transaction in transactions:
+            self.add(transaction)
+
+    def add(self, transaction):
+        key = (transaction.category, transaction.type, transaction.date[:7])
+        cents = to_cents(transaction.amount)
+        cell = self.cells.get(key)
+        if cell is None:
+            self.cells[key] = [cents, 1, cents, cents]
+            return
+        cell[0] += cents
+        cell[1] += 1
+        if cell[2] is not None:
+            cell[2] = min(cell[2], cents)
+            cell[3] = max(cell[3], cents)
+
+    def remove(self, transaction):
+        key = (transaction.category, transaction.type, transaction.date[:7])
+        cents = to_cents(transaction.amount)
+        cell = self.cells.get(key)
+        if cell is None:
+            return
+        cell[0] -= cents
+        cell[1] -= 1
+        if cell[1] == 0:
+            del self.cells[key]
+        elif cents == cell[2] or cents == cell[3]:
+            cell[2] = cell[3] = None
+
+
+def covers_months(date_from, date_to):
+    # Whether a date range is made of whole months, which rollup cells can
+    # answer exactly
+    if date_from is not None and not date_from.endswith('-01'):
+        return False
+    if date_to is not None:
+        year, month, day = map(int, date_to.split('-'))
+        return day == monthrange(year, month)[1]
+    return True
+
+
+def month_bounds(month):
+    # First and last date of a YYYY-MM month
+    year, number = map(int, month.split('-'))
+    return '%s-01' % month, '%s-%02d' % (month, monthrange(year, number)[1])
+
+
+def summarize_groups(cells, group_by):
+    # Builds the /api/summary payload from ((category, type, month), [cents,
+    # count, min, max]) cells, merged into one group per distinct value of
+    # the group_by fields
+    positions = [SUMMARY_FIELDS.index(field) for field in group_by]
+    groups = {}
+    for key, (cents, count, low, high) in cells:
+        group_key = tuple(key[position] for position in positions)
+        group = groups.get(group_key)
+        if group is None:
+            groups[group_key] = [cents, count, low, high]
+        else:
+            group[0] += cents
+            group[1] += count
+            group[2] = min(group[2], low)
+            group[3] = max(group[3], high)
+    rows = []
+    for group_key in sorted(groups, key=lambda k: [(value is None, value or '') for value in k]):
+        cents, count, low, high = groups[group_key]
+        row = dict(zip(group_by, group_key))
+        row.update(count=count, total=cents / 100, average=round(cents / count / 100, 2), min=low / 100,
+                   max=high / 100)
+        rows.append(row)
+    return {
+        'group_by': list(group_by),
+        'groups': rows,
+        'count': sum(row['count'] for row in rows),
+        'total': sum(cents for cents, _, _, _ in groups.values()) / 100,
+    }
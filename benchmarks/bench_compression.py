@@ -0,0 +1,40 @@
+import argparse
+import gzip
+
+from common import open_app, percentile, sample_transactions, timed, write
+from models import encode_lines, encode_list
+
+# CPU cost of gzip against the bytes it saves, per level, on the listing
+# payloads; then GET end to end without gzip, with gzip and with a hit in
+# the compressed cache
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--backend', default='memory')
+parser.add_argument('--rows', type=int, nargs='+', default=[100, 10000, 100000])
+parser.add_argument('--levels', type=int, nargs='+', default=[1, 6, 9])
+parser.add_argument('--repeat', type=int, default=5)
+args = parser.parse_args()
+
+print('%8s %-6s %5s %10s %10s %7s %9s %10s' % ('rows', 'format', 'level', 'bytes', 'gzipped', 'ratio', 'time',
+                                               'MB/s in'))
+for rows in args.rows:
+    transactions = sample_transactions(rows, first_id=1)
+    for name, body in (('json', encode_list(transactions)), ('ndjson', encode_lines(transactions))):
+        for level in args.levels:
+            times = timed(lambda: gzip.compress(body, level, mtime=0), args.repeat)
+            size = len(gzip.compress(body, level, mtime=0))
+            print('%8d %-6s %5d %10d %10d %6.1fx %6.1f ms %10.0f' % (
+                rows, name, level, len(body), size, len(body) / size, times[0] * 1000, len(body) / times[0] / 1e6))
+
+main, client = open_app(args.backend, args.rows[-1])
+url = '/api/transactions'
+print('GET %s end to end on %s at %d rows, p50 of %d' % (url, args.backend, args.rows[-1], args.repeat))
+gzip_headers = {'Accept-Encoding': 'gzip'}
+for name, headers, before in (('identity', {}, lambda: write(client)),
+                              ('gzip, cache miss', gzip_headers, lambda: write(client)),
+                              ('gzip, cache hit', gzip_headers, None)):
+    client.get(url, headers=headers)
+    times = timed(lambda: client.get(url, headers=headers), args.repeat, before=before)
+    print('  %-18s %7.1f ms %10d bytes' % (name, percentile(times, 0.5) * 1000,
+                                           len(client.get(url, headers=headers).get_data())))
+main.shards.close()
@@ -0,0 +1,41 @@
+import argparse
+
+from common import open_app, percentile, sample_transactions, timed, write
+from models import TRANSACTION_FIELDS, encode_columns, encode_fields, encode_list
+
+# Payload size and encoding time of the listing formats, on freshly built
+# transactions as read from storage, then end to end through the test
+# client
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--backend', default='memory')
+parser.add_argument('--rows', type=int, default=100000)
+parser.add_argument('--repeat', type=int, default=5)
+args = parser.parse_args()
+
+SOME_FIELDS = ('amount', 'date', 'category')
+ENCODERS = (
+    ('rows (all fields)', encode_list),
+    ('fields=amount,date,category', lambda rows: encode_fields(rows, SOME_FIELDS)),
+    ('columnar, all fields', lambda rows: encode_columns(rows, TRANSACTION_FIELDS)),
+    ('columnar, amount,date,category', lambda rows: encode_columns(rows, SOME_FIELDS)),
+)
+
+print('encode only, best of %d' % args.repeat)
+for name, encode in ENCODERS:
+    best = None
+    for _ in range(args.repeat):
+        # The per-record JSON caches start empty each time
+        rows = sample_transactions(args.rows, first_id=1)
+        times = timed(lambda: encode(rows), 1)
+        best = times[0] if best is None else min(best, times[0])
+    print('  %-34s %7.1f MB %7.0f ms' % (name, len(encode(rows)) / 1e6, best * 1000))
+
+main, client = open_app(args.backend, args.rows)
+print('GET end to end on %s, p50 of %d' % (args.backend, args.repeat))
+for query in ('', '?fields=amount,date,category', '?format=columnar',
+              '?format=columnar&fields=amount,date,category'):
+    url = '/api/transactions' + query
+    times = timed(lambda: client.get(url), args.repeat, before=lambda: write(client))
+    print('  %-46s %7.0f ms' % (url, percentile(times, 0.5) * 1000))
+main.shards.close()
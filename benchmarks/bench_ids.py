@@ -0,0 +1,36 @@
+import argparse
+import random
+import shutil
+import tempfile
+import time
+
+from common import sample_transactions
+from repository import MemoryRepository
+
+# Id lookups and deletes on the memory backend, per operation, at several
+# ledger sizes. There is no hash index on ids: a lookup is a bisect over the
+# store's sorted ids column, O(log n), which keeps the store at a few dozen
+# bytes per row. Deletes include their log append.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--rows', type=int, nargs='+', default=[1000, 100000, 1000000])
+parser.add_argument('--ops', type=int, default=1000)
+args = parser.parse_args()
+
+print('%10s %12s %12s' % ('rows', 'lookup', 'delete'))
+for rows in args.rows:
+    directory = tempfile.mkdtemp(prefix='ledger-bench-')
+    repo = MemoryRepository(directory)
+    repo.add_transactions(sample_transactions(rows))
+    ids = random.Random(1).sample(range(rows), min(args.ops, rows))
+    start = time.perf_counter()
+    for transaction_id in ids:
+        repo.get_transaction(transaction_id)
+    lookup = (time.perf_counter() - start) / len(ids)
+    start = time.perf_counter()
+    for transaction_id in ids:
+        repo.delete_transaction(transaction_id)
+    delete = (time.perf_counter() - start) / len(ids)
+    print('%10d %9.1f us %9.1f us' % (rows, lookup * 1e6, delete * 1e6))
+    repo.log.close()
+    shutil.rmtree(directory)
@@ -0,0 +1,22 @@
+import argparse
+
+from common import open_app, percentile, timed, write
+
+# GET latency of the listing when neither the ETag nor the gzip cache can
+# answer, so every row is encoded or joined from the fragment cache.
+# Bodies are read in full, so the NDJSON stream is timed to its last
+# line, not its first.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--backend', default='memory')
+parser.add_argument('--rows', type=int, default=100000)
+parser.add_argument('--repeat', type=int, default=50)
+args = parser.parse_args()
+
+main, client = open_app(args.backend, args.rows)
+for url in ('/api/transactions', '/api/transactions?category=food', '/api/transactions?format=ndjson'):
+    client.get(url).get_data()
+    times = timed(lambda: client.get(url).get_data(), args.repeat, before=lambda: write(client))
+    print('%-8s %-34s p50 %6.1f ms  p99 %6.1f ms' % (args.backend, url, percentile(times, 0.5) * 1000,
+                                                     percentile(times, 0.99) * 1000))
+main.shards.close()
@@ -0,0 +1,70 @@
+import argparse
+import shutil
+import tempfile
+import threading
+import time
+
+from common import percentile, sample_transactions
+from models import Transaction
+from repository import MemoryRepository, Shard
+
+# Startup and durable writes of a memory ledger: opening a ledger by
+# replaying its whole log, then from a snapshot, and the throughput
+# and latency of acknowledged writes with several writers sharing
+# each fsync (group commit)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--rows', type=int, default=1000000)
+parser.add_argument('--batch', type=int, default=1000, help='transactions per log entry while filling')
+parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16, 64])
+parser.add_argument('--writes', type=int, default=2000, help='writes per thread count')
+args = parser.parse_args()
+
+directory = tempfile.mkdtemp(prefix='ledger-bench-')
+repo = MemoryRepository(directory)
+# No compaction while filling, so the reopen below replays every entry
+repo.log.compact_bytes = float('inf')
+transactions = sample_transactions(args.rows)
+for start in range(0, args.rows, args.batch):
+    repo.add_transactions(transactions[start:start + args.batch])
+repo.log.close()
+
+start = time.perf_counter()
+repo = MemoryRepository(directory)
+print('replay   %.2f s for %d transactions in %d log entries' % (time.perf_counter() - start, args.rows,
+                                                                 -(-args.rows // args.batch)))
+repo.snapshot()
+repo.log.close()
+start = time.perf_counter()
+repo = MemoryRepository(directory)
+print('snapshot %.2f s to open the same ledger from its state file' % (time.perf_counter() - start))
+
+# Each write is acknowledged as a route would: once its log entry is
+# fsynced, waited for outside the shard's write lock
+shard = Shard(repo)
+print('%8s %10s %10s %10s' % ('writers', 'writes/s', 'p50', 'p99'))
+for threads in args.threads:
+    per_thread = max(1, args.writes // threads)
+    latencies = []
+
+    def writer():
+        times = []
+        for _ in range(per_thread):
+            started = time.perf_counter()
+            with shard.write():
+                repo.add_transaction(Transaction(None, 1.0, 'bench', 'expense', 'food', '2024-06-01'))
+            times.append(time.perf_counter() - started)
+        latencies.extend(times)
+
+    workers = [threading.Thread(target=writer) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print('%8d %10.0f %7.1f ms %7.1f ms' % (threads, len(latencies) / elapsed, percentile(latencies, 0.5) * 1000,
+                                            percentile(latencies, 0.99) * 1000))
+repo.log.close()
+shutil.rmtree(directory)
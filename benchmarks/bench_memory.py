@@ -0,0 +1,65 @@
+import argparse
+import gc
+import json
+import tracemalloc
+
+from common import sample_transactions
+from columnar import ColumnarStore
+from models import Transaction
+
+# Bytes per transaction held in memory: the list of dicts the ledger used
+# to keep, a list of slotted Transaction records, and the ColumnarStore.
+# Each is built from the same JSON text, as a replay would, so no string
+# is shared with the sample data, and measured with tracemalloc once
+# everything it was built from is freed.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+parser.add_argument('--unique-descriptions', action='store_true',
+                    help='give every transaction its own description, the worst case for dictionary encoding')
+args = parser.parse_args()
+
+
+def list_of_dicts(text):
+    return json.loads(text)
+
+
+def list_of_records(text):
+    return [Transaction.from_dict(d) for d in json.loads(text)]
+
+
+def columnar(text):
+    store = ColumnarStore()
+    store.extend([Transaction.from_dict(d) for d in json.loads(text)])
+    return store
+
+
+def measure(build, text):
+    # Bytes still allocated by build(text) once its temporaries are gone
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    built = build(text)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return built, used
+
+
+print('%9s %18s %18s %18s %12s' % ('rows', 'list of dicts', 'Transactions', 'ColumnarStore', 'nbytes()'))
+for rows in args.rows:
+    transactions = sample_transactions(rows, first_id=1)
+    if args.unique_descriptions:
+        for transaction in transactions:
+            transaction.description = 'Purchase number %d' % transaction.id
+    text = json.dumps([t.to_dict() for t in transactions])
+    del transactions
+    sizes = []
+    for build in (list_of_dicts, list_of_records, columnar):
+        built, used = measure(build, text)
+        sizes.append(used)
+        if build is columnar:
+            nbytes = built.nbytes()
+        del built
+    print('%9d %12.0f B/row %12.0f B/row %12.0f B/row %6.0f B/row' % (
+        rows, sizes[0] / rows, sizes[1] / rows, sizes[2] / rows, nbytes / rows))
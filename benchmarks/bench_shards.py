@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+
+from common import percentile
+
+# Many users at once: every simulated user logs in through /login, which
+# opens nothing, then makes `posts` POSTs, one balance read and one
+# listing, which open and fill the user's own shard through the
+# ShardRegistry. Logins and ledger requests are timed as separate phases,
+# as a login is mostly the cost of checking the password hash.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--backend', default='memory')
+parser.add_argument('--users', type=int, default=1000)
+parser.add_argument('--threads', type=int, default=16)
+parser.add_argument('--posts', type=int, default=20)
+args = parser.parse_args()
+
+data_dir = tempfile.mkdtemp(prefix='ledger-bench-')
+os.environ['LEDGER_DATA_DIR'] = data_dir
+os.environ['LEDGER_BACKEND'] = args.backend
+import logging  # noqa: E402
+logging.disable(logging.INFO)
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+# Accounts are written straight to the user store, sharing one password
+# hash, rather than hashing a password per sign-up
+password_hash = generate_password_hash('bench')
+with open(os.path.join(data_dir, 'users.json'), 'w', encoding='utf-8') as f:
+    json.dump([{'id': str(i), 'username': 'user%d' % i, 'password_hash': password_hash}
+               for i in range(1, args.users + 1)], f)
+
+import main  # noqa: E402
+
+
+def run(phase, work):
+    # Runs work(client, username), which returns the latency of each request
+    # it made, for every user on args.threads threads, and prints the totals
+    pending = queue.Queue()
+    for i in range(1, args.users + 1):
+        pending.put(i)
+    latencies = []
+    failures = []
+
+    def worker():
+        while True:
+            try:
+                i = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                latencies.extend(work(clients[i], 'user%d' % i))
+            except AssertionError as e:
+                failures.append((i, e))
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    assert not failures, failures[:5]
+    latencies.sort()
+    print('%-8s %-6s %6d requests in %6.1f s  %6.0f req/s  p50 %6.1f ms  p99 %6.1f ms'
+          % (args.backend, phase, len(latencies), elapsed, len(latencies) / elapsed,
+             percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+
+
+def timed_request(times, call, *call_args, **call_kwargs):
+    start = time.perf_counter()
+    response = call(*call_args, **call_kwargs)
+    times.append(time.perf_counter() - start)
+    return response
+
+
+def log_in(client, username):
+    times = []
+    response = timed_request(times, client.post, '/login', data={'username': username, 'password': 'bench'})
+    assert response.status_code == 302, response.status_code
+    return times
+
+
+def use_ledger(client, username):
+    times = []
+    for n in range(args.posts):
+        response = timed_request(times, client.post, '/api/transactions', json={
+            'amount': n + 1, 'description': username, 'type': 'expense' if n % 4 else 'income',
+            'category': 'c%d' % (n % 5), 'date': '2024-%02d-01' % (n % 12 + 1)})
+        assert response.status_code == 201, response.status_code
+    balance = timed_request(times, client.get, '/api/balance').json
+    listing = timed_request(times, client.get, '/api/transactions').json
+    # Each user sees exactly their own writes
+    assert balance['count'] == args.posts and {t['description'] for t in listing} == {username}
+    return times
+
+
+clients = {i: main.app.test_client() for i in range(1, args.users + 1)}
+run('login', log_in)
+run('ledger', use_ledger)
+# The memory ledgers share one flusher and one compactor thread
+print('%-8s %d shards open, %d threads besides the main one'
+      % (args.backend, len(main.shards._shards), threading.active_count() - 1))
+main.shards.close()
@@ -0,0 +1,40 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from common import sample_transactions
+from models import Transaction
+from repository import MemoryRepository
+from storage import STATE_FILE
+
+# Writing and restoring the binary state file of a memory ledger, and the
+# first reads and write after a restore
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--rows', type=int, default=1000000)
+args = parser.parse_args()
+
+directory = tempfile.mkdtemp(prefix='ledger-bench-')
+repo = MemoryRepository(directory)
+repo.add_transactions(sample_transactions(args.rows))
+start = time.perf_counter()
+repo.snapshot()
+print('snapshot %.2f s, %.0f MB' % (time.perf_counter() - start,
+                                    os.path.getsize(os.path.join(directory, STATE_FILE)) / 1e6))
+repo.close()
+
+start = time.perf_counter()
+repo = MemoryRepository(directory)
+print('restore %.2f s, %d transactions' % (time.perf_counter() - start, len(repo._store)))
+start = time.perf_counter()
+repo.get_transaction(args.rows // 2)
+repo.balance()
+sum(1 for _ in repo.query_transactions('2024-03-01', '2024-03-31', 'food'))
+print('first get, balance and range %.3f s' % (time.perf_counter() - start))
+start = time.perf_counter()
+repo.add_transaction(Transaction(None, 1.0, 'new', 'income', 'salary', '2024-12-31'))
+print('first write %.1f ms' % ((time.perf_counter() - start) * 1000))
+repo.log.close()
+shutil.rmtree(directory)
@@ -0,0 +1,63 @@
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Benchmarks run from a checkout: python benchmarks/<name>.py
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from models import Transaction  # noqa: E402
+
+CATEGORIES = ('food', 'rent', 'travel', 'salary', 'utilities', 'fun')
+
+
+def sample_transactions(count, first_id=None, seed=0):
+    # count transactions spread over 2024, the same for the same seed; ids
+    # from first_id on, or None for the repository to assign
+    rnd = random.Random(seed)
+    return [Transaction(None if first_id is None else first_id + i, rnd.randint(1, 99999) / 100,
+                        'Groceries at store %d' % (i % 300), rnd.choice(('expense', 'income')),
+                        rnd.choice(CATEGORIES), '2024-%02d-%02d' % (i % 12 + 1, i % 28 + 1),
+                        i % 50 == 0, 'monthly' if i % 50 == 0 else None)
+            for i in range(count)]
+
+
+def open_app(backend, rows):
+    # The Flask app on a fresh data directory, and a test client logged in
+    # to a user whose ledger holds `rows` sample transactions
+    os.environ['LEDGER_DATA_DIR'] = tempfile.mkdtemp(prefix='ledger-bench-')
+    os.environ['LEDGER_BACKEND'] = backend
+    import logging
+    logging.disable(logging.INFO)
+    import main
+    client = main.app.test_client()
+    client.post('/register', data={'username': 'bench', 'password': 'bench'})
+    shard = main.shards.get(main.users.find('bench').id)
+    shard.repository.add_transactions(sample_transactions(rows))
+    return main, client
+
+
+def timed(fn, repeat, before=None):
+    # Seconds each of `repeat` calls took, sorted; before, if given, runs
+    # untimed ahead of each call
+    times = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return sorted(times)
+
+
+def write(client):
+    # A POST that moves the ledger version, so neither the ETag nor the
+    # gzip cache can answer the next read
+    client.post('/api/transactions', json={'amount': 1, 'description': 'x', 'type': 'expense',
+                                           'category': 'food', 'date': '2024-02-01'})
+
+
+def percentile(times, fraction):
+    return times[min(len(times) - 1, int(len(times) * fraction))]
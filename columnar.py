@@ -0,0 +1,227 @@
+import sys
+from array import array
+from bisect import bisect_left
+from datetime import date
+
+from models import MAX_CENTS, Transaction
+
+
+def to_cents(amount):
+    if isinstance(amount, (bool, type(None), list, dict)):
+        raise ValueError("Invalid amount: %r" % (amount,))
+    cents = int(round(float(amount) * 100))
+    if not -MAX_CENTS <= cents <= MAX_CENTS:
+        raise ValueError("Amount out of range: %r" % (amount,))
+    return cents
+
+
+def to_ordinal(value):
+    if not isinstance(value, str):
+        raise ValueError("Invalid date: %r" % (value,))
+    return date.fromisoformat(value).toordinal()
+
+
+class StringTable:
+    # Dictionary encoding: every distinct value is stored once and rows keep
+    # its small integer code. None is a regular value.
+    #
+    # The value -> code map is only needed to encode new values, so a table
+    # restored with from_values builds it on first use.
+
+    def __init__(self, values=()):
+        self.values = []
+        self._codes = {}
+        for value in values:
+            self.encode(value)
+
+    @classmethod
+    def from_values(cls, values):
+        table = cls()
+        table.values = values
+        table._codes = None
+        return table
+
+    @property
+    def codes(self):
+        if self._codes is None:
+            self._codes = dict(zip(self.values, range(len(self.values))))
+        return self._codes
+
+    def encode(self, value):
+        codes = self.codes
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def __len__(self):
+        return len(self.values)
+
+    def nbytes(self):
+        return (sys.getsizeof(self.values) + sys.getsizeof(self._codes)
+                + sum(sys.getsizeof(v) for v in self.values))
+
+
+class ColumnarStore:
+    # Transactions stored column-wise in typed arrays: amounts as int64
+    # cents, dates as day ordinals, and type, category, description and
+    # recurrence interval as codes into StringTables.
+    #
+    # Rows are kept in ascending id order, so the primary key lookup is a
+    # bisect over the ids column and needs no separate index. Deletes clear
+    # the row's bit in `alive` and the arrays are compacted in bulk once dead
+    # rows make up a large share.
+
+    COMPACT_MIN_TOMBSTONES = 1024
+
+    def __init__(self):
+        self.ids = array('q')
+        self.amounts = array('q')
+        self.dates = array('i')
+        self.types = array('B')
+        self.categories = array('I')
+        self.descriptions = array('I')
+        self.intervals = array('B')
+        self.recurring = array('B')
+        self.alive = bytearray()
+
+        self.type_table = StringTable(['expense', 'income'])
+        self.category_table = StringTable()
+        self.description_table = StringTable()
+        self.interval_table = StringTable([None, 'daily', 'weekly', 'monthly', 'yearly'])
+
+        self.tombstones = 0
+
+    @classmethod
+    def from_columns(cls, columns, alive, tables, tombstones):
+        # Adopts arrays and table values as they are, e.g. from a state file
+        store = cls()
+        store.ids, store.amounts, store.dates, store.types, store.categories, store.descriptions, \
+            store.intervals, store.recurring = columns
+        store.alive = alive
+        store.type_table, store.category_table, store.description_table, store.interval_table = \
+            [StringTable.from_values(values) for values in tables]
+        store.tombstones = tombstones
+        return store
+
+    def __len__(self):
+        return len(self.ids) - self.tombstones
+
+    def columns(self):
+        return (self.ids, self.amounts, self.dates, self.types, self.categories, self.descriptions,
+                self.intervals, self.recurring)
+
+    def tables(self):
+        return self.type_table, self.category_table, self.description_table, self.interval_table
+
+    def append(self, transaction):
+        # Encode everything first so a bad value leaves the columns untouched
+        values = (
+            transaction.id,
+            to_cents(transaction.amount),
+            to_ordinal(transaction.date),
+            self.type_table.encode(transaction.type),
+            self.category_table.encode(transaction.category),
+            self.description_table.encode(transaction.description),
+            self.interval_table.encode(transaction.recurrence_interval),
+            1 if transaction.is_recurring else 0,
+        )
+        if values[3] > 255 or values[6] > 255:
+            raise ValueError("Too many distinct transaction types or intervals")
+        if self.ids and transaction.id <= self.ids[-1]:
+            raise ValueError("Transaction ids must be appended in ascending order")
+        row = len(self.ids)
+        for column, value in zip(self.columns(), values):
+            column.append(value)
+        self.alive.append(1)
+        return row
+
+    def extend(self, transactions):
+        # Appends a batch column by column; as in append, every value is
+        # converted to its column's type before any column changes, so a bad
+        # one fails the whole batch. Returns the range of new rows.
+        start = len(self.ids)
+        ids = array('q', [t.id for t in transactions])
+        if any(b <= a for a, b in zip(ids, ids[1:])) or (self.ids and ids and ids[0] <= self.ids[-1]):
+            raise ValueError("Transaction ids must be appended in ascending order")
+        type_code, category_code, description_code, interval_code = [
+            table.encode for table in (self.type_table, self.category_table, self.description_table,
+                                       self.interval_table)]
+        types = [type_code(t.type) for t in transactions]
+        intervals = [interval_code(t.recurrence_interval) for t in transactions]
+        if len(self.type_table) > 256 or len(self.interval_table) > 256:
+            raise ValueError("Too many distinct transaction types or intervals")
+        columns = (ids, [to_cents(t.amount) for t in transactions], [to_ordinal(t.date) for t in transactions],
+                   types, [category_code(t.category) for t in transactions],
+                   [description_code(t.description) for t in transactions], intervals,
+                   [1 if t.is_recurring else 0 for t in transactions])
+        columns = [array(column.typecode, values) for column, values in zip(self.columns(), columns)]
+        for column, values in zip(self.columns(), columns):
+            column.extend(values)
+        self.alive.extend(b'\x01' * len(ids))
+        return range(start, len(self.ids))
+
+    def row(self, row):
+        return Transaction(
+            self.ids[row],
+            self.amounts[row] / 100,
+            self.description_table.values[self.descriptions[row]],
+            self.type_table.values[self.types[row]],
+            self.category_table.values[self.categories[row]],
+            date.fromordinal(self.dates[row]).isoformat(),
+            bool(self.recurring[row]),
+            self.interval_table.values[self.intervals[row]],
+        )
+
+    def rows(self):
+        alive = self.alive
+        return (row for row in range(len(alive)) if alive[row])
+
+    def position(self, transaction_id):
+        # Row of a live transaction, or None
+        ids = self.ids
+        row = bisect_left(ids, transaction_id)
+        if row < len(ids) and ids[row] == transaction_id and self.alive[row]:
+            return row
+        return None
+
+    def get(self, transaction_id):
+        row = self.position(transaction_id)
+        return self.row(row) if row is not None else None
+
+    def delete(self, transaction_id):
+        row = self.position(transaction_id)
+        if row is None:
+            return None
+        deleted = self.row(row)
+        self.alive[row] = 0
+        self.tombstones += 1
+        if self.tombstones >= max(self.COMPACT_MIN_TOMBSTONES, len(self)):
+            self.compact()
+        return deleted
+
+    def delete_many(self, transaction_ids):
+        # Like delete for a batch, compacting at most once at the end
+        deleted = []
+        for transaction_id in transaction_ids:
+            row = self.position(transaction_id)
+            if row is not None:
+                deleted.append(self.row(row))
+                self.alive[row] = 0
+                self.tombstones += 1
+        if self.tombstones >= max(self.COMPACT_MIN_TOMBSTONES, len(self)):
+            self.compact()
+        return deleted
+
+    def compact(self):
+        keep = [row for row in range(len(self.alive)) if self.alive[row]]
+        self.ids, self.amounts, self.dates, self.types, self.categories, self.descriptions, \
+            self.intervals, self.recurring = [array(c.typecode, [c[row] for row in keep]) for c in self.columns()]
+        self.alive = bytearray(b'\x01' * len(keep))
+        self.tombstones = 0
+
+    def nbytes(self):
+        # Column buffers plus string tables
+        columns = sum(c.buffer_info()[1] * c.itemsize for c in self.columns()) + len(self.alive)
+        return columns + sum(t.nbytes() for t in self.tables())
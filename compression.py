@@ -0,0 +1,133 @@
+import gzip
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask_login import current_user
+from werkzeug.wrappers import Response
+
+# Bodies below this many bytes are sent as they are: the gzip framing and the
+# CPU cost outweigh what compression saves
+MIN_SIZE = 1024
+LEVEL = 6
+CACHE_SIZE = 32 * 1024 * 1024
+COMPRESSIBLE = {'application/json', 'application/x-ndjson', 'application/javascript', 'text/css', 'text/csv',
+                'text/html', 'text/javascript', 'text/plain'}
+# A strong ETag names one exact body, so the gzip body of a tagged response
+# gets its own tag: the identity tag with this suffix
+GZIP_SUFFIX = '-gzip'
+
+
+def gzip_etag(etag):
+    return etag + GZIP_SUFFIX
+
+
+def identity_etag(etag):
+    return etag[:-len(GZIP_SUFFIX)] if etag.endswith(GZIP_SUFFIX) else etag
+
+
+def cache_key(request, etag):
+    # Ledger versions are per user and can coincide, so entries are kept
+    # apart by the user the response was made for
+    return current_user.get_id(), request.full_path, etag
+
+
+class CompressedCache:
+    # Gzip responses, a (body, headers) pair, by (user, URL, strong identity
+    # ETag), least recently used evicted first once the bodies add up to
+    # more than `size` bytes. A strong tag names one exact body, so a hit
+    # can never be stale; the entries of superseded ledger versions simply
+    # age out.
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.used = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body, headers):
+        if len(body) > self.size:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.used -= len(old[0])
+            self._entries[key] = (body, headers)
+            self.used += len(body)
+            while self.used > self.size:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.used -= len(evicted)
+
+
+class ResponseCompressor:
+    # Gzips text responses for clients that accept it. Bodies of known
+    # length at or over min_size are compressed whole, and the response is
+    # cached when it has a strong ETag; streamed bodies are compressed chunk
+    # by chunk as the view produces them.
+
+    def __init__(self, level=LEVEL, min_size=MIN_SIZE, cache_size=CACHE_SIZE):
+        self.level = level
+        self.min_size = min_size
+        self.cache = CompressedCache(cache_size)
+
+    def cached_response(self, request, etag):
+        # The cached gzip response to this URL at this version, if the
+        # client takes gzip, so a view need not run again to produce it
+        if request.accept_encodings['gzip'] <= 0:
+            return None
+        entry = self.cache.get(cache_key(request, etag))
+        if entry is None:
+            return None
+        body, headers = entry
+        return Response(body, headers=headers)
+
+    def process(self, request, response):
+        if (response.status_code != 200 or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE):
+            return response
+        response.vary.add('Accept-Encoding')
+        if request.accept_encodings['gzip'] <= 0:
+            return response
+        length = response.content_length
+        if length is not None and length < self.min_size:
+            return response
+        tag, weak = response.get_etag()
+        key = cache_key(request, tag) if tag and not weak and length is not None else None
+        entry = self.cache.get(key) if key is not None else None
+        if length is None:
+            response.response = self._stream(response.iter_encoded())
+        elif entry is not None:
+            if hasattr(response.response, 'close'):
+                response.response.close()
+            response.set_data(entry[0])
+        else:
+            response.direct_passthrough = False
+            response.set_data(gzip.compress(response.get_data(), self.level, mtime=0))
+        response.headers['Content-Encoding'] = 'gzip'
+        if tag:
+            response.set_etag(gzip_etag(tag), weak)
+        if key is not None and entry is None:
+            self.cache.put(key, response.get_data(), [(name, value) for name, value in response.headers
+                                                      if name != 'Date'])
+        if tag and length is not None:
+            # Static files check If-None-Match against their identity tag;
+            # this answers a client revalidating the gzip one. Streams are
+            # left alone, as make_conditional would buffer them to count
+            # their length.
+            response.make_conditional(request)
+        return response
+
+    def _stream(self, chunks):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            # A sync flush per chunk hands the client every line the view
+            # has produced instead of holding it back for the next chunk
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
@@ -0,0 +1,178 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class SortedIndex:
+    # Secondary index ordered by (key, id), kept as two parallel typed
+    # arrays. Lookups bisect; inserts and deletes shift the tail of the
+    # arrays with a memmove. The size of any key range is known after two
+    # bisects, which is what the query planner compares.
+
+    KEY_TYPE = 'q'
+
+    def __init__(self, entries=()):
+        entries = sorted(entries)
+        self.keys = array(self.KEY_TYPE, [key for key, _ in entries])
+        self.ids = array('q', [transaction_id for _, transaction_id in entries])
+
+    @classmethod
+    def from_arrays(cls, keys, ids):
+        index = cls()
+        index.keys = keys
+        index.ids = ids
+        return index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def seek(self, key, transaction_id, after=False):
+        # First entry at or, with `after`, past (key, id)
+        lo = bisect_left(self.keys, key)
+        hi = bisect_right(self.keys, key, lo)
+        return (bisect_right if after else bisect_left)(self.ids, transaction_id, lo, hi)
+
+    def add(self, key, transaction_id):
+        position = self.seek(key, transaction_id)
+        self.keys.insert(position, key)
+        self.ids.insert(position, transaction_id)
+
+    def add_many(self, entries):
+        # Merges a batch of (key, id) entries in one pass: the runs of
+        # existing entries between two new ones are copied once, instead of
+        # the tail being shifted for every insert
+        keys = array(self.KEY_TYPE)
+        ids = array('q')
+        start = 0
+        for key, transaction_id in sorted(entries):
+            position = self.seek(key, transaction_id)
+            keys += self.keys[start:position]
+            ids += self.ids[start:position]
+            keys.append(key)
+            ids.append(transaction_id)
+            start = position
+        keys += self.keys[start:]
+        ids += self.ids[start:]
+        self.keys = keys
+        self.ids = ids
+
+    def remove(self, key, transaction_id):
+        position = self.seek(key, transaction_id)
+        if position < len(self.ids) and self.ids[position] == transaction_id and self.keys[position] == key:
+            del self.keys[position]
+            del self.ids[position]
+
+    def remove_many(self, entries):
+        # Drops a batch of (key, id) entries in one pass, copying the runs
+        # between them once
+        positions = set()
+        for key, transaction_id in entries:
+            position = self.seek(key, transaction_id)
+            if position < len(self.ids) and self.ids[position] == transaction_id and self.keys[position] == key:
+                positions.add(position)
+        if not positions:
+            return
+        keys = array(self.KEY_TYPE)
+        ids = array('q')
+        start = 0
+        for position in sorted(positions):
+            keys += self.keys[start:position]
+            ids += self.ids[start:position]
+            start = position + 1
+        keys += self.keys[start:]
+        ids += self.ids[start:]
+        self.keys = keys
+        self.ids = ids
+
+    def bounds(self, low=None, high=None):
+        # Positions of the entries with low <= key <= high
+        lo = 0 if low is None else bisect_left(self.keys, low)
+        hi = len(self.keys) if high is None else bisect_right(self.keys, high, lo)
+        return lo, hi
+
+    def range(self, low=None, high=None):
+        lo, hi = self.bounds(low, high)
+        return self.ids[lo:hi]
+
+
+class DateIndex(SortedIndex):
+    # Keyed by date ordinal, 12 bytes per transaction
+    KEY_TYPE = 'i'
+
+    @property
+    def ordinals(self):
+        return self.keys
+
+
+class PostingIndex:
+    # Inverted index from a field value to the transactions carrying it. Each
+    # posting list is a DateIndex, so a value's transactions come out in
+    # (date, id) order and can be range- or keyset-sliced like the main
+    # date index. The length of a posting list is the value's reference
+    # count, and a value is dropped as soon as its last transaction goes.
+
+    def __init__(self, entries=()):
+        grouped = {}
+        for key, ordinal, transaction_id in entries:
+            grouped.setdefault(key, []).append((ordinal, transaction_id))
+        self.postings = {key: DateIndex(group) for key, group in grouped.items()}
+
+    @classmethod
+    def from_postings(cls, postings):
+        # postings are (key, ordinals, ids) triples
+        index = cls()
+        index.postings = {key: DateIndex.from_arrays(ordinals, ids) for key, ordinals, ids in postings}
+        return index
+
+    def __len__(self):
+        return len(self.postings)
+
+    def __contains__(self, key):
+        return key in self.postings
+
+    def keys(self):
+        return list(self.postings)
+
+    def count(self, key):
+        index = self.postings.get(key)
+        return len(index) if index is not None else 0
+
+    def get(self, key):
+        index = self.postings.get(key)
+        return index if index is not None else DateIndex()
+
+    def add(self, key, ordinal, transaction_id):
+        index = self.postings.get(key)
+        if index is None:
+            index = self.postings[key] = DateIndex()
+        index.add(ordinal, transaction_id)
+
+    def add_many(self, entries):
+        grouped = {}
+        for key, ordinal, transaction_id in entries:
+            grouped.setdefault(key, []).append((ordinal, transaction_id))
+        for key, group in grouped.items():
+            index = self.postings.get(key)
+            if index is None:
+                self.postings[key] = DateIndex(group)
+            else:
+                index.add_many(group)
+
+    def remove(self, key, ordinal, transaction_id):
+        index = self.postings.get(key)
+        if index is None:
+            return
+        index.remove(ordinal, transaction_id)
+        if not index:
+            del self.postings[key]
+
+    def remove_many(self, entries):
+        grouped = {}
+        for key, ordinal, transaction_id in entries:
+            grouped.setdefault(key, []).append((ordinal, transaction_id))
+        for key, group in grouped.items():
+            index = self.postings.get(key)
+            if index is None:
+                continue
+            index.remove_many(group)
+            if not index:
+                del self.postings[key]
@@ -0,0 +1,266 @@
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date
+
+from columnar import to_cents, to_ordinal
+from models import Transaction, TRANSACTION_TYPES, RECURRENCE_INTERVALS
+
+# Sealed ledger file, little endian, every section 8-byte aligned:
+#
+#   header      magic, seq, row count, category count and section offsets
+#   records     one fixed-width RECORD per transaction, in id order
+#   date index  record numbers ordered by (date, id), then their date ordinals
+#   postings    record numbers of each category ordered by (date, id), then
+#               their date ordinals; a category owns one contiguous run
+#   categories  one CATEGORY entry per distinct category: name, posting run
+#               and per-type totals
+#   heap        UTF-8 strings, each distinct value stored once
+#
+# Strings are (offset, length) pairs into the heap; a length of NONE is None.
+
+MAGIC = b'LEDGER\x00\x01'
+HEADER = struct.Struct('<8sQQQQQQQQ')
+RECORD = struct.Struct('<qqiIIIBBB5x')
+CATEGORY = struct.Struct('<IIQQqqqq')
+NONE = 0xFFFFFFFF
+
+INTERVALS = (None,) + RECURRENCE_INTERVALS
+INTERVAL_CODES = {interval: code for code, interval in enumerate(INTERVALS)}
+TYPE_CODES = {transaction_type: code for code, transaction_type in enumerate(TRANSACTION_TYPES)}
+
+# Stride of RECORD when the records section is viewed as int64 words
+RECORD_WORDS = RECORD.size // 8
+
+
+def _align(buffer):
+    buffer.extend(b'\x00' * (-len(buffer) % 8))
+    return len(buffer)
+
+
+def build_ledger_image(rows, seq=0):
+    # rows are (id, cents, ordinal, type, category, description, is_recurring,
+    # interval) tuples in ascending id order. Returns the file as a bytearray.
+    heap = bytearray()
+    strings = {}
+
+    def intern(value):
+        if value is None:
+            return 0, NONE
+        ref = strings.get(value)
+        if ref is None:
+            encoded = value.encode('utf-8')
+            ref = strings[value] = (len(heap), len(encoded))
+            heap.extend(encoded)
+        return ref
+
+    records = bytearray()
+    ordinals = array('i')
+    category_codes = array('I')
+    categories = {}
+    totals = []
+    pack = RECORD.pack
+    last_id = None
+    for transaction_id, cents, ordinal, transaction_type, category, description, is_recurring, interval in rows:
+        if last_id is not None and transaction_id <= last_id:
+            raise ValueError("Ledger rows must be in ascending id order")
+        last_id = transaction_id
+        code = categories.get(category)
+        if code is None:
+            code = categories[category] = len(totals)
+            totals.append([0, 0, 0, 0])
+        type_code = TYPE_CODES[transaction_type]
+        cell = totals[code]
+        cell[type_code] += cents
+        cell[2 + type_code] += 1
+        description_offset, description_length = intern(description)
+        records += pack(transaction_id, cents, ordinal, code, description_offset, description_length, type_code,
+                        1 if is_recurring else 0, INTERVAL_CODES[interval])
+        ordinals.append(ordinal)
+        category_codes.append(code)
+
+    # A stable sort on the ordinal keeps id order within a day
+    by_date = array('I', sorted(range(len(ordinals)), key=ordinals.__getitem__))
+    runs = [array('I') for _ in totals]
+    for position in by_date:
+        runs[category_codes[position]].append(position)
+
+    image = bytearray(HEADER.size)
+    records_offset = _align(image)
+    image += records
+    date_index_offset = _align(image)
+    image += by_date.tobytes()
+    image += array('i', [ordinals[p] for p in by_date]).tobytes()
+    postings_offset = _align(image)
+    start = 0
+    entries = []
+    for category, code in categories.items():
+        run = runs[code]
+        image += run.tobytes()
+        name_offset, name_length = intern(category)
+        expense_cents, income_cents, expense_count, income_count = totals[code]
+        entries.append(CATEGORY.pack(name_offset, name_length, start, len(run), expense_cents, income_cents,
+                                     expense_count, income_count))
+        start += len(run)
+    for code in range(len(runs)):
+        image += array('i', [ordinals[p] for p in runs[code]]).tobytes()
+    categories_offset = _align(image)
+    for entry in entries:
+        image += entry
+    heap_offset = _align(image)
+    image += heap
+    if len(heap) >= NONE:
+        raise ValueError("Ledger string heap is too large")
+    HEADER.pack_into(image, 0, MAGIC, seq, len(ordinals), len(entries), records_offset, date_index_offset,
+                     postings_offset, categories_offset, heap_offset)
+    return image
+
+
+def write_ledger_file(path, rows, seq=0, compressed=False):
+    # Compressed files trade the zero-copy mapping for a much smaller file
+    image = build_ledger_image(rows, seq)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(zlib.compress(image) if compressed else image)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return image
+
+
+def transaction_row(transaction):
+    # Converts a Transaction into the row tuple build_ledger_image expects
+    return (transaction.id, to_cents(transaction.amount), to_ordinal(transaction.date), transaction.type,
+            transaction.category, transaction.description, transaction.is_recurring,
+            transaction.recurrence_interval)
+
+
+class MappedLedger:
+    # Read-only view of a sealed ledger file. The file is mapped rather than
+    # read, and columns are exposed as strided memoryviews over the mapping,
+    # so opening costs the header and category table however many rows
+    # there are, and scans decode records straight out of the page cache.
+
+    def __init__(self, buffer, mapping=None):
+        self._mapping = mapping
+        view = self._view = memoryview(buffer)
+        magic, self.seq, self.count, ncategories, records_offset, date_index_offset, postings_offset, \
+            categories_offset, heap_offset = HEADER.unpack_from(view, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a ledger file")
+        count = self.count
+        self.records = view[records_offset:records_offset + count * RECORD.size]
+        self._words = self.records.cast('q')
+        self.ids = self._words[0::RECORD_WORDS]
+        self.amounts = self._words[1::RECORD_WORDS]
+        self.date_positions = view[date_index_offset:date_index_offset + 4 * count].cast('I')
+        self.date_ordinals = view[date_index_offset + 4 * count:date_index_offset + 8 * count].cast('i')
+        self.posting_positions = view[postings_offset:postings_offset + 4 * count].cast('I')
+        self.posting_ordinals = view[postings_offset + 4 * count:postings_offset + 8 * count].cast('i')
+        self.heap = view[heap_offset:]
+
+        self.categories = []
+        self.category_runs = {}
+        self.category_totals = []
+        for code in range(ncategories):
+            name_offset, name_length, start, run_length, expense_cents, income_cents, expense_count, \
+                income_count = CATEGORY.unpack_from(view, categories_offset + code * CATEGORY.size)
+            category = self._string(name_offset, name_length)
+            self.categories.append(category)
+            self.category_runs[category] = (start, start + run_length)
+            for transaction_type, cents, cell_count in (('expense', expense_cents, expense_count),
+                                                        ('income', income_cents, income_count)):
+                if cell_count:
+                    self.category_totals.append((category, transaction_type, cents, cell_count))
+
+    @classmethod
+    def open(cls, path, compressed=False):
+        # A missing file is an empty ledger
+        if not os.path.exists(path):
+            return cls(build_ledger_image(()))
+        with open(path, 'rb') as f:
+            if compressed:
+                return cls(zlib.decompress(f.read()))
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapping, mapping)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def max_id(self):
+        return self.ids[-1] if self.count else -1
+
+    def _string(self, offset, length):
+        if length == NONE:
+            return None
+        return str(self.heap[offset:offset + length], 'utf-8')
+
+    def _transaction(self, fields):
+        transaction_id, cents, ordinal, category, description_offset, description_length, type_code, \
+            is_recurring, interval_code = fields
+        return Transaction(transaction_id, cents / 100, self._string(description_offset, description_length),
+                           TRANSACTION_TYPES[type_code], self.categories[category],
+                           date.fromordinal(ordinal).isoformat(), bool(is_recurring), INTERVALS[interval_code])
+
+    def position(self, transaction_id):
+        position = bisect_left(self.ids, transaction_id)
+        if position < self.count and self.ids[position] == transaction_id:
+            return position
+        return None
+
+    def __contains__(self, transaction_id):
+        return self.position(transaction_id) is not None
+
+    def row(self, position):
+        return self._transaction(RECORD.unpack_from(self.records, position * RECORD.size))
+
+    def get(self, transaction_id):
+        position = self.position(transaction_id)
+        return self.row(position) if position is not None else None
+
+    def transactions(self, skip=()):
+        # Every row in id order, decoded sequentially from the mapping
+        for fields in RECORD.iter_unpack(self.records):
+            if fields[0] not in skip:
+                yield self._transaction(fields)
+
+    def query(self, start=None, end=None, category=None, skip=()):
+        # Rows with start <= date ordinal <= end (either end open) and in
+        # `category` if given, ordered by (date, id)
+        if category is None:
+            positions, ordinals, lo, hi = self.date_positions, self.date_ordinals, 0, self.count
+        elif category in self.category_runs:
+            positions, ordinals = self.posting_positions, self.posting_ordinals
+            lo, hi = self.category_runs[category]
+        else:
+            return
+        if start is not None:
+            lo = bisect_left(ordinals, start, lo, hi)
+        if end is not None:
+            hi = bisect_right(ordinals, end, lo, hi)
+        ids = self.ids
+        for position in positions[lo:hi]:
+            if ids[position] not in skip:
+                yield self.row(position)
+
+    def rows(self, skip=()):
+        # Raw row tuples for rewriting the file, without building Transactions
+        categories = self.categories
+        for fields in RECORD.iter_unpack(self.records):
+            transaction_id, cents, ordinal, category, description_offset, description_length, type_code, \
+                is_recurring, interval_code = fields
+            if transaction_id not in skip:
+                yield (transaction_id, cents, ordinal, TRANSACTION_TYPES[type_code], categories[category],
+                       self._string(description_offset, description_length), bool(is_recurring),
+                       INTERVALS[interval_code])
+
+    def close(self):
+        for name in ('ids', 'amounts', 'date_positions', 'date_ordinals', 'posting_positions',
+                     'posting_ordinals', 'heap', '_words', 'records', '_view'):
+            getattr(self, name).release()
+        if self._mapping is not None:
+            self._mapping.close()
@@ -1,12 +1,28 @@
-from flask import Flask, render_template, jsonify, request, send_file
+from flask import (Flask, Response, render_template, jsonify, request, send_file, redirect, url_for, flash,
+                   make_response)
+from flask_login import LoginManager, current_user, login_required, login_user, logout_user
 from datetime import datetime, timedelta
+from functools import partial, wraps
+import atexit
+import base64
 import logging
 import json
 import csv
 import io
+import os
+import secrets
+import click
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle
+from werkzeug.exceptions import RequestEntityTooLarge
+from aggregates import SUMMARY_FIELDS
+from compression import ResponseCompressor, gzip_etag, identity_etag
+from models import (TRANSACTION_FIELDS, TRANSACTION_TYPES, Transaction, ValidationError, encode_columns,
+                    encode_fields, encode_lines, encode_list, parse_amount, parse_date, parse_flag)
+from repository import create_shard_registry
+from storage import LedgerInUseError
+from users import UserStore
 
 app = Flask(__name__)
 
@@ -14,79 +30,515 @@ app = Flask(__name__)
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Simulating a database with a list
-transactions = []
-recurring_transactions = []
+data_dir = os.environ.get('LEDGER_DATA_DIR', 'data')
+
+def load_secret_key():
+    # Sessions must survive restarts and be shared by every worker process
+    if os.environ.get('SECRET_KEY'):
+        return os.environ['SECRET_KEY']
+    path = os.path.join(data_dir, 'secret_key')
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        with open(path, 'x') as f:
+            f.write(secrets.token_hex(32))
+    with open(path) as f:
+        return f.read().strip()
+
+app.secret_key = load_secret_key()
+
+login_manager = LoginManager(app)
+login_manager.login_view = 'login'
+users = UserStore(os.path.join(data_dir, 'users.json'))
+
+# Every user's ledger is a separate shard with its own lock
+shards = create_shard_registry()
+atexit.register(shards.close)
+
+compressor = ResponseCompressor()
+
+@login_manager.user_loader
+def load_user(user_id):
+    return users.get(user_id)
+
+@login_manager.unauthorized_handler
+def unauthorized():
+    if request.path.startswith('/api/'):
+        return jsonify({'error': 'Authentication required'}), 401
+    return redirect(url_for('login'))
+
+def current_shard():
+    return shards.get(current_user.id)
+
+def ledger_users(username):
+    if username is None:
+        return users.all()
+    user = users.find(username)
+    if user is None:
+        raise click.ClickException("Unknown user: %s" % username)
+    return [user]
+
+def command_shard(user):
+    # A ledger a running server has open stays locked until it exits, and the
+    # commands must not write it behind the server's back
+    try:
+        return shards.get(user.id)
+    except LedgerInUseError as e:
+        raise click.ClickException("%s; stop the server first" % e)
+
+@app.cli.command('snapshot', help='Write the binary snapshot of every ledger, or of one user\'s ledger.')
+@click.argument('username', required=False)
+@click.option('--output', type=click.Path(dir_okay=False), help='Write a standalone copy to this file instead.')
+def snapshot_command(username, output):
+    if output is not None and username is None:
+        raise click.UsageError("--output needs a username")
+    for user in ledger_users(username):
+        shard = command_shard(user)
+        with shard.lock.write():
+            try:
+                shard.repository.snapshot(output)
+            except (NotImplementedError, ValueError) as e:
+                raise click.ClickException("Cannot snapshot this ledger: %s"
+                                           % (str(e) or 'not supported by this backend'))
+        click.echo("Snapshot written for %s" % user.username)
+
+@app.cli.command('restore', help='Replace a user\'s ledger with a snapshot written by snapshot --output.')
+@click.argument('username')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def restore_command(username, path):
+    user = ledger_users(username)[0]
+    shard = command_shard(user)
+    with shard.lock.write():
+        try:
+            shard.repository.restore(path)
+        except (NotImplementedError, ValueError) as e:
+            raise click.ClickException("Cannot restore this ledger: %s"
+                                       % (str(e) or 'not supported by this backend'))
+        shard.reset()
+    click.echo("Ledger of %s restored from %s" % (username, path))
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+MAX_BULK_SIZE = 100000
+# Larger request bodies are refused with 413 before any of them is read;
+# room for MAX_BULK_SIZE items of 512 bytes
+MAX_BODY_BYTES = MAX_BULK_SIZE * 512
+app.config['MAX_CONTENT_LENGTH'] = MAX_BODY_BYTES
+# NDJSON streams read pages that start at STREAM_CHUNK_SIZE rows and double
+# up to MAX_STREAM_CHUNK_SIZE
+STREAM_CHUNK_SIZE = 100
+MAX_STREAM_CHUNK_SIZE = 10000
+
+def json_response(body, status=200):
+    return Response(body, status=status, mimetype='application/json')
+
+def query_args():
+    # Filters shared by the listing and the exports; absent ones are None
+    args = request.args
+    filters = {
+        'date_from': parse_date(args['from'], 'from') if 'from' in args else None,
+        'date_to': parse_date(args['to'], 'to') if 'to' in args else None,
+        'category': args.get('category'),
+        'transaction_type': args.get('type'),
+        'min_amount': parse_amount(args['min_amount'], 'min_amount') if 'min_amount' in args else None,
+        'max_amount': parse_amount(args['max_amount'], 'max_amount') if 'max_amount' in args else None,
+        'is_recurring': parse_flag(args['is_recurring'], 'is_recurring') if 'is_recurring' in args else None,
+    }
+    if filters['transaction_type'] not in (None,) + TRANSACTION_TYPES:
+        raise ValidationError("Invalid type: %r" % filters['transaction_type'])
+    return filters
+
+def transaction_encoder():
+    # Encoder for the listing: ?fields= projects the objects to some fields,
+    # ?format=columnar returns one array per field instead and
+    # ?format=ndjson one object per line. Whole objects are joined from the
+    # shard's cached fragments.
+    fields = request.args.get('fields')
+    if fields is not None:
+        fields = tuple(dict.fromkeys(fields.split(',')))
+        if not all(field in TRANSACTION_FIELDS for field in fields):
+            raise ValidationError("Invalid fields: %r" % request.args['fields'])
+    response_format = request.args.get('format', 'rows')
+    fragments = current_shard().fragments
+    if response_format == 'ndjson':
+        return partial(encode_lines, fields=fields) if fields is not None else fragments.encode_lines
+    if response_format == 'columnar':
+        return partial(encode_columns, fields=fields or TRANSACTION_FIELDS)
+    if response_format != 'rows':
+        raise ValidationError("Invalid format: %r" % response_format)
+    if fields is not None:
+        return partial(encode_fields, fields=fields)
+    return fragments.encode_list
+
+def stream_transactions(shard, filters, encode):
+    # NDJSON chunks in (date, id) order, read as keyset pages. The first
+    # page is small so the first byte goes out quickly; later ones grow to
+    # amortise the per-page seek. The read lock is held per page only, so
+    # a slow client never holds up writers, and one page at most is in
+    # memory. Rows written mid-stream appear if they sort after the pages
+    # already sent.
+    after = None
+    size = STREAM_CHUNK_SIZE
+    while True:
+        with shard.lock.read():
+            transactions = shard.repository.page_transactions(after, size, **filters)
+        if transactions:
+            yield encode(transactions)
+        if len(transactions) < size:
+            return
+        after = (transactions[-1].date, transactions[-1].id)
+        size = min(size * 2, MAX_STREAM_CHUNK_SIZE)
+
+def encode_cursor(transaction):
+    # Opaque keyset position: the (date, id) of the last transaction served
+    key = json.dumps([transaction.date, transaction.id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        key_date, key_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(key_id, int) or isinstance(key_id, bool):
+            raise ValueError(key_id)
+    except (TypeError, ValueError):
+        raise ValidationError("Invalid cursor: %r" % cursor)
+    return parse_date(key_date, 'cursor'), key_id
+
+def parse_version(value):
+    # (epoch, version) of a ledger version as written in its ETag
+    epoch, _, version = identity_etag(value.strip('"')).rpartition('-')
+    if not epoch or not version.isdigit():
+        raise ValidationError("Invalid version: %r" % value)
+    return epoch, int(version)
+
+def page_args():
+    # (after, limit) when the request asks for a page, otherwise None
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit')
+    if cursor is None and limit is None:
+        return None
+    try:
+        limit = int(limit) if limit is not None else DEFAULT_PAGE_SIZE
+    except ValueError:
+        raise ValidationError("Invalid limit: %r" % limit)
+    return (decode_cursor(cursor) if cursor is not None else None), min(max(limit, 1), MAX_PAGE_SIZE)
+
+def bulk_items():
+    # Items of a bulk body, a JSON array or NDJSON with one object per line,
+    # and their results so far: None, or an error for an NDJSON line that
+    # is not JSON, which fails that item alone
+    body = request.get_data(cache=False)
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        results = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+                results.append(None)
+            except ValueError:
+                items.append(None)
+                results.append({'error': "Invalid JSON line", 'status': 400})
+        return items, results
+    try:
+        items = json.loads(body)
+    except ValueError:
+        raise ValidationError("Invalid JSON data")
+    if not isinstance(items, list):
+        raise ValidationError("Bulk body must be a JSON array")
+    return items, [None] * len(items)
+
+def conditional(view):
+    # Serves GETs with a strong ETag for the ledger version and answers a
+    # matching If-None-Match with 304 without running the view. The version
+    # is read before the view runs, so a concurrent write can only leave the
+    # ETag older than the body (one extra refetch), never a stale 304. On a
+    # shared backend it is first synced with the version in storage.
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET':
+            return view(*args, **kwargs)
+        shard = current_shard()
+        shard.sync()
+        with shard.lock.read():
+            etag = shard.etag
+        # A client may hold the gzip variant of the tag (see compression)
+        matched = next((tag for tag in (etag, gzip_etag(etag)) if request.if_none_match.contains_weak(tag)), None)
+        if matched is not None:
+            response = Response(status=304)
+            response.set_etag(matched)
+            response.vary.add('Accept-Encoding')
+        else:
+            # A gzip body made for this URL at this version is served again
+            # without running the view
+            cached = compressor.cached_response(request, etag)
+            if cached is not None:
+                return cached
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            response.set_etag(etag)
+        # Stored by the browser but revalidated on every use
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return wrapper
+
+@app.after_request
+def compress_response(response):
+    return compressor.process(request, response)
+
+@app.errorhandler(ValidationError)
+def handle_validation_error(e):
+    return jsonify({'error': str(e)}), 400
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_body_too_large(e):
+    return jsonify({'error': "Request body too large: at most %d bytes" % app.config['MAX_CONTENT_LENGTH']}), 413
 
 @app.route('/')
+@login_required
 def index():
     logger.debug("Accessing index page")
     return render_template('index.html')
 
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    if request.method == 'POST':
+        user = users.find(request.form.get('username', ''))
+        if user is not None and user.check_password(request.form.get('password', '')):
+            login_user(user)
+            return redirect(url_for('index'))
+        flash('Invalid username or password')
+    return render_template('login.html')
+
+@app.route('/register', methods=['GET', 'POST'])
+def register():
+    if request.method == 'POST':
+        username = request.form.get('username', '').strip()
+        password = request.form.get('password', '')
+        if not username or not password:
+            flash('Username and password are required')
+        else:
+            user = users.create(username, password)
+            if user is None:
+                flash('Username already taken')
+            else:
+                login_user(user)
+                return redirect(url_for('index'))
+    return render_template('register.html')
+
+@app.route('/logout')
+def logout():
+    logout_user()
+    return redirect(url_for('login'))
+
 @app.route('/api/current_time')
 def get_current_time():
     return jsonify({'current_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
 
 @app.route('/api/transactions', methods=['GET', 'POST'])
+@login_required
+@conditional
 def handle_transactions():
-    global transactions
+    shard = current_shard()
     if request.method == 'GET':
-        return jsonify(transactions)
+        filters = query_args()
+        page = page_args()
+        encode = transaction_encoder()
+        if request.args.get('explain') == '1':
+            after, limit = page if page is not None else (None, None)
+            with shard.lock.read():
+                return jsonify(shard.repository.explain_query(after, limit, **filters))
+        if request.args.get('format') == 'ndjson':
+            if page is not None:
+                raise ValidationError("format=ndjson streams the whole listing; it takes no cursor or limit")
+            return Response(stream_transactions(shard, filters, encode), mimetype='application/x-ndjson')
+        if page is None:
+            with shard.lock.read():
+                return json_response(encode(shard.repository.query_transactions(**filters)))
+        after, limit = page
+        # One extra row tells whether there is a next page
+        with shard.lock.read():
+            transactions = shard.repository.page_transactions(after, limit + 1, **filters)
+        next_url = None
+        if len(transactions) > limit:
+            transactions = transactions[:limit]
+            args = request.args.to_dict()
+            args.update(cursor=encode_cursor(transactions[-1]), limit=limit)
+            next_url = url_for('handle_transactions', **args)
+        response = json_response(b'{"next":' + json.dumps(next_url).encode('utf-8') + b',"transactions":'
+                                 + encode(transactions) + b'}')
+        if next_url is not None:
+            response.headers['Link'] = '<%s>; rel="next"' % next_url
+        return response
     elif request.method == 'POST':
         data = request.json
         if data is None:
             return jsonify({'error': 'Invalid JSON data'}), 400
-        transaction = {
-            'id': len(transactions),
-            'amount': data.get('amount'),
-            'description': data.get('description'),
-            'type': data.get('type'),
-            'category': data.get('category'),
-            'date': data.get('date', datetime.now().strftime('%Y-%m-%d')),
-            'is_recurring': data.get('is_recurring', False),
-            'recurrence_interval': data.get('recurrence_interval')
-        }
-        transactions.append(transaction)
-        if transaction['is_recurring']:
-            add_recurring_transaction(transaction)
-        return jsonify(transaction), 201
+        transaction = Transaction.from_request(data)
+        with shard.write():
+            transaction = shard.repository.add_transactions_with_rules([transaction])[0]
+            shard.bump(inserted=[transaction])
+        return json_response(transaction.to_json(), 201)
+
+@app.route('/api/transactions/bulk', methods=['POST'])
+@login_required
+def bulk_insert_transactions():
+    # Validates every item up front, then inserts the valid ones as one
+    # batch: one id block, one index merge and one commit. results[i] is
+    # {"id", "status": 201} or {"error", "status": 400} for item i.
+    items, results = bulk_items()
+    if len(items) > MAX_BULK_SIZE:
+        return jsonify({'error': "Too many items: at most %d per request" % MAX_BULK_SIZE}), 413
+    positions = []
+    transactions = []
+    for position, item in enumerate(items):
+        if results[position] is not None:
+            continue
+        try:
+            transactions.append(Transaction.from_request(item))
+            positions.append(position)
+        except ValidationError as e:
+            results[position] = {'error': str(e), 'status': 400}
+    shard = current_shard()
+    with shard.write():
+        stored = shard.repository.add_transactions_with_rules(transactions)
+        if stored:
+            shard.bump(inserted=stored)
+    for position, transaction in zip(positions, stored):
+        results[position] = {'id': transaction.id, 'status': 201}
+    # 207 Multi-Status when some items failed; the results say which
+    return jsonify({'inserted': len(stored), 'failed': len(items) - len(stored), 'results': results}), \
+        201 if len(stored) == len(items) else 207
+
+@app.route('/api/transactions/<int:transaction_id>', methods=['GET'])
+@login_required
+@conditional
+def get_transaction(transaction_id):
+    shard = current_shard()
+    with shard.lock.read():
+        transaction = shard.repository.get_transaction(transaction_id)
+    if transaction is None:
+        return jsonify({'error': 'Transaction not found'}), 404
+    return json_response(shard.fragments.encode(transaction))
 
 @app.route('/api/transactions/<int:transaction_id>', methods=['DELETE'])
+@login_required
 def delete_transaction(transaction_id):
-    global transactions, recurring_transactions
-    for i, transaction in enumerate(transactions):
-        if transaction['id'] == transaction_id:
-            deleted_transaction = transactions.pop(i)
-            if deleted_transaction['is_recurring']:
-                remove_recurring_transaction(deleted_transaction)
-            return '', 204
-    return jsonify({'error': 'Transaction not found'}), 404
+    shard = current_shard()
+    with shard.write():
+        deleted_transaction = shard.repository.delete_transaction(transaction_id)
+        if deleted_transaction is None:
+            return jsonify({'error': 'Transaction not found'}), 404
+        if deleted_transaction.is_recurring:
+            remove_recurring_transaction(shard.repository, deleted_transaction)
+        shard.bump(deleted=[deleted_transaction])
+    return '', 204
+
+@app.route('/api/changes')
+@login_required
+@conditional
+def get_changes():
+    # Inserts and deletes since ?since=<version>, the value of an ETag from
+    # this ledger. "resync": true means the change log cannot bridge the gap
+    # (too far behind, a restart, a restore) and the client must refetch.
+    encode = transaction_encoder()
+    since = request.args.get('since')
+    shard = current_shard()
+    epoch, version = parse_version(since) if since is not None else (None, None)
+    with shard.lock.read():
+        current = shard.etag
+        changes = shard.changes_since(version) if epoch == shard.epoch else None
+    if changes is None:
+        return jsonify({'version': current, 'resync': True})
+    inserted, deleted = changes
+    return json_response(b'{"deleted":' + json.dumps(deleted).encode('utf-8') + b',"inserted":' + encode(inserted)
+                         + b',"resync":false,"version":' + json.dumps(current).encode('utf-8') + b'}')
+
+@app.route('/api/transactions', methods=['DELETE'])
+@login_required
+def delete_transactions():
+    # Deletes the ids in an {"ids": [...]} body, or every transaction that
+    # matches the query string filters, as one batch
+    filters = query_args()
+    ids = None
+    if request.get_data():
+        data = request.get_json(silent=True)
+        ids = data.get('ids') if isinstance(data, dict) else None
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            raise ValidationError("Body must be an object with a list of integer ids")
+        if len(ids) > MAX_BULK_SIZE:
+            return jsonify({'error': "Too many ids: at most %d per request" % MAX_BULK_SIZE}), 413
+    filtered = any(value is not None for value in filters.values())
+    if ids is not None and filtered:
+        raise ValidationError("Give either ids or filters, not both")
+    if ids is None and not filtered:
+        raise ValidationError("Give ids or at least one filter")
+    shard = current_shard()
+    with shard.write():
+        if ids is None:
+            ids = [transaction.id for transaction in shard.repository.query_transactions(**filters)]
+        deleted = shard.repository.delete_transactions(ids)
+        rule_ids = [transaction.id for transaction in deleted if transaction.is_recurring]
+        if rule_ids:
+            shard.repository.remove_rules(rule_ids)
+        if deleted:
+            shard.bump(deleted=deleted)
+    return jsonify({'count': len(deleted), 'deleted': [transaction.id for transaction in deleted]})
 
 @app.route('/api/categories')
+@login_required
+@conditional
 def get_categories():
-    categories = set()
-    for transaction in transactions:
-        categories.add(transaction['category'])
-    return jsonify(list(categories))
+    shard = current_shard()
+    with shard.lock.read():
+        return jsonify(shard.repository.categories())
+
+@app.route('/api/balance')
+@login_required
+@conditional
+def get_balance():
+    shard = current_shard()
+    with shard.lock.read():
+        return jsonify(shard.repository.balance())
+
+@app.route('/api/summary')
+@login_required
+@conditional
+def get_summary():
+    # Aggregates of the transactions matching the listing's filters, per
+    # ?group_by= combination of category, type and month
+    filters = query_args()
+    group_by = request.args.get('group_by')
+    group_by = tuple(dict.fromkeys(group_by.split(','))) if group_by else ()
+    if not all(field in SUMMARY_FIELDS for field in group_by):
+        raise ValidationError("Invalid group_by: %r" % request.args['group_by'])
+    shard = current_shard()
+    with shard.lock.read():
+        return jsonify(shard.summary(group_by, **filters))
 
 @app.route('/api/export/csv')
+@login_required
+@conditional
 def export_csv():
+    filters = query_args()
+    shard = current_shard()
     csv_output = io.StringIO()
     csv_writer = csv.writer(csv_output)
     
     csv_writer.writerow(['ID', 'Amount', 'Description', 'Type', 'Category', 'Date', 'Is Recurring', 'Recurrence Interval'])
     
-    for transaction in transactions:
-        csv_writer.writerow([
-            transaction['id'],
-            transaction['amount'],
-            transaction['description'],
-            transaction['type'],
-            transaction['category'],
-            transaction['date'],
-            transaction['is_recurring'],
-            transaction.get('recurrence_interval', '')
-        ])
+    with shard.lock.read():
+        for transaction in shard.repository.query_transactions(**filters):
+            csv_writer.writerow([
+                transaction.id,
+                transaction.amount,
+                transaction.description,
+                transaction.type,
+                transaction.category,
+                transaction.date,
+                transaction.is_recurring,
+                transaction.recurrence_interval or ''
+            ])
     
     output = csv_output.getvalue()
     csv_output.close()
@@ -99,22 +551,29 @@ def export_csv():
     )
 
 @app.route('/api/export/pdf')
+@login_required
+@conditional
 def export_pdf():
+    filters = query_args()
+    shard = current_shard()
     buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=letter)
+    # invariant drops the creation date and random document id, so the same
+    # ledger always renders to the same bytes, as its strong ETag promises
+    doc = SimpleDocTemplate(buffer, pagesize=letter, invariant=1)
     
     data = [['ID', 'Amount', 'Description', 'Type', 'Category', 'Date', 'Is Recurring', 'Recurrence Interval']]
-    for transaction in transactions:
-        data.append([
-            transaction['id'],
-            transaction['amount'],
-            transaction['description'],
-            transaction['type'],
-            transaction['category'],
-            transaction['date'],
-            'Yes' if transaction['is_recurring'] else 'No',
-            transaction.get('recurrence_interval', '')
-        ])
+    with shard.lock.read():
+        for transaction in shard.repository.query_transactions(**filters):
+            data.append([
+                transaction.id,
+                transaction.amount,
+                transaction.description,
+                transaction.type,
+                transaction.category,
+                transaction.date,
+                'Yes' if transaction.is_recurring else 'No',
+                transaction.recurrence_interval or ''
+            ])
     
     table = Table(data)
     
@@ -150,51 +609,55 @@ def export_pdf():
         download_name='transactions.pdf'
     )
 
-def add_recurring_transaction(transaction):
-    recurring_transactions.append(transaction)
-
-def remove_recurring_transaction(transaction):
-    global recurring_transactions
-    recurring_transactions = [t for t in recurring_transactions if t['id'] != transaction['id']]
+def remove_recurring_transaction(repository, transaction):
+    repository.remove_rule(transaction.id)
 
 @app.route('/api/process_recurring_transactions', methods=['POST'])
+@login_required
 def process_recurring_transactions():
-    global transactions
-    current_date = datetime.now().date()
-    new_transactions = []
+    shard = current_shard()
+    with shard.write():
+        new_transactions = materialize_recurring_transactions(shard.repository)
+        if new_transactions:
+            shard.bump(inserted=new_transactions)
+    return json_response(encode_list(new_transactions), 201)
 
-    for recurring_transaction in recurring_transactions:
-        last_occurrence = datetime.strptime(recurring_transaction['date'], '%Y-%m-%d').date()
-        interval = recurring_transaction['recurrence_interval']
-
-        if interval == 'daily':
-            days_to_add = 1
-        elif interval == 'weekly':
-            days_to_add = 7
-        elif interval == 'monthly':
-            days_to_add = 30
-        elif interval == 'yearly':
-            days_to_add = 365
-        else:
-            continue
+def materialize_recurring_transactions(repository):
+    return repository.advance_rules(partial(due_occurrences, current_date=datetime.now().date()))
 
-        next_occurrence = last_occurrence + timedelta(days=days_to_add)
+def due_occurrences(recurring_transaction, current_date):
+    # Occurrences of a rule dated up to current_date, and the date of the
+    # last one (the rule's own date when none is due)
+    last_occurrence = datetime.strptime(recurring_transaction.date, '%Y-%m-%d').date()
+    interval = recurring_transaction.recurrence_interval
 
-        while next_occurrence <= current_date:
-            new_transaction = recurring_transaction.copy()
-            new_transaction['id'] = len(transactions)
-            new_transaction['date'] = next_occurrence.strftime('%Y-%m-%d')
-            new_transaction['is_recurring'] = False
-            new_transaction.pop('recurrence_interval', None)
-            
-            transactions.append(new_transaction)
-            new_transactions.append(new_transaction)
-            
-            next_occurrence += timedelta(days=days_to_add)
+    if interval == 'daily':
+        days_to_add = 1
+    elif interval == 'weekly':
+        days_to_add = 7
+    elif interval == 'monthly':
+        days_to_add = 30
+    elif interval == 'yearly':
+        days_to_add = 365
+    else:
+        return [], recurring_transaction.date
+
+    new_transactions = []
+    next_occurrence = last_occurrence + timedelta(days=days_to_add)
 
-        recurring_transaction['date'] = (next_occurrence - timedelta(days=days_to_add)).strftime('%Y-%m-%d')
+    while next_occurrence <= current_date:
+        new_transaction = recurring_transaction.copy(
+            id=None,
+            date=next_occurrence.strftime('%Y-%m-%d'),
+            is_recurring=False,
+            recurrence_interval=None
+        )
+        new_transactions.append(new_transaction)
+        
+        next_occurrence += timedelta(days=days_to_add)
 
-    return jsonify(new_transactions), 201
+    last_date = (next_occurrence - timedelta(days=days_to_add)).strftime('%Y-%m-%d')
+    return new_transactions, last_date
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
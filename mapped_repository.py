@@ -0,0 +1,214 @@
+import heapq
+import os
+import threading
+from itertools import chain, islice
+
+from columnar import to_cents, to_ordinal
+from ledger_file import MappedLedger, transaction_row, write_ledger_file
+from models import Transaction
+from planner import counted, sealed_plan
+from repository import MemoryRepository, TransactionRepository, transaction_filter
+from storage import LedgerLog
+
+LEDGER_FILE = 'ledger.bin'
+
+
+def _date_order(transaction):
+    return transaction.date, transaction.id
+
+
+class MappedRepository(MemoryRepository):
+    # Ledger for very large histories. Everything up to the last compaction
+    # is sealed into a memory-mapped ledger file (see ledger_file), and only
+    # transactions added since then live in the in-memory columnar tail
+    # inherited from MemoryRepository. Deletes of sealed rows are kept as
+    # tombstones until the next compaction rewrites the file.
+    #
+    # The sealed file, the lowest id it does not cover and its tombstones
+    # travel together in self._sealed and are replaced in one assignment, so
+    # a reader always sees a file and tail that match. Tail rows covered by
+    # a new file, and the mapping it replaced, are dropped by the next
+    # writer, which excludes readers.
+
+    def __init__(self, directory):
+        self._lock = threading.RLock()
+        self._path = os.path.join(directory, LEDGER_FILE)
+        self.log = LedgerLog(directory, self._state, self._lock, seal_fn=self._seal)
+        transactions, rules, next_id = self.log.open()
+        base = MappedLedger.open(self._path)
+        tombstones = {transaction_id for transaction_id in self.log.replayed_deletes if transaction_id in base}
+        self._sealed = (base, base.max_id + 1, tombstones)
+        self._sealing_deletes = None
+        self._untrimmed = False
+        self._retired = []
+        self._load(Transaction.from_dict(t) for t in transactions if t['id'] not in base)
+        for category, transaction_type, cents, count in base.category_totals:
+            self._totals.add(category, transaction_type, cents, count)
+        for transaction_id in tombstones:
+            deleted = base.get(transaction_id)
+            self._totals.remove(deleted.category, deleted.type, to_cents(deleted.amount))
+        self._rules = {r['id']: Transaction.from_dict(r) for r in rules}
+        self._next_id = max(next_id, base.max_id + 1)
+
+    def _state(self):
+        # Runs under self._lock at the start of a compaction
+        base, boundary, tombstones = self._sealed
+        self._capture = (base, frozenset(tombstones))
+        self._sealing_deletes = set()
+        tail = [t for t in MemoryRepository.iter_transactions(self) if t.id >= boundary]
+        return tail, [r.to_dict() for r in self._rules.values()], self._next_id
+
+    def _seal(self, seq, tail):
+        # Rewrites the file with every live row captured by _state, then
+        # swaps it in. Deletes made while the file was being written become
+        # tombstones of the new file.
+        base, tombstones = self._capture
+        write_ledger_file(self._path, chain(base.rows(tombstones), map(transaction_row, tail)), seq)
+        sealed = MappedLedger.open(self._path)
+        with self._lock:
+            deleted = self._sealing_deletes
+            self._sealing_deletes = None
+            retired, boundary = self._sealed[:2]
+            if tail:
+                boundary = tail[-1].id + 1
+            self._sealed = (sealed, boundary, {i for i in deleted if i in sealed})
+            self._untrimmed = bool(tail)
+            # A reader may still be scanning the old mapping; it is closed
+            # by the next writer
+            self._retired.append(retired)
+        self._capture = None
+        return []
+
+    def _trim(self):
+        while self._retired:
+            self._retired.pop().close()
+        if self._untrimmed:
+            boundary = self._sealed[1]
+            totals = self._totals
+            self._load([t for t in MemoryRepository.iter_transactions(self) if t.id >= boundary])
+            self._totals = totals
+            self._untrimmed = False
+
+    def iter_transactions(self):
+        base, boundary, tombstones = self._sealed
+        tail = MemoryRepository.iter_transactions(self)
+        return chain(base.transactions(tombstones), (t for t in tail if t.id >= boundary))
+
+    def get_transaction(self, transaction_id):
+        base, boundary, tombstones = self._sealed
+        if transaction_id >= boundary:
+            return self._store.get(transaction_id)
+        if transaction_id in tombstones:
+            return None
+        return base.get(transaction_id)
+
+    def _query(self, filters, sealed_stats=None):
+        # The sealed file answers the date and category filters from its own
+        # indexes and checks the rest per row; the tail is planned as in
+        # MemoryRepository. Returns the merged rows and the tail's plan.
+        base, boundary, tombstones = self._sealed
+        start = to_ordinal(filters['date_from']) if filters.get('date_from') else None
+        end = to_ordinal(filters['date_to']) if filters.get('date_to') else None
+        sealed = base.query(start, end, filters.get('category'), tombstones)
+        if sealed_stats is not None:
+            sealed = counted(sealed, sealed_stats)
+        matches = transaction_filter(transaction_type=filters.get('transaction_type'),
+                                     min_amount=filters.get('min_amount'), max_amount=filters.get('max_amount'),
+                                     is_recurring=filters.get('is_recurring'))
+        if matches is not None:
+            sealed = filter(matches, sealed)
+        plan = self._plan(filters)
+        tail = (t for t in plan.transactions() if t.id >= boundary)
+        return heapq.merge(sealed, tail, key=_date_order), plan
+
+    def query_transactions(self, date_from=None, date_to=None, category=None, transaction_type=None,
+                           min_amount=None, max_amount=None, is_recurring=None):
+        filters = {'date_from': date_from, 'date_to': date_to, 'category': category,
+                   'transaction_type': transaction_type, 'min_amount': min_amount, 'max_amount': max_amount,
+                   'is_recurring': is_recurring}
+        if all(value is None for value in filters.values()):
+            return self.iter_transactions()
+        return self._query(filters)[0]
+
+    def explain_query(self, after=None, limit=None, **filters):
+        if after is not None:
+            filters['date_from'] = max(filters.get('date_from') or '0001-01-01', after[0])
+        stats = sealed_plan(filters)
+        rows, plan = self._query(filters, stats)
+        if after is not None:
+            rows = (t for t in rows if (t.date, t.id) > after)
+        stats['returned'] = sum(1 for _ in islice(rows, limit))
+        stats['tail'] = plan.explain()
+        return stats
+
+    # The hot indexes only cover part of the ledger; the generic keyset page
+    # runs over the lazy merge of query_transactions instead
+    page_transactions = TransactionRepository.page_transactions
+
+    def categories(self):
+        return list(dict.fromkeys(category for category, _ in self._totals.cells))
+
+    def add_transaction(self, transaction):
+        with self._lock:
+            self._trim()
+            return super().add_transaction(transaction)
+
+    def add_transactions(self, transactions):
+        with self._lock:
+            self._trim()
+            return super().add_transactions(transactions)
+
+    def delete_transaction(self, transaction_id):
+        with self._lock:
+            self._trim()
+            base, boundary, tombstones = self._sealed
+            if transaction_id >= boundary:
+                deleted_transaction = super().delete_transaction(transaction_id)
+            elif transaction_id in tombstones:
+                deleted_transaction = None
+            else:
+                deleted_transaction = base.get(transaction_id)
+                if deleted_transaction is not None:
+                    tombstones.add(transaction_id)
+                    self._totals.remove(deleted_transaction.category, deleted_transaction.type,
+                                        to_cents(deleted_transaction.amount))
+                    self.log.append('delete', {'id': transaction_id})
+            if deleted_transaction is not None and self._sealing_deletes is not None:
+                self._sealing_deletes.add(transaction_id)
+        return deleted_transaction
+
+    def delete_transactions(self, transaction_ids):
+        with self._lock:
+            self._trim()
+            base, boundary, tombstones = self._sealed
+            deleted = self._remove_many([i for i in transaction_ids if i >= boundary])
+            for transaction_id in transaction_ids:
+                if transaction_id < boundary and transaction_id not in tombstones:
+                    deleted_transaction = base.get(transaction_id)
+                    if deleted_transaction is not None:
+                        tombstones.add(transaction_id)
+                        self._totals.remove(deleted_transaction.category, deleted_transaction.type,
+                                            to_cents(deleted_transaction.amount))
+                        deleted.append(deleted_transaction)
+            if deleted:
+                self.log.append('delete_many', {'ids': [t.id for t in deleted]})
+            if self._sealing_deletes is not None:
+                self._sealing_deletes.update(t.id for t in deleted)
+        return deleted
+
+    def snapshot(self, path=None):
+        # The sealed file is the snapshot; sealing rewrites it in place
+        if path is not None:
+            raise ValueError("Mapped ledgers can only be snapshotted in place")
+        self.log.compact()
+
+    def restore(self, path):
+        raise ValueError("Mapped ledgers cannot be restored from a state file")
+
+    def close(self):
+        # No seal on shutdown: it rewrites the whole file, and the log tail
+        # is bounded by compact_bytes anyway
+        self.log.close()
+        for ledger in self._retired:
+            ledger.close()
+        self._sealed[0].close()
@@ -0,0 +1,263 @@
+import json
+import threading
+from collections import OrderedDict
+from itertools import count
+from datetime import date, datetime
+from operator import attrgetter
+
+TRANSACTION_FIELDS = ('id', 'amount', 'description', 'type', 'category', 'date', 'is_recurring',
+                      'recurrence_interval')
+TRANSACTION_TYPES = ('expense', 'income')
+# Amounts are stored as int64 cents
+MAX_CENTS = 2 ** 63 - 1
+RECURRENCE_INTERVALS = ('daily', 'weekly', 'monthly', 'yearly')
+# Fields the columnar encoding stores as a value table plus codes
+DICTIONARY_FIELDS = ('type', 'category', 'recurrence_interval')
+# Bytes of encoded transactions the process-wide FragmentCache holds
+FRAGMENT_CACHE_SIZE = 64 * 1024 * 1024
+# What an entry costs on top of its bytes: key, dict slot and bytes header
+FRAGMENT_OVERHEAD = 220
+
+
+class ValidationError(ValueError):
+    pass
+
+
+def parse_date(value, name='date'):
+    # Normalises to YYYY-MM-DD, which every backend compares as a string
+    try:
+        return date.fromisoformat(value).isoformat()
+    except (TypeError, ValueError):
+        raise ValidationError("Invalid %s: %r" % (name, value))
+
+
+def parse_amount(value, name='amount'):
+    # Finite float from a number or numeric string
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValidationError("Invalid %s: %r" % (name, value))
+    try:
+        amount = float(value)
+    except ValueError:
+        raise ValidationError("Invalid %s: %r" % (name, value))
+    if amount != amount or amount in (float('inf'), float('-inf')):
+        raise ValidationError("Invalid %s: %r" % (name, value))
+    # Storage keeps amounts as int64 cents
+    if abs(round(amount * 100)) > MAX_CENTS:
+        raise ValidationError("Invalid %s: %r is out of range" % (name, value))
+    return amount
+
+
+def parse_flag(value, name):
+    # Query string boolean: true/false or 1/0
+    if value in ('true', '1'):
+        return True
+    if value in ('false', '0'):
+        return False
+    raise ValidationError("Invalid %s: %r" % (name, value))
+
+
+class Transaction:
+    # A ledger entry. Recurring rules use the same type with is_recurring set.
+    #
+    # The JSON encoding is cached on first use and dropped whenever a field
+    # is assigned, so unchanged records are serialised once.
+
+    __slots__ = TRANSACTION_FIELDS + ('_json',)
+
+    def __init__(self, id=None, amount=0.0, description=None, type='expense', category=None, date=None,
+                 is_recurring=False, recurrence_interval=None):
+        set_field = object.__setattr__
+        set_field(self, 'id', id)
+        set_field(self, 'amount', amount)
+        set_field(self, 'description', description)
+        set_field(self, 'type', type)
+        set_field(self, 'category', category)
+        set_field(self, 'date', date)
+        set_field(self, 'is_recurring', is_recurring)
+        set_field(self, 'recurrence_interval', recurrence_interval)
+        set_field(self, '_json', None)
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        object.__setattr__(self, '_json', None)
+
+    def __repr__(self):
+        return 'Transaction(%s)' % ', '.join('%s=%r' % (f, getattr(self, f)) for f in TRANSACTION_FIELDS)
+
+    def __eq__(self, other):
+        if not isinstance(other, Transaction):
+            return NotImplemented
+        return all(getattr(self, f) == getattr(other, f) for f in TRANSACTION_FIELDS)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{f: data.get(f) for f in TRANSACTION_FIELDS if f in data})
+
+    @classmethod
+    def from_request(cls, data):
+        # Validates a client payload; the id is always assigned by storage
+        if not isinstance(data, dict):
+            raise ValidationError("Transaction must be a JSON object")
+
+        amount = parse_amount(data.get('amount'))
+
+        transaction_type = data.get('type', 'expense')
+        if transaction_type not in TRANSACTION_TYPES:
+            raise ValidationError("Invalid type: %r" % (transaction_type,))
+
+        transaction_date = parse_date(data.get('date') or datetime.now().strftime('%Y-%m-%d'))
+
+        # A JSON boolean, or one of the query string spellings; anything
+        # else is rejected rather than read as truthy
+        is_recurring = data.get('is_recurring')
+        if is_recurring is None:
+            is_recurring = False
+        elif not isinstance(is_recurring, bool):
+            is_recurring = parse_flag(is_recurring, 'is_recurring')
+        recurrence_interval = data.get('recurrence_interval')
+        if is_recurring and recurrence_interval not in RECURRENCE_INTERVALS:
+            raise ValidationError("Invalid recurrence interval: %r" % (recurrence_interval,))
+
+        description = data.get('description')
+        category = data.get('category')
+        for name, value in (('description', description), ('category', category)):
+            if value is not None and not isinstance(value, str):
+                raise ValidationError("Invalid %s: %r" % (name, value))
+
+        return cls(None, amount, description, transaction_type, category, transaction_date, is_recurring,
+                   recurrence_interval if is_recurring else None)
+
+    def copy(self, **changes):
+        values = {f: getattr(self, f) for f in TRANSACTION_FIELDS}
+        values.update(changes)
+        return Transaction(**values)
+
+    def to_dict(self):
+        return {f: getattr(self, f) for f in TRANSACTION_FIELDS}
+
+    def to_json(self):
+        encoded = self._json
+        if encoded is None:
+            # Same key order and separators as Flask's jsonify
+            encoded = json.dumps(self.to_dict(), sort_keys=True, separators=(',', ':')).encode()
+            object.__setattr__(self, '_json', encoded)
+        return encoded
+
+
+def encode_list(transactions):
+    # Builds a JSON array out of the per-record cached encodings
+    return b'[' + b','.join(t.to_json() for t in transactions) + b']'
+
+
+class FragmentCache:
+    # to_json bytes of stored transactions by (ledger, id), shared by every
+    # ledger of the process. Repositories build fresh Transaction objects for
+    # every query, so their own cached encoding never survives a request;
+    # this one does. Stored transactions are never modified, and ids are
+    # never reused, so an entry stays valid until its transaction is
+    # deleted. Least recently used entries are dropped once the entries add
+    # up to more than `size` bytes.
+
+    def __init__(self, size=FRAGMENT_CACHE_SIZE):
+        self.size = size
+        self.used = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._ledgers = count()
+
+    def ledger(self):
+        return LedgerFragments(self, next(self._ledgers))
+
+    def encode(self, ledger, transactions):
+        # The fragments of transactions of one ledger, in order, encoding
+        # and caching those not held yet
+        entries = self._entries
+        fragments = []
+        with self._lock:
+            for transaction in transactions:
+                key = (ledger, transaction.id)
+                fragment = entries.get(key)
+                if fragment is not None:
+                    entries.move_to_end(key)
+                else:
+                    fragment = entries[key] = transaction.to_json()
+                    self.used += len(fragment) + FRAGMENT_OVERHEAD
+                    while self.used > self.size:
+                        _, evicted = entries.popitem(last=False)
+                        self.used -= len(evicted) + FRAGMENT_OVERHEAD
+                fragments.append(fragment)
+        return fragments
+
+    def discard(self, ledger, ids):
+        with self._lock:
+            for transaction_id in ids:
+                fragment = self._entries.pop((ledger, transaction_id), None)
+                if fragment is not None:
+                    self.used -= len(fragment) + FRAGMENT_OVERHEAD
+
+
+class LedgerFragments:
+    # One ledger's part of a FragmentCache. clear() moves the ledger to a
+    # new key, and its old entries age out.
+
+    def __init__(self, cache, ledger):
+        self.cache = cache
+        self.ledger = ledger
+
+    def encode(self, transaction):
+        return self.cache.encode(self.ledger, (transaction,))[0]
+
+    def encode_list(self, transactions):
+        return b'[' + b','.join(self.cache.encode(self.ledger, transactions)) + b']'
+
+    def encode_lines(self, transactions):
+        return b''.join(fragment + b'\n' for fragment in self.cache.encode(self.ledger, transactions))
+
+    def discard(self, ids):
+        self.cache.discard(self.ledger, ids)
+
+    def clear(self):
+        self.ledger = self.cache.ledger().ledger
+
+
+def encode_fields(transactions, fields):
+    # JSON array of objects holding only `fields`, keys sorted like to_json
+    get = attrgetter(*fields)
+    if len(fields) == 1:
+        rows = ({fields[0]: get(t)} for t in transactions)
+    else:
+        rows = (dict(zip(fields, get(t))) for t in transactions)
+    return json.dumps(list(rows), sort_keys=True, separators=(',', ':')).encode()
+
+
+def encode_lines(transactions, fields=None):
+    # NDJSON: one object per line, each line newline terminated
+    if fields is None:
+        return b''.join(t.to_json() + b'\n' for t in transactions)
+    get = attrgetter(*fields)
+    encode = json.JSONEncoder(sort_keys=True, separators=(',', ':')).encode
+    if len(fields) == 1:
+        return b''.join(encode({fields[0]: get(t)}).encode() + b'\n' for t in transactions)
+    return b''.join(encode(dict(zip(fields, get(t)))).encode() + b'\n' for t in transactions)
+
+
+def encode_columns(transactions, fields):
+    # Columnar JSON: {"count": n, "columns": {field: [values]}}, one array
+    # per field instead of one object per transaction. Fields with few
+    # distinct values are dictionary encoded as {"values": [...], "codes":
+    # [...]}, codes indexing values.
+    get = attrgetter(*fields)
+    rows = [get(t) for t in transactions]
+    if len(fields) == 1:
+        transposed = [rows]
+    else:
+        transposed = list(zip(*rows)) or [()] * len(fields)
+    columns = {}
+    for field, column in zip(fields, transposed):
+        if field in DICTIONARY_FIELDS:
+            codes = {}
+            columns[field] = {'codes': [codes.setdefault(value, len(codes)) for value in column],
+                              'values': list(codes)}
+        else:
+            columns[field] = list(column)
+    return json.dumps({'columns': columns, 'count': len(rows)}, sort_keys=True, separators=(',', ':')).encode()
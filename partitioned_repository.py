@@ -0,0 +1,416 @@
+import heapq
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import date
+from itertools import islice
+
+from aggregates import LedgerRollup
+from columnar import to_cents, to_ordinal
+from ledger_file import MappedLedger, transaction_row, write_ledger_file
+from models import Transaction
+from planner import counted, sealed_plan
+from repository import MemoryRepository, TransactionRepository, transaction_filter
+from storage import LedgerLog
+
+MANIFEST_FILE = 'segments.json'
+SEGMENT_DIR = 'segments'
+SEGMENT_SUFFIX = '.seg'
+
+
+def month_of(iso_date):
+    return iso_date[:7]
+
+
+def month_bounds(month):
+    # First and last day ordinals of a 'YYYY-MM' month
+    year, number = int(month[:4]), int(month[5:7])
+    following = date(year + 1, 1, 1) if number == 12 else date(year, number + 1, 1)
+    return date(year, number, 1).toordinal(), following.toordinal() - 1
+
+
+def hot_cutoff(today=None):
+    # Transactions dated before the previous month belong in sealed segments
+    today = today or date.today()
+    if today.month == 1:
+        return '%04d-12' % (today.year - 1)
+    return '%04d-%02d' % (today.year, today.month - 1)
+
+
+def _date_order(transaction):
+    return transaction.date, transaction.id
+
+
+def segment_cells(rows):
+    # [category, type, cents, count, min, max] per cell of a segment's rows,
+    # kept in the manifest so summaries of sealed months read no segment
+    cells = {}
+    for row in rows:
+        cents, key = row[1], (row[4], row[3])
+        cell = cells.get(key)
+        if cell is None:
+            cells[key] = [cents, 1, cents, cents]
+        else:
+            cell[0] += cents
+            cell[1] += 1
+            cell[2] = min(cell[2], cents)
+            cell[3] = max(cell[3], cents)
+    return [[category, transaction_type] + cell for (category, transaction_type), cell in cells.items()]
+
+
+class SegmentCache:
+    # Small LRU of decompressed segments, shared by concurrent readers.
+    # Segment files are never rewritten in place, so names are stable keys.
+
+    def __init__(self, directory, size=8):
+        self.directory = directory
+        self.size = size
+        self._segments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            segment = self._segments.get(name)
+            if segment is not None:
+                self._segments.move_to_end(name)
+                return segment
+        segment = MappedLedger.open(os.path.join(self.directory, name), compressed=True)
+        self.put(name, segment)
+        return segment
+
+    def put(self, name, segment):
+        with self._lock:
+            self._segments[name] = segment
+            self._segments.move_to_end(name)
+            while len(self._segments) > self.size:
+                self._segments.popitem(last=False)
+
+
+class PartitionedRepository(MemoryRepository):
+    # Ledger partitioned by calendar month. Transactions of the current and
+    # previous month are hot: they live in the in-memory columnar store
+    # inherited from MemoryRepository. Older months are sealed into
+    # immutable zlib-compressed segments (one ledger_file image per month)
+    # listed in a manifest together with each segment's id range,
+    # per-category totals and rollup cells (sum, count, min and max per
+    # category and type).
+    #
+    # Queries only open the segments whose month overlaps the date range and
+    # whose summary lists the category; balance, categories and the rollup
+    # behind /api/summary come from the summaries without opening any. Only a few decompressed segments are
+    # cached, so memory is bounded by the hot months, not the history.
+    #
+    # Compaction of the log seals hot rows that have aged out, together with
+    # backdated additions and deletes (tombstones) in sealed months, by
+    # rewriting just the affected months. It runs when the log grows, when
+    # the month rolls over and at shutdown. As with MappedRepository, the
+    # manifest, tombstones and the ids of sealed but not yet dropped hot rows
+    # are swapped in one assignment, and the next writer drops those rows.
+
+    def __init__(self, directory):
+        self._lock = threading.RLock()
+        self.directory = directory
+        self._segments = SegmentCache(os.path.join(directory, SEGMENT_DIR))
+        self.log = LedgerLog(directory, self._state, self._lock, seal_fn=self._seal)
+        transactions, rules, next_id = self.log.open()
+        os.makedirs(os.path.join(directory, SEGMENT_DIR), exist_ok=True)
+        months = self._read_manifest()
+        self._remove_unlisted_segments(months)
+
+        # Rows already sealed are skipped in case the snapshot predates the manifest
+        self._cold = (months, {}, frozenset())
+        hot = [t for t in map(Transaction.from_dict, transactions) if self._find_cold(months, t.id) is None]
+        self._load(sorted(hot, key=lambda t: t.id))
+        tombstones = self._cold[1]
+        for month, summary in months.items():
+            for category, transaction_type, cents, count in summary['totals']:
+                self._totals.add(category, transaction_type, cents, count)
+        for transaction_id in self.log.replayed_deletes:
+            month = self._find_cold(months, transaction_id)
+            if month is not None:
+                deleted = self._segment(months, month).get(transaction_id)
+                tombstones[transaction_id] = month
+                self._totals.remove(deleted.category, deleted.type, to_cents(deleted.amount))
+        self._rules = {r['id']: Transaction.from_dict(r) for r in rules}
+        self._next_id = max([next_id] + [summary['max_id'] + 1 for summary in months.values()])
+
+        self._capture = None
+        self._sealing_deletes = None
+        self._obsolete = []
+        self._untrimmed = False
+        self._cutoff = hot_cutoff()
+        if tombstones or any(month_of(t.date) < self._cutoff for t in hot):
+            self.log.request_compaction()
+
+    def _read_manifest(self):
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return {}
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)['months']
+
+    def _write_manifest(self, seq, months):
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'seq': seq, 'months': months}, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def _remove_unlisted_segments(self, months):
+        listed = {summary['file'] for summary in months.values()}
+        for name in os.listdir(os.path.join(self.directory, SEGMENT_DIR)):
+            if name not in listed:
+                os.remove(os.path.join(self.directory, SEGMENT_DIR, name))
+
+    def _segment(self, months, month):
+        return self._segments.get(months[month]['file'])
+
+    def _find_cold(self, months, transaction_id):
+        # Month of the sealed segment holding the id, opening only segments
+        # whose id range covers it
+        for month, summary in months.items():
+            if summary['min_id'] <= transaction_id <= summary['max_id'] \
+                    and transaction_id in self._segment(months, month):
+                return month
+        return None
+
+    def _state(self):
+        # Runs under self._lock at the start of a compaction
+        months, tombstones, hidden = self._cold
+        self._capture = (months, dict(tombstones), hot_cutoff())
+        self._sealing_deletes = {}
+        rows = [t for t in MemoryRepository.iter_transactions(self) if t.id not in hidden]
+        return rows, [r.to_dict() for r in self._rules.values()], self._next_id
+
+    def _seal(self, seq, rows):
+        # Rewrites every month that gained aged-out rows or tombstones, then
+        # swaps the new manifest in. Returns the rows that stay hot.
+        months, tombstones, cutoff = self._capture
+        sealing = {}
+        hot = []
+        for t in rows:
+            if month_of(t.date) < cutoff:
+                sealing.setdefault(month_of(t.date), []).append(t)
+            else:
+                hot.append(t)
+        dirty = set(sealing) | set(tombstones.values())
+
+        updated = dict(months)
+        written = {}
+        for month in sorted(dirty):
+            sealed_rows = self._segment(months, month).rows(tombstones) if month in months else ()
+            new_rows = map(transaction_row, sealing.get(month, ()))
+            merged = list(heapq.merge(sealed_rows, new_rows, key=lambda row: row[0]))
+            if not merged:
+                updated.pop(month, None)
+                continue
+            name = '%s-%020d%s' % (month, seq, SEGMENT_SUFFIX)
+            segment = MappedLedger(write_ledger_file(os.path.join(self.directory, SEGMENT_DIR, name), merged, seq,
+                                                     compressed=True))
+            self._segments.put(name, segment)
+            written[month] = segment
+            updated[month] = {'file': name, 'count': len(merged), 'min_id': merged[0][0], 'max_id': merged[-1][0],
+                              'totals': segment.category_totals, 'cells': segment_cells(merged)}
+        self._write_manifest(seq, updated)
+
+        with self._lock:
+            deleted = self._sealing_deletes
+            self._sealing_deletes = None
+            current = self._cold[1]
+            kept = {i: month for i, month in current.items() if month not in dirty}
+            kept.update((i, month) for i, month in deleted.items() if month in written and i in written[month])
+            # Rows sealed by an earlier compaction stay hidden until a writer
+            # trims them
+            hidden = self._cold[2] | frozenset(t.id for batch in sealing.values() for t in batch)
+            self._cold = (updated, kept, hidden)
+            self._obsolete.extend(months[month]['file'] for month in dirty if month in months)
+            self._untrimmed = True
+        self._capture = None
+        return [t.to_dict() for t in hot]
+
+    def _trim(self):
+        # Runs in writers, which exclude readers, so nothing still reads the
+        # dropped rows or the replaced segment files
+        if self._untrimmed:
+            months, tombstones, hidden = self._cold
+            if hidden:
+                totals = self._totals
+                self._load([t for t in MemoryRepository.iter_transactions(self) if t.id not in hidden])
+                self._totals = totals
+            self._cold = (months, tombstones, frozenset())
+            for name in self._obsolete:
+                os.remove(os.path.join(self.directory, SEGMENT_DIR, name))
+            self._obsolete = []
+            self._untrimmed = False
+
+    def _check_cutoff(self):
+        cutoff = hot_cutoff()
+        if cutoff != self._cutoff:
+            self._cutoff = cutoff
+            self.log.request_compaction()
+
+    def _sealed_rows(self, months, tombstones, start, end, category, transaction_type=None):
+        # Rows of the sealed months overlapping [start, end], month by month,
+        # ordered by (date, id); each segment is opened only when reached.
+        # Months whose totals have no cell for the category and type are
+        # skipped without opening them.
+        for month in sorted(months):
+            first, last = month_bounds(month)
+            if (start is not None and last < start) or (end is not None and first > end):
+                continue
+            if (category is not None or transaction_type is not None) and not any(
+                    (category is None or c == category) and (transaction_type is None or t == transaction_type)
+                    for c, t, _, _ in months[month]['totals']):
+                continue
+            yield from self._segment(months, month).query(start, end, category, tombstones)
+
+    def iter_transactions(self):
+        # Ordered by (date, id) rather than id, so a full export streams one
+        # segment at a time
+        return self.query_transactions()
+
+    def _query(self, filters, sealed_stats=None):
+        # Sealed months answer the date and category filters from their
+        # segment indexes and check the rest per row; the hot months are
+        # planned as in MemoryRepository. Returns the merged rows and the
+        # hot months' plan.
+        months, tombstones, hidden = self._cold
+        start = to_ordinal(filters['date_from']) if filters.get('date_from') else None
+        end = to_ordinal(filters['date_to']) if filters.get('date_to') else None
+        sealed = self._sealed_rows(months, tombstones, start, end, filters.get('category'),
+                                   filters.get('transaction_type'))
+        if sealed_stats is not None:
+            sealed = counted(sealed, sealed_stats)
+        matches = transaction_filter(transaction_type=filters.get('transaction_type'),
+                                     min_amount=filters.get('min_amount'), max_amount=filters.get('max_amount'),
+                                     is_recurring=filters.get('is_recurring'))
+        if matches is not None:
+            sealed = filter(matches, sealed)
+        plan = self._plan(filters)
+        hot = (t for t in plan.transactions() if t.id not in hidden)
+        return heapq.merge(sealed, hot, key=_date_order), plan
+
+    def query_transactions(self, date_from=None, date_to=None, category=None, transaction_type=None,
+                           min_amount=None, max_amount=None, is_recurring=None):
+        return self._query({'date_from': date_from, 'date_to': date_to, 'category': category,
+                            'transaction_type': transaction_type, 'min_amount': min_amount,
+                            'max_amount': max_amount, 'is_recurring': is_recurring})[0]
+
+    def explain_query(self, after=None, limit=None, **filters):
+        if after is not None:
+            filters['date_from'] = max(filters.get('date_from') or '0001-01-01', after[0])
+        stats = sealed_plan(filters)
+        rows, plan = self._query(filters, stats)
+        if after is not None:
+            rows = (t for t in rows if (t.date, t.id) > after)
+        stats['returned'] = sum(1 for _ in islice(rows, limit))
+        stats['hot'] = plan.explain()
+        return stats
+
+    def get_transaction(self, transaction_id):
+        months, tombstones, hidden = self._cold
+        if transaction_id not in hidden:
+            transaction = self._store.get(transaction_id)
+            if transaction is not None:
+                return transaction
+        if transaction_id in tombstones:
+            return None
+        month = self._find_cold(months, transaction_id)
+        return self._segment(months, month).get(transaction_id) if month is not None else None
+
+    def rollup(self):
+        # Sealed months start from the cells their segments were sealed
+        # with; only tombstoned rows and the hot months are read
+        months, tombstones, hidden = self._cold
+        rollup = LedgerRollup()
+        for month, summary in months.items():
+            if 'cells' in summary:
+                for category, transaction_type, cents, count, low, high in summary['cells']:
+                    rollup.cells[(category, transaction_type, month)] = [cents, count, low, high]
+            else:
+                # Sealed before segments carried their cells
+                for transaction in self._segment(months, month).transactions():
+                    rollup.add(transaction)
+        for transaction_id, month in tombstones.items():
+            rollup.remove(self._segment(months, month).get(transaction_id))
+        for transaction in MemoryRepository.iter_transactions(self):
+            if transaction.id not in hidden:
+                rollup.add(transaction)
+        return rollup
+
+    # The hot indexes only cover part of the ledger; the generic keyset page
+    # runs over the lazy merge of query_transactions instead
+    page_transactions = TransactionRepository.page_transactions
+
+    def categories(self):
+        return list(dict.fromkeys(category for category, _ in self._totals.cells))
+
+    def add_transaction(self, transaction):
+        with self._lock:
+            self._trim()
+            self._check_cutoff()
+            return super().add_transaction(transaction)
+
+    def add_transactions(self, transactions):
+        with self._lock:
+            self._trim()
+            self._check_cutoff()
+            return super().add_transactions(transactions)
+
+    def delete_transaction(self, transaction_id):
+        with self._lock:
+            self._trim()
+            self._check_cutoff()
+            deleted_transaction = super().delete_transaction(transaction_id)
+            months, tombstones, _ = self._cold
+            if deleted_transaction is None and transaction_id not in tombstones:
+                month = self._find_cold(months, transaction_id)
+                if month is not None:
+                    deleted_transaction = self._segment(months, month).get(transaction_id)
+                    tombstones[transaction_id] = month
+                    self._totals.remove(deleted_transaction.category, deleted_transaction.type,
+                                        to_cents(deleted_transaction.amount))
+                    self.log.append('delete', {'id': transaction_id})
+            if deleted_transaction is not None and self._sealing_deletes is not None:
+                self._sealing_deletes[transaction_id] = month_of(deleted_transaction.date)
+        return deleted_transaction
+
+    def delete_transactions(self, transaction_ids):
+        with self._lock:
+            self._trim()
+            self._check_cutoff()
+            deleted = self._remove_many(transaction_ids)
+            hot = {t.id for t in deleted}
+            months, tombstones, _ = self._cold
+            for transaction_id in transaction_ids:
+                if transaction_id in hot or transaction_id in tombstones:
+                    continue
+                month = self._find_cold(months, transaction_id)
+                if month is not None:
+                    deleted_transaction = self._segment(months, month).get(transaction_id)
+                    tombstones[transaction_id] = month
+                    self._totals.remove(deleted_transaction.category, deleted_transaction.type,
+                                        to_cents(deleted_transaction.amount))
+                    deleted.append(deleted_transaction)
+            if deleted:
+                self.log.append('delete_many', {'ids': [t.id for t in deleted]})
+            if self._sealing_deletes is not None:
+                self._sealing_deletes.update((t.id, month_of(t.date)) for t in deleted)
+        return deleted
+
+    def snapshot(self, path=None):
+        if path is not None:
+            raise ValueError("Partitioned ledgers can only be snapshotted in place")
+        self.log.compact()
+
+    def restore(self, path):
+        raise ValueError("Partitioned ledgers cannot be restored from a state file")
+
+    def close(self):
+        super().close()
+        # Nothing reads after close, so replaced segments can go now
+        for name in self._obsolete:
+            os.remove(os.path.join(self.directory, SEGMENT_DIR, name))
+        self._obsolete = []
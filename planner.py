@@ -0,0 +1,154 @@
+from math import ceil, floor
+
+from columnar import to_ordinal
+
+# Intersect another index range with the driving one when it is at most this
+# many times larger; past that, checking the column per candidate is cheaper
+# than building the id set.
+INTERSECT_RATIO = 4
+
+
+def amount_bounds(min_amount, max_amount):
+    # Inclusive bounds in cents; amounts are stored as whole cents
+    low = ceil(round(min_amount * 100, 6)) if min_amount is not None else None
+    high = floor(round(max_amount * 100, 6)) if max_amount is not None else None
+    return low, high
+
+
+class QueryPlan:
+    # Plans a filtered query over a MemoryRepository. Three indexes can
+    # produce candidates: the category posting list (also bounded by date),
+    # the date index and the amount index. Each knows its exact candidate
+    # count after two bisects, so the plan drives the query from the
+    # smallest, intersects the id sets of the others that are not much
+    # larger, and checks whatever predicates remain on the columns of each
+    # candidate row. type and is_recurring are always column checks.
+    #
+    # Matches come out in (date, id) order: straight from a date-ordered
+    # driver, or sorted when the amount index drives. A plan for one page
+    # of `limit` rows sorts its whole amount range again for every page,
+    # so the amount index only drives it when that is cheaper than reading
+    # a date-ordered driver until the page is full.
+
+    def __init__(self, store, dates, categories, amounts, date_from=None, date_to=None, category=None,
+                 transaction_type=None, min_amount=None, max_amount=None, is_recurring=None, limit=None):
+        self.store = store
+        start = to_ordinal(date_from) if date_from else None
+        end = to_ordinal(date_to) if date_to else None
+        low, high = amount_bounds(min_amount, max_amount)
+
+        # (name, index, lo, hi, predicates the candidates already satisfy)
+        candidates = []
+        if category is not None:
+            index = categories.get(category)
+            candidates.append(('category', index) + index.bounds(start, end) + ({'category', 'date'},))
+        elif start is not None or end is not None:
+            candidates.append(('date', dates) + dates.bounds(start, end) + ({'date'},))
+        if low is not None or high is not None:
+            candidates.append(('amount', amounts) + amounts.bounds(low, high) + ({'amount'},))
+        if not candidates:
+            candidates.append(('scan', dates, 0, len(dates), set()))
+        candidates.sort(key=lambda candidate: candidate[3] - candidate[2])
+        if limit is not None and candidates[0][0] == 'amount':
+            # Sorting the k amount candidates against reading about
+            # limit * m / k of the m date-ordered ones. The amount range is
+            # then checked per row, as intersecting it would cost k a page.
+            size = candidates[0][3] - candidates[0][2]
+            ordered = candidates[1:] or [('scan', dates, 0, len(dates), set())]
+            if size * size > limit * (ordered[0][3] - ordered[0][2]):
+                candidates = ordered
+
+        self.driver = candidates[0]
+        self.estimate = self.driver[3] - self.driver[2]
+        covered = set(self.driver[4])
+        self.intersections = []
+        for name, index, lo, hi, predicates in candidates[1:]:
+            if hi - lo <= INTERSECT_RATIO * self.estimate:
+                self.intersections.append((name, set(index.ids[lo:hi])))
+                covered |= predicates
+
+        self.filters = []
+        self.checks = []
+        if 'date' not in covered and (start is not None or end is not None):
+            self._check('date', store.dates, lambda ordinal: (start is None or ordinal >= start)
+                        and (end is None or ordinal <= end))
+        if 'category' not in covered and category is not None:
+            category_code = store.category_table.codes.get(category)
+            self._check('category', store.categories, lambda value: value == category_code)
+        if 'amount' not in covered and (low is not None or high is not None):
+            self._check('amount', store.amounts, lambda cents: (low is None or cents >= low)
+                        and (high is None or cents <= high))
+        if transaction_type is not None:
+            type_code = store.type_table.codes.get(transaction_type)
+            self._check('type', store.types, lambda value: value == type_code)
+        if is_recurring is not None:
+            flag = 1 if is_recurring else 0
+            self._check('is_recurring', store.recurring, lambda value: value == flag)
+        self.scanned = 0
+
+    def _check(self, name, column, test):
+        self.filters.append(name)
+        self.checks.append((column, test))
+
+    def _matches(self, ids, lo, hi):
+        # Store rows of the candidates in ids[lo:hi] that pass every filter
+        position = self.store.position
+        sets = [id_set for _, id_set in self.intersections]
+        checks = self.checks
+        for i in range(lo, hi):
+            self.scanned += 1
+            transaction_id = ids[i]
+            if sets and not all(transaction_id in s for s in sets):
+                continue
+            row = position(transaction_id)
+            if row is not None and all(test(column[row]) for column, test in checks):
+                yield row
+
+    def rows(self, after=None):
+        # Matching store rows in (date, id) order, past the keyset key
+        # `after`, a (date ordinal, id) pair
+        name, index, lo, hi, _ = self.driver
+        if name != 'amount':
+            if after is not None:
+                lo = max(lo, index.seek(*after, after=True))
+            return self._matches(index.ids, lo, hi)
+        dates, ids = self.store.dates, self.store.ids
+        keyed = sorted((dates[row], ids[row], row) for row in self._matches(index.ids, lo, hi))
+        return (row for ordinal, transaction_id, row in keyed
+                if after is None or (ordinal, transaction_id) > after)
+
+    def transactions(self, after=None):
+        row = self.store.row
+        return map(row, self.rows(after))
+
+    def explain(self):
+        return {
+            'index': self.driver[0],
+            'estimate': self.estimate,
+            'intersect': [name for name, _ in self.intersections],
+            'filters': self.filters,
+            'scanned': self.scanned,
+        }
+
+
+def sealed_plan(filters):
+    # Explain dict for a sealed ledger file (see ledger_file), which reads
+    # through its category or date index and checks the other filters on
+    # each row it decodes
+    if filters.get('category') is not None:
+        index = 'category'
+    elif filters.get('date_from') or filters.get('date_to'):
+        index = 'date'
+    else:
+        index = 'scan'
+    checked = [name for name, keys in (('type', ('transaction_type',)), ('amount', ('min_amount', 'max_amount')),
+                                       ('is_recurring', ('is_recurring',)))
+               if any(filters.get(key) is not None for key in keys)]
+    return {'index': index, 'filters': checked, 'scanned': 0}
+
+
+def counted(rows, plan):
+    # Passes rows through, counting them in plan['scanned']
+    for row in rows:
+        plan['scanned'] += 1
+        yield row
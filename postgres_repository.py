@@ -0,0 +1,549 @@
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+
+try:
+    import psycopg2
+    from psycopg2 import sql
+    from psycopg2.extras import execute_values
+except ImportError:  # pragma: no cover - optional dependency
+    psycopg2 = None
+
+from models import Transaction, TRANSACTION_FIELDS
+from aggregates import summarize_totals
+from repository import TransactionRepository
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+SELECT pg_advisory_xact_lock(7261001);
+CREATE TABLE IF NOT EXISTS transactions (
+    id BIGSERIAL PRIMARY KEY,
+    amount DOUBLE PRECISION,
+    description TEXT,
+    type TEXT,
+    category TEXT,
+    date DATE,
+    is_recurring BOOLEAN NOT NULL DEFAULT FALSE,
+    recurrence_interval TEXT
+);
+CREATE TABLE IF NOT EXISTS recurring_rules (
+    id BIGINT PRIMARY KEY,
+    amount DOUBLE PRECISION,
+    description TEXT,
+    type TEXT,
+    category TEXT,
+    date DATE,
+    is_recurring BOOLEAN NOT NULL DEFAULT TRUE,
+    recurrence_interval TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_transactions_date_id ON transactions (date, id);
+CREATE INDEX IF NOT EXISTS ix_transactions_category_date_id ON transactions (category, date, id);
+DROP INDEX IF EXISTS ix_transactions_date;
+DROP INDEX IF EXISTS ix_transactions_category_date;
+CREATE INDEX IF NOT EXISTS ix_transactions_type_date ON transactions (type, date);
+CREATE INDEX IF NOT EXISTS ix_transactions_amount ON transactions (amount);
+CREATE TABLE IF NOT EXISTS ledger_totals (
+    category TEXT,
+    type TEXT,
+    total DOUBLE PRECISION NOT NULL DEFAULT 0,
+    count BIGINT NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ux_ledger_totals ON ledger_totals (category, type) NULLS NOT DISTINCT;
+CREATE TABLE IF NOT EXISTS ledger_version (
+    epoch TEXT NOT NULL,
+    version BIGINT NOT NULL
+);
+INSERT INTO ledger_version (epoch, version)
+    SELECT substr(md5(random()::text || clock_timestamp()::text), 1, 16), 0
+    WHERE NOT EXISTS (SELECT 1 FROM ledger_version);
+CREATE OR REPLACE FUNCTION ledger_totals_insert() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO ledger_totals (category, type, total, count)
+        SELECT category, type, SUM(amount), COUNT(*) FROM new_rows GROUP BY category, type
+        ON CONFLICT (category, type) DO UPDATE
+        SET total = ledger_totals.total + EXCLUDED.total, count = ledger_totals.count + EXCLUDED.count;
+    UPDATE ledger_version SET version = version + (SELECT COUNT(*) FROM new_rows);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION ledger_totals_delete() RETURNS trigger AS $$
+BEGIN
+    UPDATE ledger_totals SET total = ledger_totals.total - deleted.total, count = ledger_totals.count - deleted.count
+        FROM (SELECT category, type, SUM(amount) AS total, COUNT(*) AS count FROM old_rows
+              GROUP BY category, type) AS deleted
+        WHERE ledger_totals.category IS NOT DISTINCT FROM deleted.category
+          AND ledger_totals.type IS NOT DISTINCT FROM deleted.type;
+    DELETE FROM ledger_totals WHERE count <= 0;
+    UPDATE ledger_version SET version = version + (SELECT COUNT(*) FROM old_rows);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+'''
+
+# Run once on a database without the statement-level triggers, replacing
+# the per-row trigger of older versions. Totals are applied once per
+# statement from its transition table, so a batch insert updates each
+# (category, type) cell once instead of once per row.
+CREATE_TOTALS_TRIGGER = '''
+DROP TRIGGER IF EXISTS tr_ledger_totals ON transactions;
+DROP FUNCTION IF EXISTS ledger_totals_apply();
+CREATE TRIGGER tr_ledger_totals_insert AFTER INSERT ON transactions
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION ledger_totals_insert();
+CREATE TRIGGER tr_ledger_totals_delete AFTER DELETE ON transactions
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION ledger_totals_delete();
+DELETE FROM ledger_totals;
+INSERT INTO ledger_totals (category, type, total, count)
+    SELECT category, type, SUM(amount), COUNT(*) FROM transactions GROUP BY category, type;
+'''
+
+COLUMNS = ', '.join(TRANSACTION_FIELDS)
+INSERT_COLUMNS = ', '.join(TRANSACTION_FIELDS[1:])
+
+SELECT_TRANSACTIONS = 'SELECT %s FROM transactions ORDER BY id' % COLUMNS
+INSERT_TRANSACTIONS = 'INSERT INTO transactions (%s) VALUES %%s RETURNING id' % INSERT_COLUMNS
+# Filtered queries are assembled from these clauses in this fixed order;
+# the planner picks among the date, category and amount indexes
+FILTER_CLAUSES = (
+    ('date_from', 'date >= %s'),
+    ('date_to', 'date <= %s'),
+    ('category', 'category = %s'),
+    ('transaction_type', 'type = %s'),
+    ('min_amount', 'amount >= %s'),
+    ('max_amount', 'amount <= %s'),
+    ('is_recurring', 'is_recurring = %s'),
+)
+SELECT_WHERE = 'SELECT %s FROM transactions WHERE ' % COLUMNS
+ORDER_BY_DATE = ' ORDER BY date, id'
+# Keyset pages: (date, id) row comparisons are index range bounds on
+# ix_transactions_date_id and ix_transactions_category_date_id
+PAGE_AFTER = ' AND (date, id) > (%s, %s) ORDER BY date, id LIMIT %s'
+MIN_DATE = '0001-01-01'
+SELECT_TRANSACTION = 'SELECT %s FROM transactions WHERE id = %%s' % COLUMNS
+DELETE_TRANSACTION = 'DELETE FROM transactions WHERE id = %%s RETURNING %s' % COLUMNS
+DELETE_TRANSACTIONS = 'DELETE FROM transactions WHERE id = ANY(%%s) RETURNING %s' % COLUMNS
+SELECT_CATEGORIES = 'SELECT DISTINCT category FROM transactions'
+SELECT_TOTALS = 'SELECT category, type, total, count FROM ledger_totals'
+# Rollup cells of the matching rows, ((category, type, month), [cents,
+# count, min, max]), aggregated in the database
+CENTS = 'ROUND(amount * 100)::BIGINT'
+# SUM of a BIGINT is a NUMERIC, which psycopg2 would return as a Decimal
+SELECT_SUMMARY = ("SELECT category, type, to_char(date, 'YYYY-MM') AS month, SUM(%s)::BIGINT, COUNT(*), "
+                  "MIN(%s), MAX(%s) FROM transactions" % (CENTS, CENTS, CENTS))
+GROUP_BY_CELL = ' GROUP BY category, type, month'
+SELECT_VERSION = 'SELECT epoch, version FROM ledger_version'
+SELECT_RULES = 'SELECT %s FROM recurring_rules ORDER BY id' % COLUMNS
+UPSERT_RULE = ('INSERT INTO recurring_rules (%s) VALUES (%s) ON CONFLICT (id) DO UPDATE SET %s'
+               % (COLUMNS, ', '.join(['%s'] * len(TRANSACTION_FIELDS)),
+                  ', '.join('%s = EXCLUDED.%s' % (f, f) for f in TRANSACTION_FIELDS[1:])))
+# Locks the rules until the transaction ends, so concurrent runs queue up
+SELECT_RULES_FOR_UPDATE = SELECT_RULES + ' FOR UPDATE'
+# Moves a rule on only if no other process has moved it since it was read
+ADVANCE_RULE = 'UPDATE recurring_rules SET date = %s WHERE id = %s AND date = %s'
+DELETE_RULE = 'DELETE FROM recurring_rules WHERE id = %s'
+DELETE_RULES = 'DELETE FROM recurring_rules WHERE id = ANY(%s)'
+
+EXPORT_FETCH_SIZE = 2000
+
+
+def filter_clauses(filters):
+    # The FILTER_CLAUSES of the filters given, and their parameters
+    clauses = []
+    params = []
+    for name, clause in FILTER_CLAUSES:
+        if filters.get(name) is not None:
+            clauses.append(clause)
+            params.append(filters[name])
+    return clauses, params
+
+
+def row_to_transaction(row):
+    transaction = Transaction(*row)
+    if transaction.date is not None:
+        transaction.date = transaction.date.isoformat()
+    return transaction
+
+
+def transaction_to_row(transaction):
+    return tuple(getattr(transaction, field) for field in TRANSACTION_FIELDS)
+
+
+def insert_batch(cur, transactions):
+    # Inserts the transactions with one multi-row INSERT per 1000 and sets
+    # the ids the database assigned
+    if not transactions:
+        return
+    rows = [transaction_to_row(t)[1:] for t in transactions]
+    ids = execute_values(cur, INSERT_TRANSACTIONS, rows, page_size=1000, fetch=True)
+    for transaction, (transaction_id,) in zip(transactions, ids):
+        transaction.id = transaction_id
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    # Bounded, thread-safe pool. Connections idle longer than
+    # health_check_after are pinged before reuse, and connections beyond
+    # min_size that stay idle for idle_timeout are closed.
+
+    def __init__(self, connect, min_size=1, max_size=10, timeout=30.0, idle_timeout=300.0,
+                 health_check_after=30.0):
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+
+        self._cond = threading.Condition()
+        self._idle = []  # (connection, returned_at), most recently used last
+        self._size = 0
+        self._closed = False
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("Connection pool is closed")
+                self._evict_idle()
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn, returned_at = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout("Timed out waiting for a database connection")
+                self._cond.wait(remaining)
+
+        if conn is not None and time.monotonic() - returned_at >= self.health_check_after:
+            if not self._healthy(conn):
+                # Reconnect in the same slot
+                self._close_quietly(conn)
+                conn = None
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def putconn(self, conn, broken=False):
+        if not broken and conn.closed == 0:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+        if broken or conn.closed != 0:
+            self._discard(conn)
+            return
+        with self._cond:
+            if self._closed:
+                conn.close()
+                self._size -= 1
+                return
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                conn.close()
+            self._size -= len(self._idle)
+            self._idle = []
+            self._cond.notify_all()
+
+    def _healthy(self, conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception:
+            logger.warning("Dropping unhealthy database connection")
+            return False
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _discard(self, conn):
+        self._close_quietly(conn)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _evict_idle(self):
+        # Oldest idle connections sit at the front of the list
+        now = time.monotonic()
+        while len(self._idle) > self.min_size and now - self._idle[0][1] >= self.idle_timeout:
+            conn, _ = self._idle.pop(0)
+            conn.close()
+            self._size -= 1
+
+
+def create_pool(dsn, min_size=1, max_size=10):
+    if psycopg2 is None:
+        raise RuntimeError("The postgres backend requires psycopg2 (pip install psycopg2-binary)")
+    return ConnectionPool(lambda: psycopg2.connect(dsn), min_size=min_size, max_size=max_size)
+
+
+class PostgresRepository(TransactionRepository):
+    # Each ledger shard lives in its own schema. Shards share one connection
+    # pool and select their schema per transaction with SET LOCAL. Every
+    # server process writes the same schemas, so the ledger version lives in
+    # ledger_version, bumped by the totals triggers by the rows each
+    # statement inserted or deleted.
+
+    shared = True
+
+    def __init__(self, pool, schema='public'):
+        self.pool = pool
+        self.schema = schema
+        self._set_path = sql.SQL('SET LOCAL search_path TO {}').format(sql.Identifier(schema))
+        self._execute(self._create_schema)
+
+    def _create_schema(self, cur):
+        cur.execute(sql.SQL('CREATE SCHEMA IF NOT EXISTS {}').format(sql.Identifier(self.schema)))
+        cur.execute(self._set_path)
+        cur.execute(SCHEMA)
+        cur.execute("SELECT 1 FROM pg_trigger WHERE tgname = 'tr_ledger_totals_insert' "
+                    "AND tgrelid = 'transactions'::regclass")
+        if cur.fetchone() is None:
+            cur.execute(CREATE_TOTALS_TRIGGER)
+
+    def _execute(self, work):
+        conn = self.pool.getconn()
+        broken = False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(self._set_path)
+                result = work(cur)
+            conn.commit()
+            return result
+        except psycopg2.Error:
+            broken = conn.closed != 0
+            raise
+        finally:
+            self.pool.putconn(conn, broken=broken)
+
+    def list_transactions(self):
+        def work(cur):
+            cur.execute(SELECT_TRANSACTIONS)
+            return [row_to_transaction(row) for row in cur]
+        return self._execute(work)
+
+    def iter_transactions(self):
+        return self._stream(SELECT_TRANSACTIONS)
+
+    def _select(self, filters, after=None, limit=None):
+        # SQL text and parameters of a filtered query, or of one page of it
+        if limit is not None:
+            filters = dict(filters, date_from=filters.get('date_from') or MIN_DATE)
+        clauses, params = filter_clauses(filters)
+        if not clauses:
+            return None, params
+        if limit is not None:
+            after_date, after_id = after if after is not None else (MIN_DATE, 0)
+            return SELECT_WHERE + ' AND '.join(clauses) + PAGE_AFTER, params + [after_date, after_id, limit]
+        return SELECT_WHERE + ' AND '.join(clauses) + ORDER_BY_DATE, params
+
+    def query_transactions(self, date_from=None, date_to=None, category=None, transaction_type=None,
+                           min_amount=None, max_amount=None, is_recurring=None):
+        query, params = self._select({'date_from': date_from, 'date_to': date_to, 'category': category,
+                                      'transaction_type': transaction_type, 'min_amount': min_amount,
+                                      'max_amount': max_amount, 'is_recurring': is_recurring})
+        if query is None:
+            return self.iter_transactions()
+        return self._stream(query, params)
+
+    def page_transactions(self, after=None, limit=50, **filters):
+        query, params = self._select(filters, after, limit)
+
+        def work(cur):
+            cur.execute(query, params)
+            return [row_to_transaction(row) for row in cur]
+        return self._execute(work)
+
+    def explain_query(self, after=None, limit=None, **filters):
+        # Runs the query under EXPLAIN ANALYZE; rows scanned are the rows
+        # each table or index scan produced plus those its filter removed
+        query, params = self._select(filters, after, limit)
+        if query is None:
+            query, params = SELECT_TRANSACTIONS, []
+
+        def work(cur):
+            cur.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + query, params)
+            return cur.fetchone()[0][0]['Plan']
+        root = self._execute(work)
+        indexes = []
+        scanned = 0
+        nodes = [root]
+        while nodes:
+            node = nodes.pop()
+            nodes.extend(node.get('Plans', ()))
+            if 'Index Name' in node:
+                indexes.append(node['Index Name'])
+            elif node['Node Type'] == 'Seq Scan':
+                indexes.append('scan')
+            if 'Relation Name' in node:
+                scanned += (node['Actual Rows'] + node.get('Rows Removed by Filter', 0)) * node['Actual Loops']
+        return {'index': indexes, 'scanned': scanned, 'returned': root['Actual Rows']}
+
+    def _stream(self, query, params=None):
+        # Named cursors are server-side, so exports pull EXPORT_FETCH_SIZE rows
+        # at a time instead of the whole result set.
+        conn = self.pool.getconn()
+        broken = False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(self._set_path)
+            with conn.cursor(name='export_%s' % uuid.uuid4().hex) as cur:
+                cur.itersize = EXPORT_FETCH_SIZE
+                cur.execute(query, params)
+                for row in cur:
+                    yield row_to_transaction(row)
+        except psycopg2.Error:
+            broken = conn.closed != 0
+            raise
+        finally:
+            self.pool.putconn(conn, broken=broken)
+
+    def add_transaction(self, transaction):
+        return self.add_transactions([transaction])[0]
+
+    def add_transactions(self, transactions):
+        if not transactions:
+            return transactions
+        self._execute(lambda cur: insert_batch(cur, transactions))
+        return transactions
+
+    def add_transactions_with_rules(self, transactions):
+        if not transactions:
+            return transactions
+
+        def work(cur):
+            insert_batch(cur, transactions)
+            cur.executemany(UPSERT_RULE, [transaction_to_row(t) for t in transactions if t.is_recurring])
+        self._execute(work)
+        return transactions
+
+    def get_transaction(self, transaction_id):
+        def work(cur):
+            cur.execute(SELECT_TRANSACTION, (transaction_id,))
+            return cur.fetchone()
+        row = self._execute(work)
+        return row_to_transaction(row) if row is not None else None
+
+    def delete_transaction(self, transaction_id):
+        def work(cur):
+            cur.execute(DELETE_TRANSACTION, (transaction_id,))
+            return cur.fetchone()
+        row = self._execute(work)
+        return row_to_transaction(row) if row is not None else None
+
+    def delete_transactions(self, transaction_ids):
+        # One statement, so the totals trigger runs once for the batch
+        def work(cur):
+            cur.execute(DELETE_TRANSACTIONS, (list(transaction_ids),))
+            return cur.fetchall()
+        return [row_to_transaction(row) for row in self._execute(work)]
+
+    def categories(self):
+        def work(cur):
+            cur.execute(SELECT_CATEGORIES)
+            return [row[0] for row in cur]
+        return self._execute(work)
+
+    def balance(self):
+        # ledger_totals is maintained by a trigger
+        def work(cur):
+            cur.execute(SELECT_TOTALS)
+            return summarize_totals(cur.fetchall())
+        return self._execute(work)
+
+    def summary_cells(self, **filters):
+        clauses, params = filter_clauses(filters)
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+
+        def work(cur):
+            cur.execute(SELECT_SUMMARY + where + GROUP_BY_CELL, params)
+            return [((category, transaction_type, month), [cents, count, low, high])
+                    for category, transaction_type, month, cents, count, low, high in cur]
+        return self._execute(work)
+
+    def ledger_version(self):
+        def work(cur):
+            cur.execute(SELECT_VERSION)
+            return cur.fetchone()
+        return self._execute(work)
+
+    def recurring_rules(self):
+        def work(cur):
+            cur.execute(SELECT_RULES)
+            return [row_to_transaction(row) for row in cur]
+        return self._execute(work)
+
+    def add_rule(self, rule):
+        self._execute(lambda cur: cur.execute(UPSERT_RULE, transaction_to_row(rule)))
+
+    def update_rule(self, rule):
+        self._execute(lambda cur: cur.execute(UPSERT_RULE, transaction_to_row(rule)))
+
+    def remove_rule(self, rule_id):
+        self._execute(lambda cur: cur.execute(DELETE_RULE, (rule_id,)))
+
+    def advance_rules(self, due):
+        # FOR UPDATE holds the rule rows until commit, so a worker in
+        # another process waits for this one and then reads the rules moved
+        # on. A rule's occurrences are only inserted if its conditional
+        # UPDATE matched.
+        def work(cur):
+            cur.execute(SELECT_RULES_FOR_UPDATE)
+            occurrences = []
+            for rule in [row_to_transaction(row) for row in cur.fetchall()]:
+                due_now, last_date = due(rule)
+                if due_now:
+                    cur.execute(ADVANCE_RULE, (last_date, rule.id, rule.date))
+                    if cur.rowcount == 1:
+                        occurrences.extend(due_now)
+            insert_batch(cur, occurrences)
+            return occurrences
+        return self._execute(work)
+
+    def remove_rules(self, rule_ids):
+        self._execute(lambda cur: cur.execute(DELETE_RULES, (list(rule_ids),)))
+
+
+def start_local_server(directory, port=5433):
+    # Starts (and on first use initialises) a private postgres cluster using
+    # the initdb/pg_ctl binaries on PATH, and returns a DSN for it.
+    for binary in ('initdb', 'pg_ctl'):
+        if shutil.which(binary) is None:
+            raise RuntimeError("%s not found on PATH; set DATABASE_URL instead" % binary)
+    directory = os.path.abspath(directory)
+    if not os.path.exists(os.path.join(directory, 'PG_VERSION')):
+        os.makedirs(directory, exist_ok=True)
+        subprocess.run(['initdb', '-D', directory, '-U', 'postgres', '--auth=trust'],
+                       check=True, stdout=subprocess.DEVNULL)
+    status = subprocess.run(['pg_ctl', '-D', directory, 'status'], stdout=subprocess.DEVNULL)
+    if status.returncode != 0:
+        subprocess.run(['pg_ctl', '-D', directory, '-l', os.path.join(directory, 'server.log'), '-w',
+                        '-o', '-p %d -k %s -c listen_addresses=' % (port, directory), 'start'],
+                       check=True, stdout=subprocess.DEVNULL)
+    return 'host=%s port=%d user=postgres dbname=postgres' % (directory, port)
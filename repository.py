@@ -0,0 +1,703 @@
+import os
+import secrets
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice
+
+from aggregates import LedgerRollup, LedgerTotals, covers_months, month_bounds, summarize_groups, summarize_totals
+from columnar import ColumnarStore, to_cents, to_ordinal
+from indexes import DateIndex, PostingIndex, SortedIndex
+from locks import ReadWriteLock
+from models import FRAGMENT_CACHE_SIZE, FragmentCache, Transaction
+from planner import QueryPlan, amount_bounds
+from state_file import read_state, write_state
+from storage import LedgerLog, STATE_FILE, batch_entry, batch_transactions
+
+
+def _category_postings(store):
+    # (category, date ordinal, id) for every live row of a ColumnarStore
+    values = store.category_table.values
+    return ((values[store.categories[row]], store.dates[row], store.ids[row]) for row in store.rows())
+
+
+def transaction_filter(date_from=None, date_to=None, category=None, transaction_type=None, min_amount=None,
+                       max_amount=None, is_recurring=None):
+    # Predicate over Transactions for the query_transactions filters, or None
+    # when there is nothing to filter on
+    tests = []
+    if date_from is not None:
+        tests.append(lambda t: t.date >= date_from)
+    if date_to is not None:
+        tests.append(lambda t: t.date <= date_to)
+    if category is not None:
+        tests.append(lambda t: t.category == category)
+    if transaction_type is not None:
+        tests.append(lambda t: t.type == transaction_type)
+    if min_amount is not None or max_amount is not None:
+        low, high = amount_bounds(min_amount, max_amount)
+        tests.append(lambda t: (low is None or to_cents(t.amount) >= low)
+                     and (high is None or to_cents(t.amount) <= high))
+    if is_recurring is not None:
+        tests.append(lambda t: bool(t.is_recurring) == is_recurring)
+    if not tests:
+        return None
+    return lambda t: all(test(t) for test in tests)
+
+
+class TransactionRepository:
+    # Storage interface used by the routes in main.py. Transactions and
+    # recurring rules are models.Transaction records.
+    #
+    # shared backends may be written by other server processes too; they
+    # keep the ledger version in storage, see ledger_version.
+
+    shared = False
+
+    def list_transactions(self):
+        raise NotImplementedError
+
+    def iter_transactions(self):
+        return iter(self.list_transactions())
+
+    def get_transaction(self, transaction_id):
+        for transaction in self.iter_transactions():
+            if transaction.id == transaction_id:
+                return transaction
+        return None
+
+    def query_transactions(self, date_from=None, date_to=None, category=None, transaction_type=None,
+                           min_amount=None, max_amount=None, is_recurring=None):
+        # Transactions dated within [date_from, date_to] (inclusive ISO dates,
+        # either end open), with an amount within [min_amount, max_amount],
+        # and matching category, type and is_recurring where given, ordered
+        # by (date, id). Without any filter this is iter_transactions().
+        matches = transaction_filter(date_from, date_to, category, transaction_type, min_amount, max_amount,
+                                     is_recurring)
+        if matches is None:
+            return self.iter_transactions()
+        return iter(sorted(filter(matches, self.iter_transactions()), key=lambda t: (t.date, t.id)))
+
+    def page_transactions(self, after=None, limit=50, date_from=None, **filters):
+        # Up to `limit` transactions of query_transactions, always ordered by
+        # (date, id), that come after the keyset position `after`: the
+        # (date, id) pair of the last transaction of the previous page.
+        # When query_transactions is lazy, skipping to `after` costs a seek
+        # plus the rows of its day that were already returned.
+        date_from = date_from or '0001-01-01'
+        if after is None:
+            rows = self.query_transactions(date_from, **filters)
+        else:
+            rows = (t for t in self.query_transactions(max(date_from, after[0]), **filters)
+                    if (t.date, t.id) > after)
+        return list(islice(rows, limit))
+
+    def explain_query(self, after=None, limit=None, **filters):
+        # Runs the query, or one page of it, and reports how it was answered:
+        # the index used, the filters checked per row, and how many rows were
+        # scanned and returned. This generic version scans everything.
+        if limit is not None:
+            returned = len(self.page_transactions(after, limit, **filters))
+        else:
+            returned = sum(1 for _ in self.query_transactions(**filters))
+        return {
+            'index': None,
+            'filters': [name for name, value in filters.items() if value is not None],
+            'scanned': sum(1 for _ in self.iter_transactions()),
+            'returned': returned,
+        }
+
+    def add_transaction(self, transaction):
+        # Assigns the id and returns the stored transaction. Raises ValueError
+        # for values the backend cannot store.
+        raise NotImplementedError
+
+    def add_transactions(self, transactions):
+        return [self.add_transaction(transaction) for transaction in transactions]
+
+    def add_transactions_with_rules(self, transactions):
+        # add_transactions, plus a recurring rule for every recurring
+        # transaction. Shared backends store both in one transaction, so no
+        # recurring row is ever left without its rule.
+        stored = self.add_transactions(transactions)
+        for transaction in stored:
+            if transaction.is_recurring:
+                self.add_rule(transaction)
+        return stored
+
+    def delete_transaction(self, transaction_id):
+        # Returns the deleted transaction, or None if it does not exist
+        raise NotImplementedError
+
+    def delete_transactions(self, transaction_ids):
+        # Returns the transactions deleted; ids that do not exist are skipped
+        deleted = (self.delete_transaction(transaction_id) for transaction_id in transaction_ids)
+        return [transaction for transaction in deleted if transaction is not None]
+
+    def categories(self):
+        return list({t.category for t in self.iter_transactions()})
+
+    def balance(self):
+        # Income, expense and net totals, overall and per type and category
+        totals = {}
+        for t in self.iter_transactions():
+            cell = totals.setdefault((t.category, t.type), [0.0, 0])
+            cell[0] += t.amount
+            cell[1] += 1
+        return summarize_totals((category, transaction_type, total, count)
+                                for (category, transaction_type), (total, count) in totals.items())
+
+    def summary_cells(self, **filters):
+        # ((category, type, month), [cents, count, min, max]) rollup cells
+        # of the transactions matching the filters, in one pass over them
+        return LedgerRollup(self.query_transactions(**filters)).cells.items()
+
+    def rollup(self):
+        # LedgerRollup of the whole ledger, which Shard.summary then keeps
+        # up to date itself
+        return LedgerRollup(self.iter_transactions())
+
+    def ledger_version(self):
+        # (epoch, version) held in storage by shared backends, where version
+        # counts every row ever inserted or deleted; None for the others
+        return None
+
+    def recurring_rules(self):
+        raise NotImplementedError
+
+    def add_rule(self, rule):
+        raise NotImplementedError
+
+    def update_rule(self, rule):
+        raise NotImplementedError
+
+    def remove_rule(self, rule_id):
+        raise NotImplementedError
+
+    def remove_rules(self, rule_ids):
+        for rule_id in rule_ids:
+            self.remove_rule(rule_id)
+
+    def advance_rules(self, due):
+        # Inserts the occurrences every recurring rule has due, as one batch,
+        # and moves each rule on to its last occurrence. due(rule) returns
+        # (occurrences, date of the last one). Returns the inserted
+        # transactions. Shared backends do it all in one transaction that
+        # locks the rules, so two processes never insert the same occurrence.
+        occurrences = []
+        advanced = []
+        for rule in self.recurring_rules():
+            due_now, last_date = due(rule)
+            if due_now:
+                occurrences.extend(due_now)
+                rule.date = last_date
+                advanced.append(rule)
+        occurrences = self.add_transactions(occurrences)
+        for rule in advanced:
+            self.update_rule(rule)
+        return occurrences
+
+    def write_position(self):
+        # How far the writes made so far reach, for wait_durable; None for
+        # backends whose writes are durable when they return
+        return None
+
+    def wait_durable(self, position):
+        # Returns once the writes up to position are on disk
+        pass
+
+    def snapshot(self, path=None):
+        # Persists the full ledger state, in place or as a copy at path
+        raise NotImplementedError
+
+    def restore(self, path):
+        # Replaces the whole ledger with a copy written by snapshot(path)
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryRepository(TransactionRepository):
+    # In-memory ledger made durable by an append-only log with snapshots.
+    # Transactions are held column-wise in a ColumnarStore and materialised
+    # as Transaction records on read. A DateIndex answers date range queries
+    # in O(log n + k), a PostingIndex over categories answers category
+    # lookups and /api/categories without scanning, an amount index serves
+    # amount ranges, and LedgerTotals keeps the balance up to date on every
+    # insert and delete. Filtered queries go through a QueryPlan (see
+    # planner), which picks the most selective of the three indexes.
+    #
+    # Compaction dumps all of that to a binary state file (see state_file),
+    # so a restart restores the arrays as they were instead of rebuilding
+    # them, then replays only the log written since.
+
+    def __init__(self, directory):
+        self._lock = threading.RLock()
+        self.log = LedgerLog(directory, self._state, self._lock, dump_fn=write_state)
+        state_path = os.path.join(directory, STATE_FILE)
+        if os.path.exists(state_path):
+            state = read_state(state_path)
+            self._restore(state)
+            for entry in self.log.open_entries(state['seq']):
+                self._apply(entry['op'], entry['data'])
+        else:
+            # A ledger not compacted yet: all of it is in the log
+            transactions, rules, self._next_id = self.log.open()
+            self._load(sorted(map(Transaction.from_dict, transactions), key=lambda t: t.id))
+            self._rules = {r['id']: Transaction.from_dict(r) for r in rules}
+
+    def _load(self, transactions):
+        self._store = ColumnarStore()
+        for transaction in transactions:
+            self._store.append(transaction)
+        store = self._store
+        self._dates = DateIndex((store.dates[row], store.ids[row]) for row in store.rows())
+        self._categories = PostingIndex(_category_postings(store))
+        self._amounts = SortedIndex((store.amounts[row], store.ids[row]) for row in store.rows())
+        self._totals = LedgerTotals()
+        for row in store.rows():
+            self._totals.add(store.category_table.values[store.categories[row]],
+                             store.type_table.values[store.types[row]], store.amounts[row])
+
+    def _state(self):
+        # Copies of everything write_state needs, taken under self._lock
+        store = self._store
+        return {
+            'next_id': self._next_id,
+            'columns': [column[:] for column in store.columns()],
+            'alive': bytes(store.alive),
+            'tombstones': store.tombstones,
+            'tables': [list(table.values) for table in store.tables()],
+            'dates': (self._dates.ordinals[:], self._dates.ids[:]),
+            'postings': [(key, index.ordinals[:], index.ids[:])
+                         for key, index in self._categories.postings.items()],
+            'amounts': (self._amounts.keys[:], self._amounts.ids[:]),
+            'totals': [[category, transaction_type, cents, count]
+                       for (category, transaction_type), (cents, count) in self._totals.cells.items()],
+            'rules': [r.to_dict() for r in self._rules.values()],
+        }
+
+    def _restore(self, state):
+        self._store = ColumnarStore.from_columns(state['columns'], state['alive'], state['tables'],
+                                                 state['tombstones'])
+        self._dates = DateIndex.from_arrays(*state['dates'])
+        self._categories = PostingIndex.from_postings(state['postings'])
+        self._amounts = SortedIndex.from_arrays(*state['amounts'])
+        self._totals = LedgerTotals()
+        for category, transaction_type, cents, count in state['totals']:
+            self._totals.add(category, transaction_type, cents, count)
+        self._rules = {r['id']: Transaction.from_dict(r) for r in state['rules']}
+        self._next_id = state['next_id']
+
+    def _apply(self, op, data):
+        # Replays one log entry written after the restored state
+        if op == 'add':
+            if data['id'] >= self._next_id:
+                self._insert(Transaction.from_dict(data))
+                self._next_id = data['id'] + 1
+        elif op == 'add_many':
+            batch = [Transaction.from_dict(t) for t in batch_transactions(data) if t['id'] >= self._next_id]
+            if batch:
+                self._insert_many(batch)
+                self._next_id = batch[-1].id + 1
+        elif op == 'delete':
+            self._remove(data['id'])
+        elif op == 'delete_many':
+            self._remove_many(data['ids'])
+        elif op == 'rule':
+            self._rules[data['id']] = Transaction.from_dict(data)
+        elif op == 'unrule':
+            self._rules.pop(data['id'], None)
+        else:
+            raise ValueError("Unknown ledger log operation: %s" % op)
+
+    def snapshot(self, path=None):
+        # Writes the state file now: in place, which also truncates the log,
+        # or as a standalone copy at path
+        if path is None:
+            self.log.compact()
+            return
+        with self._lock:
+            seq = self.log.seq
+            state = self._state()
+        write_state(path, seq, state)
+
+    def restore(self, path):
+        state = read_state(path)
+        with self._lock:
+            self.log.reset(path, state['seq'])
+            self._restore(state)
+
+    def list_transactions(self):
+        return list(self.iter_transactions())
+
+    def iter_transactions(self):
+        store = self._store
+        return (store.row(row) for row in store.rows())
+
+    def get_transaction(self, transaction_id):
+        return self._store.get(transaction_id)
+
+    def _plan(self, filters, limit=None):
+        return QueryPlan(self._store, self._dates, self._categories, self._amounts, limit=limit, **filters)
+
+    def query_transactions(self, date_from=None, date_to=None, category=None, transaction_type=None,
+                           min_amount=None, max_amount=None, is_recurring=None):
+        filters = {'date_from': date_from, 'date_to': date_to, 'category': category,
+                   'transaction_type': transaction_type, 'min_amount': min_amount, 'max_amount': max_amount,
+                   'is_recurring': is_recurring}
+        if all(value is None for value in filters.values()):
+            return self.iter_transactions()
+        return self._plan(filters).transactions()
+
+    def page_transactions(self, after=None, limit=50, **filters):
+        # Date-ordered plans seek straight to `after`, so a page costs the
+        # bisects plus the candidates scanned to fill it
+        key = (to_ordinal(after[0]), after[1]) if after is not None else None
+        return list(islice(self._plan(filters, limit).transactions(key), limit))
+
+    def explain_query(self, after=None, limit=None, **filters):
+        plan = self._plan(filters, limit)
+        key = (to_ordinal(after[0]), after[1]) if after is not None else None
+        returned = sum(1 for _ in islice(plan.rows(key), limit))
+        return dict(plan.explain(), returned=returned)
+
+    def categories(self):
+        return self._categories.keys()
+
+    def balance(self):
+        return summarize_totals(self._totals.rows())
+
+    def add_transaction(self, transaction):
+        with self._lock:
+            transaction.id = self._next_id
+            stored = self._insert(transaction)
+            self._next_id += 1
+            self.log.append('add', stored.to_dict())
+        return stored
+
+    def add_transactions(self, transactions):
+        # One contiguous id block, one merge into each index and one log
+        # entry for the whole batch, so replay applies it all or nothing
+        with self._lock:
+            for offset, transaction in enumerate(transactions):
+                transaction.id = self._next_id + offset
+            stored = self._insert_many(transactions)
+            self._next_id += len(transactions)
+            if stored:
+                self.log.append('add_many', batch_entry(stored))
+        return stored
+
+    def _insert(self, transaction):
+        row = self._store.append(transaction)
+        self._dates.add(self._store.dates[row], transaction.id)
+        self._categories.add(transaction.category, self._store.dates[row], transaction.id)
+        self._amounts.add(self._store.amounts[row], transaction.id)
+        self._totals.add(transaction.category, transaction.type, self._store.amounts[row])
+        return self._store.row(row)
+
+    def _insert_many(self, transactions):
+        # Returns the transactions themselves, amounts rounded to the stored
+        # cents, rather than decoding every row back out of the store
+        store = self._store
+        rows = store.extend(transactions)
+        ids, dates, amounts = store.ids[rows.start:], store.dates[rows.start:], store.amounts[rows.start:]
+        self._dates.add_many(zip(dates, ids))
+        self._categories.add_many(zip((t.category for t in transactions), dates, ids))
+        self._amounts.add_many(zip(amounts, ids))
+        for transaction, cents in zip(transactions, amounts):
+            self._totals.add(transaction.category, transaction.type, cents)
+            if transaction.amount != cents / 100:
+                transaction.amount = cents / 100
+        return transactions
+
+    def delete_transaction(self, transaction_id):
+        with self._lock:
+            deleted_transaction = self._remove(transaction_id)
+            if deleted_transaction is not None:
+                self.log.append('delete', {'id': transaction_id})
+        return deleted_transaction
+
+    def _remove(self, transaction_id):
+        deleted_transaction = self._store.delete(transaction_id)
+        if deleted_transaction is not None:
+            self._dates.remove(to_ordinal(deleted_transaction.date), transaction_id)
+            self._categories.remove(deleted_transaction.category, to_ordinal(deleted_transaction.date),
+                                    transaction_id)
+            self._amounts.remove(to_cents(deleted_transaction.amount), transaction_id)
+            self._totals.remove(deleted_transaction.category, deleted_transaction.type,
+                                to_cents(deleted_transaction.amount))
+        return deleted_transaction
+
+    def delete_transactions(self, transaction_ids):
+        # One pass over each index and one log entry for the whole batch
+        with self._lock:
+            deleted = self._remove_many(transaction_ids)
+            if deleted:
+                self.log.append('delete_many', {'ids': [t.id for t in deleted]})
+        return deleted
+
+    def _remove_many(self, transaction_ids):
+        deleted = self._store.delete_many(transaction_ids)
+        keys = [(to_ordinal(t.date), to_cents(t.amount), t) for t in deleted]
+        self._dates.remove_many((ordinal, t.id) for ordinal, _, t in keys)
+        self._categories.remove_many((t.category, ordinal, t.id) for ordinal, _, t in keys)
+        self._amounts.remove_many((cents, t.id) for _, cents, t in keys)
+        for _, cents, t in keys:
+            self._totals.remove(t.category, t.type, cents)
+        return deleted
+
+    def recurring_rules(self):
+        return list(self._rules.values())
+
+    def add_rule(self, rule):
+        rule = rule.copy()
+        with self._lock:
+            self._rules[rule.id] = rule
+            self.log.append('rule', rule.to_dict())
+
+    def update_rule(self, rule):
+        with self._lock:
+            self._rules[rule.id] = rule
+            self.log.append('rule', rule.to_dict())
+
+    def remove_rule(self, rule_id):
+        with self._lock:
+            if self._rules.pop(rule_id, None) is not None:
+                self.log.append('unrule', {'id': rule_id})
+
+    def write_position(self):
+        return self.log.seq
+
+    def wait_durable(self, position):
+        self.log.wait_synced(position)
+
+    def close(self):
+        # Snapshot on shutdown so the next start has no log to replay
+        if self.log.seq > self.log.snapshot_seq:
+            self.snapshot()
+        self.log.close()
+
+
+# Rows of inserts and deletes each shard keeps for /api/changes; clients
+# further behind than that resync from a full listing
+CHANGE_LOG_SIZE = 10000
+
+
+class Shard:
+    # One user's ledger: a repository holding its store, indexes, totals and
+    # recurring rules, plus a reader/writer lock. Reads of a shard run in
+    # parallel, writes to it are serialised, and users never share a shard,
+    # so they never wait on each other's locks.
+    #
+    # version is bumped with each mutation under the write lock. Together
+    # with the epoch it names one state of the ledger, so versions from
+    # before a restart never match. Routes use it for ETags. The change log
+    # keeps what each recent version inserted and deleted, so a client can
+    # catch up from its version without refetching the ledger.
+    #
+    # On its own, version counts the mutations made through this process
+    # and the epoch is drawn when the shard opens. A shared repository keeps
+    # both in storage instead, and sync() picks up the writes of other
+    # processes; the log cannot describe those, so it restarts from there.
+    # fragments is its part of the process-wide cache of transaction JSON
+    # the routes encode from, and the rollup, built on the first summary,
+    # keeps per-month aggregates.
+
+    def __init__(self, repository, fragments=None):
+        self.repository = repository
+        self.lock = ReadWriteLock()
+        self.epoch = secrets.token_hex(8)
+        self.version = 0
+        self._changes = deque()
+        self._logged = 0
+        self.fragments = fragments if fragments is not None else FragmentCache().ledger()
+        self._rollup = None
+        if repository.shared:
+            self.epoch, self.version = repository.ledger_version()
+
+    @contextmanager
+    def write(self):
+        # The write lock, then, once it is released, a wait until what was
+        # written under it is durable. Waiting outside the lock lets the
+        # shard's next writers share the same fsync.
+        with self.lock.write():
+            yield
+            position = self.repository.write_position()
+        self.repository.wait_durable(position)
+
+    def sync(self):
+        # Catches up with the stored version of a shared repository. Run
+        # without holding the lock: a restart takes the write lock, so no
+        # write of this process is halfway through and no reader sees the
+        # change log, epoch and version of two different states.
+        if not self.repository.shared:
+            return
+        if self.repository.ledger_version()[1] <= self.version:
+            return
+        with self.lock.write():
+            epoch, version = self.repository.ledger_version()
+            if version > self.version:
+                self._restart(epoch, version)
+
+    def _restart(self, epoch, version):
+        # Other processes wrote since this one last looked: nothing this
+        # process derived from the ledger is known to be current. Run under
+        # the write lock.
+        self._changes.clear()
+        self._logged = 0
+        self.fragments.clear()
+        self._rollup = None
+        self.epoch, self.version = epoch, version
+
+    def bump(self, inserted=(), deleted=()):
+        # Records a mutation: the transactions it inserted and deleted
+        deleted_ids = tuple(transaction.id for transaction in deleted)
+        if self.repository.shared:
+            epoch, version = self.repository.ledger_version()
+            if version != self.version + len(inserted) + len(deleted_ids):
+                self._restart(epoch, version)
+                return
+            self.version = version
+        else:
+            self.version += 1
+        self.fragments.discard(deleted_ids)
+        if self._rollup is not None:
+            for transaction in inserted:
+                self._rollup.add(transaction)
+            for transaction in deleted:
+                self._rollup.remove(transaction)
+        self._changes.append((self.version, tuple(inserted), deleted_ids))
+        self._logged += len(self._changes[-1][1]) + len(self._changes[-1][2])
+        while self._logged > CHANGE_LOG_SIZE:
+            _, evicted_inserts, evicted_deletes = self._changes.popleft()
+            self._logged -= len(evicted_inserts) + len(evicted_deletes)
+
+    def reset(self):
+        # For changes the log cannot describe, like a restore: every client
+        # behind the new version has to resync
+        self._changes.clear()
+        self._logged = 0
+        self.fragments.clear()
+        self._rollup = None
+        self.version += 1
+
+    def changes_since(self, version):
+        # (inserted transactions, deleted ids) that take a client from
+        # `version` to the current one, or None when the log no longer
+        # reaches back that far. A row inserted and deleted within the
+        # window is left out of both.
+        oldest = self._changes[0][0] - 1 if self._changes else self.version
+        if not oldest <= version <= self.version:
+            return None
+        inserted = {}
+        deleted = []
+        for change_version, change_inserts, change_deletes in self._changes:
+            if change_version <= version:
+                continue
+            for transaction in change_inserts:
+                inserted[transaction.id] = transaction
+            for transaction_id in change_deletes:
+                if inserted.pop(transaction_id, None) is None:
+                    deleted.append(transaction_id)
+        return list(inserted.values()), deleted
+
+    def summary(self, group_by=(), **filters):
+        # Sums, counts, averages and bounds of the amounts matching the
+        # filters, per group_by group. Category, type and whole-month date
+        # filters are answered from the rollup, touching only the rows of
+        # cells whose bounds a delete left unknown; any other filter is a
+        # single-pass hash aggregation over the matching rows. A shared
+        # repository aggregates in the database instead, as no rollup here
+        # would see the writes of other processes. Run under the read lock;
+        # concurrent readers only ever write the same values.
+        if self.repository.shared:
+            return dict(summarize_groups(self.repository.summary_cells(**filters), group_by), source='database')
+        if any(filters.get(name) is not None for name in ('min_amount', 'max_amount', 'is_recurring')) \
+                or not covers_months(filters.get('date_from'), filters.get('date_to')):
+            return dict(summarize_groups(self.repository.summary_cells(**filters), group_by), source='scan')
+        if self._rollup is None:
+            self._rollup = self.repository.rollup()
+        first = filters['date_from'][:7] if filters.get('date_from') else None
+        last = filters['date_to'][:7] if filters.get('date_to') else None
+        cells = [(key, cell) for key, cell in self._rollup.cells.items()
+                 if (filters.get('category') is None or key[0] == filters['category'])
+                 and (filters.get('transaction_type') is None or key[1] == filters['transaction_type'])
+                 and (first is None or key[2] >= first) and (last is None or key[2] <= last)]
+        for position, (key, cell) in enumerate(cells):
+            if cell[2] is None:
+                category, transaction_type, month = key
+                date_from, date_to = month_bounds(month)
+                amounts = [to_cents(transaction.amount) for transaction in self.repository.query_transactions(
+                    date_from=date_from, date_to=date_to, category=category, transaction_type=transaction_type)
+                    if transaction.category == category]
+                # Replaced whole, so another reader never sees half the bounds
+                cell = self._rollup.cells[key] = [cell[0], cell[1], min(amounts), max(amounts)]
+                cells[position] = (key, cell)
+        return dict(summarize_groups(cells, group_by), source='rollup')
+
+    @property
+    def etag(self):
+        return '%s-%d' % (self.epoch, self.version)
+
+
+class ShardRegistry:
+    # Opens shards lazily on first use and keeps them for the life of the
+    # process. The registry lock only guards the shard map. The shards share
+    # one FragmentCache, so its byte budget holds however many users there are.
+
+    def __init__(self, open_repository, on_close=None, fragment_cache_size=FRAGMENT_CACHE_SIZE):
+        self._open_repository = open_repository
+        self._on_close = on_close
+        self.fragments = FragmentCache(fragment_cache_size)
+        self._shards = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        shard = self._shards.get(key)
+        if shard is None:
+            with self._lock:
+                shard = self._shards.get(key)
+                if shard is None:
+                    shard = self._shards[key] = Shard(self._open_repository(key), self.fragments.ledger())
+        return shard
+
+    def close(self):
+        with self._lock:
+            for shard in self._shards.values():
+                shard.repository.close()
+            self._shards = {}
+        if self._on_close is not None:
+            self._on_close()
+
+
+def create_shard_registry():
+    # Storage backend is selected with LEDGER_BACKEND (memory, mapped,
+    # partitioned, sqlite or postgres); every user gets a separate ledger
+    # within it. LEDGER_FRAGMENT_CACHE_MB sizes the cache of transaction
+    # JSON all of them share.
+    backend = os.environ.get('LEDGER_BACKEND', 'memory')
+    data_dir = os.environ.get('LEDGER_DATA_DIR', 'data')
+    users_dir = os.path.join(data_dir, 'users')
+    fragment_cache_mb = os.environ.get('LEDGER_FRAGMENT_CACHE_MB')
+    cache_size = int(fragment_cache_mb) * 1024 * 1024 if fragment_cache_mb else FRAGMENT_CACHE_SIZE
+    registry = partial(ShardRegistry, fragment_cache_size=cache_size)
+    if backend == 'memory':
+        return registry(lambda key: MemoryRepository(os.path.join(users_dir, key)))
+    if backend == 'mapped':
+        from mapped_repository import MappedRepository
+        return registry(lambda key: MappedRepository(os.path.join(users_dir, key + '.mapped')))
+    if backend == 'partitioned':
+        from partitioned_repository import PartitionedRepository
+        return registry(lambda key: PartitionedRepository(os.path.join(users_dir, key + '.partitioned')))
+    if backend == 'sqlite':
+        from sqlite_repository import SQLiteRepository
+        return registry(lambda key: SQLiteRepository(os.path.join(users_dir, key + '.db')))
+    if backend == 'postgres':
+        from postgres_repository import PostgresRepository, create_pool, start_local_server
+        dsn = os.environ.get('DATABASE_URL') or start_local_server(os.path.join(data_dir, 'postgres'))
+        pool = create_pool(dsn, max_size=int(os.environ.get('DATABASE_POOL_SIZE', 10)))
+        return registry(lambda key: PostgresRepository(pool, 'ledger_' + key), on_close=pool.close)
+    raise ValueError("Unknown LEDGER_BACKEND: %s" % backend)
@@ -0,0 +1,368 @@
+import json
+import os
+import sqlite3
+import threading
+
+from aggregates import summarize_totals
+from models import Transaction, TRANSACTION_FIELDS
+from repository import TransactionRepository
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    amount REAL,
+    description TEXT,
+    type TEXT,
+    category TEXT,
+    date TEXT,
+    is_recurring INTEGER NOT NULL DEFAULT 0,
+    recurrence_interval TEXT
+);
+CREATE TABLE IF NOT EXISTS recurring_rules (
+    id INTEGER PRIMARY KEY,
+    amount REAL,
+    description TEXT,
+    type TEXT,
+    category TEXT,
+    date TEXT,
+    is_recurring INTEGER NOT NULL DEFAULT 1,
+    recurrence_interval TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_transactions_date ON transactions (date);
+CREATE INDEX IF NOT EXISTS ix_transactions_category_date ON transactions (category, date);
+CREATE INDEX IF NOT EXISTS ix_transactions_type_date ON transactions (type, date);
+CREATE INDEX IF NOT EXISTS ix_transactions_amount ON transactions (amount);
+CREATE TABLE IF NOT EXISTS ledger_totals (
+    category TEXT,
+    type TEXT,
+    total REAL NOT NULL DEFAULT 0,
+    count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_ledger_totals ON ledger_totals (category, type);
+CREATE TRIGGER IF NOT EXISTS tr_ledger_totals_insert AFTER INSERT ON transactions BEGIN
+    INSERT INTO ledger_totals (category, type)
+        SELECT NEW.category, NEW.type
+        WHERE NOT EXISTS (SELECT 1 FROM ledger_totals WHERE category IS NEW.category AND type IS NEW.type);
+    UPDATE ledger_totals SET total = total + NEW.amount, count = count + 1
+        WHERE category IS NEW.category AND type IS NEW.type;
+END;
+CREATE TRIGGER IF NOT EXISTS tr_ledger_totals_delete AFTER DELETE ON transactions BEGIN
+    UPDATE ledger_totals SET total = total - OLD.amount, count = count - 1
+        WHERE category IS OLD.category AND type IS OLD.type;
+    DELETE FROM ledger_totals WHERE count <= 0;
+END;
+CREATE TABLE IF NOT EXISTS ledger_version (
+    epoch TEXT NOT NULL,
+    version INTEGER NOT NULL
+);
+INSERT INTO ledger_version (epoch, version)
+    SELECT lower(hex(randomblob(8))), 0 WHERE NOT EXISTS (SELECT 1 FROM ledger_version);
+CREATE TRIGGER IF NOT EXISTS tr_ledger_version_insert AFTER INSERT ON transactions BEGIN
+    UPDATE ledger_version SET version = version + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS tr_ledger_version_delete AFTER DELETE ON transactions BEGIN
+    UPDATE ledger_version SET version = version + 1;
+END;
+'''
+
+HAS_TOTALS = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ledger_totals'"
+# Run once when ledger_totals is first created on an existing database
+REBUILD_TOTALS = '''
+DELETE FROM ledger_totals;
+INSERT INTO ledger_totals (category, type, total, count)
+    SELECT category, type, SUM(amount), COUNT(*) FROM transactions GROUP BY category, type;
+'''
+
+COLUMNS = ', '.join(TRANSACTION_FIELDS)
+PLACEHOLDERS = ', '.join('?' * len(TRANSACTION_FIELDS))
+
+SELECT_TRANSACTIONS = 'SELECT %s FROM transactions ORDER BY id' % COLUMNS
+INSERT_TRANSACTION = 'INSERT INTO transactions (%s) VALUES (%s)' % (COLUMNS, PLACEHOLDERS)
+# Filtered queries are assembled from these clauses in this fixed order, so
+# each combination of filters is always the same SQL text and reuses one
+# prepared statement. SQLite's planner picks among ix_transactions_date,
+# ix_transactions_category_date and ix_transactions_amount.
+FILTER_CLAUSES = (
+    ('date_from', 'date >= ?'),
+    ('date_to', 'date <= ?'),
+    ('category', 'category = ?'),
+    ('transaction_type', 'type = ?'),
+    ('min_amount', 'amount >= ?'),
+    ('max_amount', 'amount <= ?'),
+    ('is_recurring', 'is_recurring = ?'),
+)
+SELECT_WHERE = 'SELECT %s FROM transactions WHERE ' % COLUMNS
+ORDER_BY_DATE = ' ORDER BY date, id'
+# Keyset pages walk the date indexes, which end in the rowid, so the page
+# is read in (date, id) order without a sort
+PAGE_AFTER = ' AND (date, id) > (?, ?) ORDER BY date, id LIMIT ?'
+MIN_DATE = '0000-00-00'
+SELECT_TRANSACTION = 'SELECT %s FROM transactions WHERE id = ?' % COLUMNS
+DELETE_TRANSACTION = 'DELETE FROM transactions WHERE id = ?'
+# Batches bind their ids as one JSON array, so any number fits one statement
+SELECT_TRANSACTION_BATCH = 'SELECT %s FROM transactions WHERE id IN (SELECT value FROM json_each(?))' % COLUMNS
+DELETE_TRANSACTION_BATCH = 'DELETE FROM transactions WHERE id IN (SELECT value FROM json_each(?))'
+# Answered from ix_transactions_category_date without touching the table
+SELECT_CATEGORIES = 'SELECT DISTINCT category FROM transactions'
+SELECT_TOTALS = 'SELECT category, type, total, count FROM ledger_totals'
+# Rollup cells of the matching rows, ((category, type, month), [cents,
+# count, min, max]), aggregated in the database
+CENTS = 'CAST(ROUND(amount * 100) AS INTEGER)'
+SELECT_SUMMARY = ('SELECT category, type, substr(date, 1, 7) AS month, SUM(%s), COUNT(*), MIN(%s), MAX(%s) '
+                  'FROM transactions' % (CENTS, CENTS, CENTS))
+GROUP_BY_CELL = ' GROUP BY category, type, month'
+SELECT_VERSION = 'SELECT epoch, version FROM ledger_version'
+SELECT_RULES = 'SELECT %s FROM recurring_rules ORDER BY id' % COLUMNS
+UPSERT_RULE = 'INSERT OR REPLACE INTO recurring_rules (%s) VALUES (%s)' % (COLUMNS, PLACEHOLDERS)
+# Moves a rule on only if no other process has moved it since it was read
+ADVANCE_RULE = 'UPDATE recurring_rules SET date = ? WHERE id = ? AND date = ?'
+DELETE_RULE = 'DELETE FROM recurring_rules WHERE id = ?'
+DELETE_RULE_BATCH = 'DELETE FROM recurring_rules WHERE id IN (SELECT value FROM json_each(?))'
+
+
+def filter_clauses(filters):
+    # The FILTER_CLAUSES of the filters given, and their parameters
+    clauses = []
+    params = []
+    for name, clause in FILTER_CLAUSES:
+        if filters.get(name) is not None:
+            clauses.append(clause)
+            params.append(filters[name])
+    return clauses, params
+
+
+def row_to_transaction(row):
+    transaction = Transaction(*row)
+    transaction.is_recurring = bool(transaction.is_recurring)
+    return transaction
+
+
+def transaction_to_row(transaction):
+    return tuple(getattr(transaction, field) for field in TRANSACTION_FIELDS)
+
+
+class SQLiteRepository(TransactionRepository):
+    # Several processes may open the same database file, so the ledger
+    # version lives in it: ledger_version counts every row ever inserted or
+    # deleted, bumped by triggers in the writing transaction.
+    #
+    # AUTOINCREMENT keeps ids monotonic: SQLite would otherwise reuse the id
+    # of a deleted max row.
+    #
+    # One connection per thread; sqlite3 keeps a per-connection cache of
+    # prepared statements keyed by SQL text, so every query here is a
+    # module-level constant with bound parameters.
+
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        conn = self._connection()
+        has_totals = conn.execute(HAS_TOTALS).fetchone()
+        conn.executescript(SCHEMA)
+        if not has_totals:
+            conn.executescript(REBUILD_TOTALS)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, cached_statements=256,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=5000')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def list_transactions(self):
+        return [row_to_transaction(row) for row in self._connection().execute(SELECT_TRANSACTIONS)]
+
+    def iter_transactions(self):
+        # Streams rows off the cursor instead of building the whole list
+        for row in self._connection().execute(SELECT_TRANSACTIONS):
+            yield row_to_transaction(row)
+
+    def _select(self, filters, after=None, limit=None):
+        # SQL text and parameters of a filtered query, or of one page of it
+        if limit is not None:
+            after_date, after_id = after if after is not None else (MIN_DATE, 0)
+            # SQLite only seeks on the plain date bound, so it starts at the cursor's day
+            filters = dict(filters, date_from=max(filters.get('date_from') or MIN_DATE, after_date))
+        clauses, params = filter_clauses(filters)
+        if not clauses:
+            return None, params
+        if limit is not None:
+            return SELECT_WHERE + ' AND '.join(clauses) + PAGE_AFTER, params + [after_date, after_id, limit]
+        return SELECT_WHERE + ' AND '.join(clauses) + ORDER_BY_DATE, params
+
+    def query_transactions(self, date_from=None, date_to=None, category=None, transaction_type=None,
+                           min_amount=None, max_amount=None, is_recurring=None):
+        query, params = self._select({'date_from': date_from, 'date_to': date_to, 'category': category,
+                                      'transaction_type': transaction_type, 'min_amount': min_amount,
+                                      'max_amount': max_amount, 'is_recurring': is_recurring})
+        if query is None:
+            return self.iter_transactions()
+        return self._query(query, params)
+
+    def page_transactions(self, after=None, limit=50, **filters):
+        query, params = self._select(filters, after, limit)
+        return list(self._query(query, params))
+
+    def explain_query(self, after=None, limit=None, **filters):
+        # SQLite does not report rows scanned, only the plan it chose
+        query, params = self._select(filters, after, limit)
+        if query is None:
+            query, params = SELECT_TRANSACTIONS, []
+        conn = self._connection()
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params)]
+        return {'plan': plan, 'returned': sum(1 for _ in conn.execute(query, params))}
+
+    def _query(self, query, params):
+        for row in self._connection().execute(query, params):
+            yield row_to_transaction(row)
+
+    def add_transaction(self, transaction):
+        conn = self._connection()
+        transaction.id = None
+        cursor = conn.execute(INSERT_TRANSACTION, transaction_to_row(transaction))
+        transaction.id = cursor.lastrowid
+        return transaction
+
+    def add_transactions(self, transactions):
+        # One write transaction for the whole batch
+        if not transactions:
+            return transactions
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._insert_batch(conn, transactions)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return transactions
+
+    def add_transactions_with_rules(self, transactions):
+        if not transactions:
+            return transactions
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._insert_batch(conn, transactions)
+            conn.executemany(UPSERT_RULE, (transaction_to_row(t) for t in transactions if t.is_recurring))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return transactions
+
+    def _insert_batch(self, conn, transactions):
+        # Runs inside a write transaction. The first insert draws an id past
+        # every id ever used, so the rest take the ids after it and go in
+        # with a single executemany.
+        if not transactions:
+            return
+        first = transactions[0]
+        first.id = None
+        first.id = conn.execute(INSERT_TRANSACTION, transaction_to_row(first)).lastrowid
+        for offset, transaction in enumerate(transactions[1:], 1):
+            transaction.id = first.id + offset
+        conn.executemany(INSERT_TRANSACTION, map(transaction_to_row, transactions[1:]))
+
+    def get_transaction(self, transaction_id):
+        row = self._connection().execute(SELECT_TRANSACTION, (transaction_id,)).fetchone()
+        return row_to_transaction(row) if row is not None else None
+
+    def delete_transaction(self, transaction_id):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(SELECT_TRANSACTION, (transaction_id,)).fetchone()
+            if row is not None:
+                conn.execute(DELETE_TRANSACTION, (transaction_id,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return row_to_transaction(row) if row is not None else None
+
+    def delete_transactions(self, transaction_ids):
+        ids = json.dumps(list(transaction_ids))
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(SELECT_TRANSACTION_BATCH, (ids,)).fetchall()
+            if rows:
+                conn.execute(DELETE_TRANSACTION_BATCH, (ids,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return [row_to_transaction(row) for row in rows]
+
+    def categories(self):
+        return [row[0] for row in self._connection().execute(SELECT_CATEGORIES)]
+
+    def balance(self):
+        # ledger_totals is maintained by triggers, so this reads one row per
+        # (category, type) pair instead of aggregating the ledger
+        return summarize_totals(self._connection().execute(SELECT_TOTALS))
+
+    def summary_cells(self, **filters):
+        clauses, params = filter_clauses(filters)
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return [((category, transaction_type, month), [cents, count, low, high])
+                for category, transaction_type, month, cents, count, low, high
+                in self._connection().execute(SELECT_SUMMARY + where + GROUP_BY_CELL, params)]
+
+    def ledger_version(self):
+        return self._connection().execute(SELECT_VERSION).fetchone()
+
+    def recurring_rules(self):
+        return [row_to_transaction(row) for row in self._connection().execute(SELECT_RULES)]
+
+    def add_rule(self, rule):
+        self._connection().execute(UPSERT_RULE, transaction_to_row(rule))
+
+    def update_rule(self, rule):
+        self._connection().execute(UPSERT_RULE, transaction_to_row(rule))
+
+    def remove_rule(self, rule_id):
+        self._connection().execute(DELETE_RULE, (rule_id,))
+
+    def advance_rules(self, due):
+        # BEGIN IMMEDIATE takes the database's write lock before the rules
+        # are read, so a worker in another process waits for this one and
+        # then finds the rules moved on. A rule's occurrences are only
+        # inserted if its conditional UPDATE matched.
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            occurrences = []
+            for rule in [row_to_transaction(row) for row in conn.execute(SELECT_RULES)]:
+                due_now, last_date = due(rule)
+                if due_now and conn.execute(ADVANCE_RULE, (last_date, rule.id, rule.date)).rowcount == 1:
+                    occurrences.extend(due_now)
+            self._insert_batch(conn, occurrences)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return occurrences
+
+    def remove_rules(self, rule_ids):
+        self._connection().execute(DELETE_RULE_BATCH, (json.dumps(list(rule_ids)),))
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
@@ -0,0 +1,128 @@
+import json
+import os
+import struct
+import sys
+from array import array
+
+# Binary dump of a MemoryRepository: every typed array is written as its raw
+# buffer and read back with a single frombytes, so a restore does no per-row
+# work for the columns and indexes. Layout:
+#
+#   MAGIC, HEADER (format version, length of the metadata)
+#   metadata    JSON: seq, id counter, byte order, string table and posting
+#               list shapes, totals, recurring rules and the section list
+#   sections    raw array buffers, back to back, in metadata order
+#
+# String tables are one section each: the values other than None joined by
+# NUL, or a JSON list when a value itself contains NUL. Category posting
+# lists are concatenated into one section of ids followed by one of date
+# ordinals. The amount index follows as its cents and ids.
+
+MAGIC = b'LEDGSNAP'
+HEADER = struct.Struct('<II')
+VERSION = 3
+
+
+def _encode_table(values):
+    none = values.index(None) if None in values else -1
+    strings = [v for v in values if v is not None]
+    if any('\x00' in v for v in strings):
+        return none, True, json.dumps(strings).encode('utf-8')
+    return none, False, '\x00'.join(strings).encode('utf-8', 'surrogatepass')
+
+
+def _decode_table(none, is_json, data, count):
+    if is_json:
+        values = json.loads(bytes(data).decode('utf-8'))
+    else:
+        text = str(data, 'utf-8', 'surrogatepass')
+        values = text.split('\x00') if count > (1 if none >= 0 else 0) else []
+    if none >= 0:
+        values.insert(none, None)
+    return values
+
+
+def write_state(path, seq, state):
+    sections = list(state['columns'])
+    sections.append(array('B', state['alive']))
+    tables = []
+    for values in state['tables']:
+        none, is_json, data = _encode_table(values)
+        tables.append([none, is_json, len(values)])
+        sections.append(array('B', data))
+    sections.extend(state['dates'])
+    postings = [[key, len(ids)] for key, _, ids in state['postings']]
+    sections.append(array('q', b''.join(ids.tobytes() for _, _, ids in state['postings'])))
+    sections.append(array('i', b''.join(ordinals.tobytes() for _, ordinals, _ in state['postings'])))
+    sections.extend(state['amounts'])
+
+    meta = json.dumps({
+        'seq': seq,
+        'next_id': state['next_id'],
+        'byteorder': sys.byteorder,
+        'tombstones': state['tombstones'],
+        'tables': tables,
+        'postings': postings,
+        'totals': state['totals'],
+        'rules': state['rules'],
+        'sections': [[s.typecode, s.itemsize, len(s)] for s in sections],
+    }, separators=(',', ':')).encode('utf-8')
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + HEADER.pack(VERSION, len(meta)) + meta)
+        for section in sections:
+            section.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_state(path):
+    # Returns the state dict passed to write_state, with seq added
+    with open(path, 'rb') as f:
+        data = memoryview(f.read())
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a ledger state file: %s" % path)
+    version, meta_length = HEADER.unpack_from(data, len(MAGIC))
+    if version != VERSION:
+        raise ValueError("Unsupported ledger state version %d in %s" % (version, path))
+    offset = len(MAGIC) + HEADER.size
+    meta = json.loads(bytes(data[offset:offset + meta_length]))
+    offset += meta_length
+
+    sections = []
+    for typecode, itemsize, length in meta['sections']:
+        section = array(typecode)
+        if section.itemsize != itemsize:
+            raise ValueError("Ledger state %s was written on an incompatible platform" % path)
+        section.frombytes(data[offset:offset + itemsize * length])
+        if meta['byteorder'] != sys.byteorder:
+            section.byteswap()
+        sections.append(section)
+        offset += itemsize * length
+
+    columns = sections[:8]
+    alive = bytearray(sections[8])
+    tables = [_decode_table(none, is_json, section, count)
+              for (none, is_json, count), section in zip(meta['tables'], sections[9:13])]
+    dates = sections[13], sections[14]
+    postings = []
+    position = 0
+    for key, length in meta['postings']:
+        postings.append((key, sections[16][position:position + length], sections[15][position:position + length]))
+        position += length
+    amounts = sections[17], sections[18]
+    return {
+        'seq': meta['seq'],
+        'next_id': meta['next_id'],
+        'columns': columns,
+        'alive': alive,
+        'tombstones': meta['tombstones'],
+        'tables': tables,
+        'dates': dates,
+        'postings': postings,
+        'amounts': amounts,
+        'totals': meta['totals'],
+        'rules': meta['rules'],
+    }
@@ -13,18 +13,30 @@ document.addEventListener('DOMContentLoaded', () => {
     const categoryFilterSelect = document.getElementById('category-filter');
     const expenseChartCtx = document.getElementById('expense-chart').getContext('2d');
     const processRecurringButton = document.getElementById('process-recurring');
+    const loadMoreButton = document.getElementById('load-more');
+    const removeSelectedButton = document.getElementById('remove-selected');
+    const pageSize = 100;
+    const syncInterval = 5000;
+    // Fields the list and chart use, fetched column-wise
+    const listFields = 'id,amount,description,type,category,date,is_recurring';
 
     let transactions = [];
     let categories = [];
+    let nextPage = null;
+    // Ledger version the loaded list reflects, from the first page's ETag
+    let version = null;
     let expenseChart;
 
     function updateBalance() {
-        const balance = transactions.reduce((acc, transaction) => {
-            return transaction.type === 'income' ? acc + transaction.amount : acc - transaction.amount;
-        }, 0);
-
-        balanceElement.textContent = balance.toFixed(2);
-        balanceElement.className = balance >= 0 ? 'balance positive' : 'balance negative';
+        fetch('/api/balance')
+            .then(response => response.json())
+            .then(data => {
+                balanceElement.textContent = data.balance.toFixed(2);
+                balanceElement.className = data.balance >= 0 ? 'balance positive' : 'balance negative';
+            })
+            .catch((error) => {
+                console.error('Error:', error);
+            });
     }
 
     function renderTransactions(filteredTransactions = transactions) {
@@ -33,6 +45,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const li = document.createElement('li');
             li.className = `transaction-item ${transaction.type}`;
             li.innerHTML = `
+                <input type="checkbox" class="form-check-input select-transaction" value="${transaction.id}">
                 <span>${transaction.description}</span>
                 <span>${transaction.type === 'income' ? '+' : '-'}$${transaction.amount.toFixed(2)}</span>
                 <span>${transaction.category}</span>
@@ -42,40 +55,63 @@ document.addEventListener('DOMContentLoaded', () => {
             `;
             transactionList.appendChild(li);
         });
+        removeSelectedButton.disabled = true;
     }
 
-    function updateChart(filteredTransactions = transactions) {
-        const labels = filteredTransactions.map(t => t.description);
-        const data = filteredTransactions.map(t => t.amount);
-        const backgroundColors = filteredTransactions.map(t => t.type === 'income' ? 'rgba(75, 192, 192, 0.2)' : 'rgba(255, 99, 132, 0.2)');
-        const borderColors = filteredTransactions.map(t => t.type === 'income' ? 'rgba(75, 192, 192, 1)' : 'rgba(255, 99, 132, 1)');
+    function selectedIds() {
+        return Array.from(transactionList.querySelectorAll('.select-transaction:checked'), box => Number(box.value));
+    }
 
-        if (expenseChart) {
-            expenseChart.destroy();
-        }
+    function updateChart() {
+        // Monthly income and expense totals over the whole ledger, aggregated
+        // by the server, so the chart does not need every transaction loaded
+        const selectedCategory = categoryFilterSelect.value;
+        const category = selectedCategory ? `&category=${encodeURIComponent(selectedCategory)}` : '';
+        fetch(`/api/summary?group_by=month,type${category}`)
+            .then(response => response.json())
+            .then(data => {
+                const months = [...new Set(data.groups.map(g => g.month))];
+                const totals = type => months.map(month => {
+                    const group = data.groups.find(g => g.month === month && g.type === type);
+                    return group ? group.total : 0;
+                });
 
-        expenseChart = new Chart(expenseChartCtx, {
-            type: 'bar',
-            data: {
-                labels: labels,
-                datasets: [{
-                    label: 'Transaction Amount',
-                    data: data,
-                    backgroundColor: backgroundColors,
-                    borderColor: borderColors,
-                    borderWidth: 1
-                }]
-            },
-            options: {
-                scales: {
-                    y: {
-                        beginAtZero: true
+                if (expenseChart) {
+                    expenseChart.destroy();
+                }
+
+                expenseChart = new Chart(expenseChartCtx, {
+                    type: 'bar',
+                    data: {
+                        labels: months,
+                        datasets: [{
+                            label: 'Income',
+                            data: totals('income'),
+                            backgroundColor: 'rgba(75, 192, 192, 0.2)',
+                            borderColor: 'rgba(75, 192, 192, 1)',
+                            borderWidth: 1
+                        }, {
+                            label: 'Expense',
+                            data: totals('expense'),
+                            backgroundColor: 'rgba(255, 99, 132, 0.2)',
+                            borderColor: 'rgba(255, 99, 132, 1)',
+                            borderWidth: 1
+                        }]
+                    },
+                    options: {
+                        scales: {
+                            y: {
+                                beginAtZero: true
+                            }
+                        },
+                        responsive: true,
+                        maintainAspectRatio: false
                     }
-                },
-                responsive: true,
-                maintainAspectRatio: false
-            }
-        });
+                });
+            })
+            .catch((error) => {
+                console.error('Error:', error);
+            });
     }
 
     function addTransaction(e) {
@@ -104,10 +140,10 @@ document.addEventListener('DOMContentLoaded', () => {
         })
         .then(response => response.json())
         .then(data => {
-            transactions.push(data);
+            mergeTransactions([data]);
             updateCategories();
             updateBalance();
-            renderTransactions();
+            filterTransactions();
             updateChart();
             transactionForm.reset();
             dateInput.value = new Date().toISOString().split('T')[0];
@@ -118,17 +154,24 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
-    function removeTransaction(id) {
-        fetch(`/api/transactions/${id}`, {
+    function removeTransactions(ids) {
+        // One request for the whole selection
+        fetch('/api/transactions', {
             method: 'DELETE',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ ids }),
         })
-        .then(response => {
-            if (response.ok) {
-                transactions = transactions.filter(t => t.id !== id);
+        .then(response => response.ok ? response.json() : null)
+        .then(data => {
+            if (data) {
+                const deleted = new Set(data.deleted);
+                transactions = transactions.filter(t => !deleted.has(t.id));
                 updateCategories();
                 updateBalance();
-                renderTransactions();
                 updateChart();
+                filterTransactions();
             }
         })
         .catch((error) => {
@@ -137,23 +180,127 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     function updateCategories() {
-        categories = [...new Set(transactions.map(t => t.category))];
-        categoryFilterSelect.innerHTML = '<option value="">All Categories</option>';
-        categories.forEach(category => {
-            const option = document.createElement('option');
-            option.value = category;
-            option.textContent = category;
-            categoryFilterSelect.appendChild(option);
+        // Only a page of transactions is loaded, so ask the server for all categories
+        fetch('/api/categories')
+            .then(response => response.json())
+            .then(data => {
+                const selectedCategory = categoryFilterSelect.value;
+                categories = data;
+                categoryFilterSelect.innerHTML = '<option value="">All Categories</option>';
+                categories.forEach(category => {
+                    const option = document.createElement('option');
+                    option.value = category;
+                    option.textContent = category;
+                    categoryFilterSelect.appendChild(option);
+                });
+                categoryFilterSelect.value = categories.includes(selectedCategory) ? selectedCategory : '';
+            })
+            .catch((error) => {
+                console.error('Error:', error);
+            });
+    }
+
+    function fromColumns(data) {
+        // Rebuilds transaction objects from a format=columnar payload
+        const columns = {};
+        Object.entries(data.columns).forEach(([field, column]) => {
+            columns[field] = Array.isArray(column) ? column : column.codes.map(code => column.values[code]);
+        });
+        const fields = Object.keys(columns);
+        return Array.from({ length: data.count }, (_, i) => {
+            const transaction = {};
+            fields.forEach(field => {
+                transaction[field] = columns[field][i];
+            });
+            return transaction;
         });
     }
 
+    function loadTransactions(url, append = false) {
+        // Pages are ordered by (date, id); data.next is the URL of the following page
+        fetch(url)
+            .then(response => {
+                if (!append) {
+                    version = (response.headers.get('ETag') || '').replace(/^W\//, '').replace(/"/g, '') || null;
+                }
+                return response.json();
+            })
+            .then(data => {
+                const page = fromColumns(data.transactions);
+                if (append) {
+                    // A row added here since the last page may be on this one too
+                    const known = new Set(transactions.map(t => t.id));
+                    transactions = transactions.concat(page.filter(t => !known.has(t.id)));
+                } else {
+                    transactions = page;
+                }
+                nextPage = data.next;
+                loadMoreButton.style.display = nextPage ? 'block' : 'none';
+                filterTransactions();
+            })
+            .catch((error) => {
+                console.error('Error:', error);
+            });
+    }
+
+    function firstPageUrl() {
+        const selectedCategory = categoryFilterSelect.value;
+        const category = selectedCategory ? `&category=${encodeURIComponent(selectedCategory)}` : '';
+        return `/api/transactions?limit=${pageSize}&format=columnar&fields=${listFields}${category}`;
+    }
+
     function filterTransactions() {
         const selectedCategory = categoryFilterSelect.value;
         const filteredTransactions = selectedCategory
             ? transactions.filter(t => t.category === selectedCategory)
             : transactions;
         renderTransactions(filteredTransactions);
-        updateChart(filteredTransactions);
+    }
+
+    function compareTransactions(a, b) {
+        // The (date, id) order pages are served in
+        return a.date < b.date ? -1 : a.date > b.date ? 1 : a.id - b.id;
+    }
+
+    function mergeTransactions(inserted, deleted = new Set()) {
+        // Applies inserts and deletes to the loaded pages, keeping their
+        // (date, id) order. New rows outside the category filter, or past
+        // the last loaded row while "Load more" will still fetch them, are
+        // left out.
+        const selectedCategory = categoryFilterSelect.value;
+        const known = new Set(transactions.map(t => t.id));
+        const last = transactions[transactions.length - 1];
+        const added = inserted.filter(t => !known.has(t.id)
+            && (!selectedCategory || t.category === selectedCategory)
+            && (!nextPage || !last || compareTransactions(t, last) < 0));
+        transactions = transactions.filter(t => !deleted.has(t.id)).concat(added).sort(compareTransactions);
+    }
+
+    function syncChanges() {
+        // Applies inserts and deletes made since the list was loaded, from
+        // this tab or any other client
+        if (version === null || document.hidden) {
+            return;
+        }
+        fetch(`/api/changes?since=${encodeURIComponent(version)}&fields=${listFields}`)
+            .then(response => response.json())
+            .then(data => {
+                if (data.resync) {
+                    loadTransactions(firstPageUrl());
+                } else if (data.inserted.length || data.deleted.length) {
+                    mergeTransactions(data.inserted, new Set(data.deleted));
+                    updateCategories();
+                    updateBalance();
+                    updateChart();
+                    filterTransactions();
+                }
+                if (!data.resync) {
+                    version = data.version;
+                }
+            })
+            .catch((error) => {
+                console.error('Error:', error);
+            });
     }
 
     function processRecurringTransactions() {
@@ -162,10 +309,10 @@ document.addEventListener('DOMContentLoaded', () => {
         })
         .then(response => response.json())
         .then(data => {
-            transactions = transactions.concat(data);
+            mergeTransactions(data);
             updateCategories();
             updateBalance();
-            renderTransactions();
+            filterTransactions();
             updateChart();
         })
         .catch((error) => {
@@ -174,26 +321,32 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     transactionForm.addEventListener('submit', addTransaction);
-    categoryFilterSelect.addEventListener('change', filterTransactions);
+    categoryFilterSelect.addEventListener('change', () => {
+        loadTransactions(firstPageUrl());
+        updateChart();
+    });
+    loadMoreButton.addEventListener('click', () => {
+        if (nextPage) {
+            loadTransactions(nextPage, true);
+        }
+    });
     processRecurringButton.addEventListener('click', processRecurringTransactions);
+    transactionList.addEventListener('change', () => {
+        removeSelectedButton.disabled = selectedIds().length === 0;
+    });
+    removeSelectedButton.addEventListener('click', () => removeTransactions(selectedIds()));
 
     isRecurringCheckbox.addEventListener('change', () => {
         recurrenceIntervalContainer.style.display = isRecurringCheckbox.checked ? 'block' : 'none';
     });
 
-    // Fetch transactions from the server
-    fetch('/api/transactions')
-        .then(response => response.json())
-        .then(data => {
-            transactions = data;
-            updateCategories();
-            updateBalance();
-            renderTransactions();
-            updateChart();
-        })
-        .catch((error) => {
-            console.error('Error:', error);
-        });
+    // Fetch the first page of transactions from the server
+    loadTransactions(firstPageUrl());
+    updateCategories();
+    updateBalance();
+    updateChart();
+    setInterval(syncChanges, syncInterval);
+    document.addEventListener('visibilitychange', syncChanges);
 
     // Fetch and display current time from the server
     fetch('/api/current_time')
@@ -206,5 +359,5 @@ document.addEventListener('DOMContentLoaded', () => {
     // Set default date to today
     dateInput.value = new Date().toISOString().split('T')[0];
 
-    window.removeTransaction = removeTransaction;
+    window.removeTransaction = id => removeTransactions([id]);
 });
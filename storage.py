@@ -0,0 +1,403 @@
+import fcntl
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+from contextlib import nullcontext
+from operator import attrgetter
+
+from models import TRANSACTION_FIELDS
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = 'snapshot.json'
+STATE_FILE = 'state.bin'
+LOCK_FILE = 'ledger.lock'
+LOG_PREFIX = 'ledger-'
+LOG_SUFFIX = '.log'
+
+
+class LedgerInUseError(RuntimeError):
+    pass
+
+
+class LogWorker:
+    # Background threads shared by every open LedgerLog: one flusher that
+    # fsyncs dirty logs every sync_interval (or as soon as one has a full
+    # batch pending or a writer waits) and one compactor fed through a queue. Sharing them
+    # keeps the thread count flat however many ledgers are open.
+
+    def __init__(self, sync_interval=0.05):
+        self.sync_interval = sync_interval
+        self._logs = set()
+        self._lock = threading.Lock()
+        self._sync_event = threading.Event()
+        self._compact_queue = queue.Queue()
+        self._started = False
+
+    def register(self, log):
+        with self._lock:
+            self._logs.add(log)
+            if not self._started:
+                self._started = True
+                threading.Thread(target=self._flush_loop, name='ledger-flush', daemon=True).start()
+                threading.Thread(target=self._compact_loop, name='ledger-compact', daemon=True).start()
+
+    def unregister(self, log):
+        with self._lock:
+            self._logs.discard(log)
+
+    def request_sync(self):
+        self._sync_event.set()
+
+    def request_compaction(self, log):
+        self._compact_queue.put(log)
+
+    def _flush_loop(self):
+        while True:
+            self._sync_event.wait(self.sync_interval)
+            self._sync_event.clear()
+            with self._lock:
+                logs = list(self._logs)
+            for log in logs:
+                try:
+                    log.sync()
+                except Exception:
+                    logger.exception("Ledger sync failed for %s", log.directory)
+
+    def _compact_loop(self):
+        while True:
+            log = self._compact_queue.get()
+            try:
+                log.compact()
+            except Exception:
+                logger.exception("Ledger compaction failed for %s", log.directory)
+
+
+worker = LogWorker()
+
+
+class LedgerLog:
+    # Append-only mutation log with batched fsync. State is rebuilt at startup
+    # from the last snapshot plus every log segment written after it.
+    #
+    # The snapshot records the id allocator's next value, so ids of deleted
+    # transactions are never handed out again after a restart.
+    #
+    # Replay is idempotent (adds and rule upserts are keyed by id, deletes of
+    # missing ids are ignored), so a mutation that lands in the snapshot and
+    # in the log tail is applied only once.
+    #
+    # state_lock, if given, is held while state_fn runs. Writers must take it
+    # before calling append() so the two locks are always acquired in order.
+    #
+    # seal_fn, if given, is called as seal_fn(seq, transactions) during
+    # compaction, outside the locks, to move the captured transactions into
+    # storage of the owner's own; it returns what the snapshot should keep.
+    # Deletes replayed for ids the log has never seen are collected in
+    # replayed_deletes so the owner can apply them to that storage.
+    #
+    # dump_fn, if given, replaces snapshot.json with the owner's own format:
+    # compaction calls dump_fn(path, seq, state) on whatever state_fn
+    # returned, and at startup the owner restores that file itself and
+    # replays the rest through open_entries(seq).
+    #
+    # Writers call wait_synced(seq) before acknowledging a write: a group
+    # commit, where every writer waiting on the flusher's next pass shares
+    # its fsync.
+    #
+    # A log holds an exclusive lock on LOCK_FILE from construction until it
+    # is closed, so a second process (another server, or the snapshot and
+    # restore commands) cannot open the ledger behind the first one's back.
+
+    def __init__(self, directory, state_fn, state_lock=None, sync_batch=512, compact_bytes=64 * 1024 * 1024,
+                 seal_fn=None, dump_fn=None):
+        self.directory = directory
+        self.state_fn = state_fn
+        self.state_lock = state_lock
+        self.seal_fn = seal_fn
+        self.dump_fn = dump_fn
+        self.replayed_deletes = set()
+        self.snapshot_seq = 0
+        self.sync_batch = sync_batch
+        self.compact_bytes = compact_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, LOCK_FILE), 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise LedgerInUseError("Ledger %s is in use by another process" % directory)
+
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        # Held for a whole compaction, so an explicit one and the worker's
+        # never write the snapshot at once
+        self._compact_lock = threading.Lock()
+        self._file = None
+        self._seq = 0
+        self._synced_seq = 0
+        self._segment_bytes = 0
+        self._pending = 0
+        self._compacting = False
+        self._compaction_requested = False
+        self._closed = False
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._truncate_torn_tail()
+        transactions, recurring, next_id, self._seq = self._replay()
+        self._start_segment()
+        worker.register(self)
+        logger.info("Ledger opened with %d transactions at seq %d", len(transactions), self._seq)
+        return transactions, recurring, next_id
+
+    def open_entries(self, seq):
+        # Opens the log on top of a state restored at seq and returns the
+        # entries written after it, in order
+        os.makedirs(self.directory, exist_ok=True)
+        self._truncate_torn_tail()
+        entries = list(self._entries(seq))
+        self.snapshot_seq = seq
+        self._seq = max([seq] + [entry['seq'] for entry in entries])
+        self._start_segment()
+        worker.register(self)
+        logger.info("Ledger opened at seq %d with %d log entries after the snapshot", self._seq, len(entries))
+        return entries
+
+    @property
+    def seq(self):
+        return self._seq
+
+    def append(self, op, data):
+        with self._lock:
+            self._seq += 1
+            line = json.dumps({'seq': self._seq, 'op': op, 'data': data}, separators=(',', ':')) + '\n'
+            self._file.write(line)
+            self._segment_bytes += len(line)
+            self._pending += 1
+            if self._pending >= self.sync_batch:
+                worker.request_sync()
+            if self._segment_bytes >= self.compact_bytes and not self._compacting:
+                self._compacting = True
+                worker.request_compaction(self)
+
+    def wait_synced(self, seq):
+        # Returns once the entries up to seq are on disk
+        with self._lock:
+            if self._synced_seq < seq and not self._closed:
+                worker.request_sync()
+                while self._synced_seq < seq and not self._closed:
+                    self._synced.wait()
+
+    def request_compaction(self):
+        # A request made while a compaction runs is kept and runs after it,
+        # as the running one may have captured its state before the request
+        with self._lock:
+            if self._closed:
+                return
+            if self._compacting:
+                self._compaction_requested = True
+            else:
+                self._compacting = True
+                worker.request_compaction(self)
+
+    def sync(self):
+        with self._lock:
+            if not self._closed:
+                self._sync_locked()
+
+    def compact(self):
+        # Rotate to a fresh segment and capture state under the lock, then
+        # write the snapshot without blocking appends. Compactions run one at
+        # a time, so snapshots land in seq order.
+        with self._compact_lock:
+            self._compact()
+
+    def _compact(self):
+        with self.state_lock or nullcontext(), self._lock:
+            if self._closed:
+                return
+            self._sync_locked()
+            seq = self._seq
+            state = self.state_fn()
+            self._file.close()
+            self._start_segment()
+        try:
+            if self.dump_fn is not None:
+                self.dump_fn(os.path.join(self.directory, STATE_FILE), seq, state)
+            else:
+                transactions, recurring, next_id = state
+                if self.seal_fn is not None:
+                    transactions = self.seal_fn(seq, transactions)
+                self._write_snapshot(seq, transactions, recurring, next_id)
+            self.snapshot_seq = seq
+        finally:
+            with self._lock:
+                self._compacting = self._compaction_requested and not self._closed
+                self._compaction_requested = False
+                if self._compacting:
+                    worker.request_compaction(self)
+        # Every segment older than the one just started is covered by the snapshot
+        for name in self._segments():
+            if self._segment_name_seq(name) < seq:
+                os.remove(os.path.join(self.directory, name))
+        logger.info("Ledger compacted at seq %d", seq)
+
+    def reset(self, state_path, seq):
+        # Discards the log and installs state_path as the snapshot at seq
+        with self._lock:
+            self._sync_locked()
+            self._file.close()
+            path = os.path.join(self.directory, STATE_FILE)
+            shutil.copyfile(state_path, path + '.tmp')
+            os.replace(path + '.tmp', path)
+            for name in self._segments():
+                os.remove(os.path.join(self.directory, name))
+            self._seq = self.snapshot_seq = seq
+            self._start_segment()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._sync_locked()
+            self._file.close()
+        worker.unregister(self)
+        self._lock_file.close()
+
+    def _sync_locked(self):
+        if self._pending:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending = 0
+        self._synced_seq = self._seq
+        self._synced.notify_all()
+
+    def _start_segment(self):
+        # Segment names carry the seq of the last entry before them, so sorting
+        # by name yields replay order.
+        path = os.path.join(self.directory, '%s%020d%s' % (LOG_PREFIX, self._seq, LOG_SUFFIX))
+        self._file = open(path, 'a', encoding='utf-8')
+        self._segment_bytes = 0
+        self._synced_seq = self._seq
+
+    def _truncate_torn_tail(self):
+        # A crash can leave the newest segment ending in part of an entry.
+        # When that was the segment's first entry, _start_segment reopens
+        # the same file, and the next entry would be appended to the torn
+        # line and lost with it on the following replay; so the segment is
+        # cut back to its last complete line first.
+        segments = self._segments()
+        if not segments:
+            return
+        with open(os.path.join(self.directory, segments[-1]), 'rb+') as f:
+            end = position = f.seek(0, os.SEEK_END)
+            keep = 0
+            while position > 0:
+                start = max(0, position - 65536)
+                f.seek(start)
+                newline = f.read(position - start).rfind(b'\n')
+                if newline >= 0:
+                    keep = start + newline + 1
+                    break
+                position = start
+            if keep < end:
+                logger.warning("Truncating %d bytes of a torn log entry in %s", end - keep, segments[-1])
+                f.truncate(keep)
+                os.fsync(f.fileno())
+
+    def _segments(self):
+        names = [n for n in os.listdir(self.directory) if n.startswith(LOG_PREFIX) and n.endswith(LOG_SUFFIX)]
+        return sorted(names)
+
+    def _segment_name_seq(self, name):
+        return int(name[len(LOG_PREFIX):-len(LOG_SUFFIX)])
+
+    def _write_snapshot(self, seq, transactions, recurring, next_id):
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            # json.dumps is far faster than streaming json.dump for large states
+            f.write(json.dumps({'seq': seq, 'next_id': next_id, 'transactions': transactions,
+                                'recurring': recurring}, separators=(',', ':')))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _replay(self):
+        transactions = {}
+        recurring = {}
+        seq = 0
+        next_id = 0
+
+        snapshot_path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+            seq = snapshot['seq']
+            next_id = snapshot.get('next_id', 0)
+            transactions = {t['id']: t for t in snapshot['transactions']}
+            recurring = {r['id']: r for r in snapshot['recurring']}
+
+        self.snapshot_seq = seq
+        for entry in self._entries(seq):
+            seq = max(seq, entry['seq'])
+            if entry['op'] == 'add':
+                next_id = max(next_id, entry['data']['id'] + 1)
+            elif entry['op'] == 'add_many':
+                next_id = max([next_id] + [t['id'] + 1 for t in batch_transactions(entry['data'])])
+            elif entry['op'] == 'delete' and entry['data']['id'] not in transactions:
+                self.replayed_deletes.add(entry['data']['id'])
+            elif entry['op'] == 'delete_many':
+                self.replayed_deletes.update(i for i in entry['data']['ids'] if i not in transactions)
+            apply_entry(transactions, recurring, entry['op'], entry['data'])
+
+        next_id = max([next_id] + [t + 1 for t in transactions])
+        return list(transactions.values()), list(recurring.values()), next_id, seq
+
+    def _entries(self, after_seq):
+        for name in self._segments():
+            with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn write at the tail of the last segment
+                        logger.warning("Skipping truncated log entry in %s", name)
+                        break
+                    if entry['seq'] > after_seq:
+                        yield entry
+
+
+def batch_entry(transactions):
+    # Data of an add_many entry: one field list and a row of values per
+    # transaction, which encodes several times faster than a dict each
+    return {'fields': TRANSACTION_FIELDS, 'rows': list(map(attrgetter(*TRANSACTION_FIELDS), transactions))}
+
+
+def batch_transactions(data):
+    fields = data['fields']
+    return [dict(zip(fields, row)) for row in data['rows']]
+
+
+def apply_entry(transactions, recurring, op, data):
+    if op == 'add':
+        transactions.setdefault(data['id'], data)
+    elif op == 'add_many':
+        for transaction in batch_transactions(data):
+            transactions.setdefault(transaction['id'], transaction)
+    elif op == 'delete':
+        transactions.pop(data['id'], None)
+    elif op == 'delete_many':
+        for transaction_id in data['ids']:
+            transactions.pop(transaction_id, None)
+    elif op == 'rule':
+        recurring[data['id']] = data
+    elif op == 'unrule':
+        recurring.pop(data['id'], None)
+    else:
+        raise ValueError("Unknown ledger log operation: %s" % op)
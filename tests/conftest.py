@@ -0,0 +1,41 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main reads its data directory and secret key on import
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ['LEDGER_DATA_DIR'] = tempfile.mkdtemp(prefix='ledger-tests-')
+os.environ.setdefault('SECRET_KEY', 'tests')
+
+import main  # noqa: E402
+from repository import create_shard_registry  # noqa: E402
+from users import UserStore  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch, request):
+    # main's app on a fresh data directory with the backend named by the
+    # test's `backend` parameter
+    monkeypatch.setenv('LEDGER_DATA_DIR', str(tmp_path))
+    monkeypatch.setenv('LEDGER_BACKEND', request.param)
+    shards = create_shard_registry()
+    monkeypatch.setattr(main, 'shards', shards)
+    monkeypatch.setattr(main, 'users', UserStore(str(tmp_path / 'users.json')))
+    yield main.app
+    shards.close()
+
+
+def login(app, username='alice'):
+    client = app.test_client()
+    client.post('/register', data={'username': username, 'password': 'secret'})
+    return client
+
+
+def add(client, amount, kind='expense', category='food', date='2024-01-15', **fields):
+    response = client.post('/api/transactions', json=dict(
+        amount=amount, description='x', type=kind, category=category, date=date, **fields))
+    assert response.status_code == 201
+    return response.json
@@ -0,0 +1,128 @@
+import json
+
+import pytest
+
+import main
+from conftest import login
+
+ITEM = {'amount': 1, 'description': 'x', 'type': 'expense', 'category': 'food', 'date': '2024-01-01'}
+
+
+def items(*amounts):
+    return [dict(ITEM, amount=amount) for amount in amounts]
+
+
+@pytest.mark.parametrize('app', ['memory', 'sqlite'], indirect=True)
+def test_bulk_insert_assigns_consecutive_ids(app):
+    client = login(app)
+    response = client.post('/api/transactions/bulk', json=items(1, 2, 3))
+    assert response.status_code == 201
+    ids = [result['id'] for result in response.json['results']]
+    assert ids == list(range(ids[0], ids[0] + 3))
+    assert (response.json['inserted'], response.json['failed']) == (3, 0)
+    assert client.get('/api/balance').json['expense'] == 6.0
+
+
+@pytest.mark.parametrize('app', ['memory', 'sqlite'], indirect=True)
+def test_bulk_insert_reports_failed_items(app):
+    client = login(app)
+    response = client.post('/api/transactions/bulk', json=items(1, 'abc', 3) + ['not an object'])
+    assert response.status_code == 207
+    assert (response.json['inserted'], response.json['failed']) == (2, 2)
+    results = response.json['results']
+    assert [result['status'] for result in results] == [201, 400, 201, 400]
+    assert 'amount' in results[1]['error']
+    assert sorted(t['id'] for t in client.get('/api/transactions').json) == [results[0]['id'], results[2]['id']]
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_bulk_insert_ndjson(app):
+    client = login(app)
+    body = '\n'.join([json.dumps(ITEM), '{"amount": ', '', json.dumps(dict(ITEM, amount=2))]) + '\n'
+    response = client.post('/api/transactions/bulk', data=body, content_type='application/x-ndjson')
+    assert response.status_code == 207
+    # Blank lines are skipped; a line that is not JSON fails alone
+    assert response.json['results'][1] == {'error': 'Invalid JSON line', 'status': 400}
+    assert [result['status'] for result in response.json['results']] == [201, 400, 201]
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_bulk_insert_limits_and_bad_bodies(app, monkeypatch):
+    client = login(app)
+    monkeypatch.setattr(main, 'MAX_BULK_SIZE', 3)
+    response = client.post('/api/transactions/bulk', json=items(1, 2, 3, 4))
+    assert response.status_code == 413
+    assert client.get('/api/transactions').json == []
+    assert client.post('/api/transactions/bulk', json=items(1, 2, 3)).status_code == 201
+
+    assert client.post('/api/transactions/bulk', json=ITEM).status_code == 400
+    assert client.post('/api/transactions/bulk', data='[', content_type='application/json').status_code == 400
+
+
+@pytest.mark.parametrize('app', ['memory', 'sqlite'], indirect=True)
+def test_bulk_insert_stores_recurring_rules(app):
+    client = login(app)
+    response = client.post('/api/transactions/bulk', json=[
+        dict(ITEM, is_recurring=True, recurrence_interval='monthly'), ITEM])
+    assert response.status_code == 201
+    shard = main.shards.get(main.users.find('alice').id)
+    rules = shard.repository.recurring_rules()
+    assert [rule.id for rule in rules] == [response.json['results'][0]['id']]
+
+
+@pytest.mark.parametrize('app', ['memory', 'sqlite'], indirect=True)
+def test_bulk_delete_by_ids(app):
+    client = login(app)
+    response = client.post('/api/transactions/bulk', json=[
+        dict(ITEM, amount=1, is_recurring=True, recurrence_interval='monthly'), dict(ITEM, amount=2),
+        dict(ITEM, amount=3)])
+    ids = [result['id'] for result in response.json['results']]
+    response = client.delete('/api/transactions', json={'ids': [ids[0], ids[2], 999999]})
+    assert response.status_code == 200
+    # Missing ids are skipped
+    assert response.json == {'count': 2, 'deleted': [ids[0], ids[2]]}
+    assert [t['id'] for t in client.get('/api/transactions').json] == [ids[1]]
+    assert client.get('/api/balance').json['expense'] == 2.0
+    # The recurring rule went with its transaction
+    assert main.shards.get(main.users.find('alice').id).repository.recurring_rules() == []
+
+
+@pytest.mark.parametrize('app', ['memory', 'sqlite'], indirect=True)
+def test_bulk_delete_by_filter(app):
+    client = login(app)
+    client.post('/api/transactions/bulk', json=[
+        dict(ITEM, amount=1, category='rent', date='2023-12-01'), dict(ITEM, amount=2, category='rent'),
+        dict(ITEM, amount=3, category='food', date='2023-11-01')])
+    response = client.delete('/api/transactions?category=rent&to=2023-12-31')
+    assert response.json['count'] == 1
+    assert sorted(t['amount'] for t in client.get('/api/transactions').json) == [2.0, 3.0]
+    assert client.get('/api/categories').json.count('rent') == 1
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_bulk_delete_rejects_bad_requests(app, monkeypatch):
+    client = login(app)
+    client.post('/api/transactions/bulk', json=items(1, 2))
+    # Neither ids nor a filter, both, or ids that are not integers
+    assert client.delete('/api/transactions').status_code == 400
+    assert client.delete('/api/transactions?category=food', json={'ids': [1]}).status_code == 400
+    for body in ({'ids': ['1']}, {'ids': [True]}, {'ids': 1}, [1]):
+        assert client.delete('/api/transactions', json=body).status_code == 400
+    monkeypatch.setattr(main, 'MAX_BULK_SIZE', 1)
+    assert client.delete('/api/transactions', json={'ids': [1, 2]}).status_code == 413
+    assert len(client.get('/api/transactions').json) == 2
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_bodies_over_the_size_limit_are_refused_unread(app, monkeypatch):
+    client = login(app)
+    body = '\n'.join(json.dumps(item) for item in items(*range(1, 51)))
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', len(body) - 1)
+    for content_type in ('application/x-ndjson', 'application/json'):
+        response = client.post('/api/transactions/bulk', data=body, content_type=content_type)
+        assert response.status_code == 413
+        assert 'at most %d bytes' % (len(body) - 1) in response.json['error']
+    assert client.get('/api/transactions').json == []
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', len(body))
+    response = client.post('/api/transactions/bulk', data=body, content_type='application/x-ndjson')
+    assert response.status_code == 201
@@ -0,0 +1,83 @@
+import pytest
+
+import main
+import repository
+from conftest import add, login
+from repository import create_shard_registry
+
+
+def version(client):
+    return client.get('/api/transactions').headers['ETag'].strip('"')
+
+
+@pytest.mark.parametrize('app', ['memory', 'sqlite'], indirect=True)
+def test_inserts_and_deletes_since_a_version(app):
+    client = login(app)
+    old = add(client, 1)
+    since = version(client)
+    new = add(client, 2)
+    transient = add(client, 3)
+    assert client.delete('/api/transactions/%d' % transient['id']).status_code == 204
+    assert client.delete('/api/transactions/%d' % old['id']).status_code == 204
+
+    changes = client.get('/api/changes?since=' + since).json
+    assert changes['resync'] is False
+    # A row inserted and deleted within the window is in neither list
+    assert [t['id'] for t in changes['inserted']] == [new['id']]
+    assert changes['deleted'] == [old['id']]
+    assert changes['version'] == version(client)
+
+    caught_up = client.get('/api/changes?since=' + changes['version']).json
+    assert (caught_up['inserted'], caught_up['deleted'], caught_up['resync']) == ([], [], False)
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_gzip_tags_and_projections(app):
+    client = login(app)
+    since = version(client)
+    add(client, 2)
+    changes = client.get('/api/changes?fields=amount&since=%s-gzip' % since).json
+    assert changes['inserted'] == [{'amount': 2.0}]
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_resync_when_the_log_cannot_bridge_the_gap(app, monkeypatch):
+    client = login(app)
+    add(client, 1)
+    current = version(client)
+    epoch, number = current.rsplit('-', 1)
+
+    # No since, another epoch (a restart or restore), a future version
+    for since in (None, 'deadbeefdeadbeef-' + number, '%s-%d' % (epoch, int(number) + 5)):
+        response = client.get('/api/changes', query_string={'since': since} if since else {})
+        assert response.json == {'resync': True, 'version': current}
+
+    # Too far behind for the bounded log
+    monkeypatch.setattr(repository, 'CHANGE_LOG_SIZE', 2)
+    for amount in (2, 3, 4):
+        add(client, amount)
+    assert client.get('/api/changes?since=' + current).json['resync'] is True
+
+    assert client.get('/api/changes?since=nonsense').status_code == 400
+
+
+@pytest.mark.parametrize('app', ['sqlite'], indirect=True)
+def test_resync_after_a_write_by_another_process(app, monkeypatch):
+    client = login(app)
+    add(client, 1)
+    since = version(client)
+    # A second registry on the same files stands in for another server
+    shards = main.shards
+    other = create_shard_registry()
+    monkeypatch.setattr(main, 'shards', other)
+    add(client, 2)
+    other.close()
+    monkeypatch.setattr(main, 'shards', shards)
+
+    changes = client.get('/api/changes?since=' + since).json
+    assert changes['resync'] is True
+    assert changes['version'] != since
+    # From the new version on, the feed works again
+    add(client, 3)
+    changes = client.get('/api/changes?since=' + changes['version']).json
+    assert [t['amount'] for t in changes['inserted']] == [3.0]
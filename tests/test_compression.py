@@ -0,0 +1,100 @@
+import gzip
+
+import pytest
+
+import compression
+import main
+import repository
+from compression import ResponseCompressor
+from conftest import login
+
+GZIP = {'Accept-Encoding': 'gzip'}
+
+
+@pytest.fixture
+def client(app, monkeypatch):
+    # A user with a ledger listing well over MIN_SIZE, and an empty
+    # compressed cache
+    monkeypatch.setattr(main, 'compressor', ResponseCompressor())
+    client = login(app)
+    response = client.post('/api/transactions/bulk', json=[
+        {'amount': i, 'description': 'item %d' % i, 'type': 'expense', 'category': 'food', 'date': '2024-01-01'}
+        for i in range(1, 51)])
+    assert response.status_code == 201
+    return client
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_gzip_only_when_accepted(client):
+    plain = client.get('/api/transactions')
+    assert 'Content-Encoding' not in plain.headers
+    assert 'Accept-Encoding' in plain.headers['Vary']
+    for headers in ({'Accept-Encoding': 'gzip;q=0'}, {'Accept-Encoding': 'br'}):
+        assert 'Content-Encoding' not in client.get('/api/transactions', headers=headers).headers
+
+    response = client.get('/api/transactions', headers={'Accept-Encoding': 'br, gzip;q=0.5'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.get_data()) == plain.get_data()
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_gzip_etag_suffix_and_revalidation(client):
+    etag = client.get('/api/transactions').headers['ETag']
+    response = client.get('/api/transactions', headers=GZIP)
+    assert response.headers['ETag'] == etag[:-1] + '-gzip"'
+    # Either tag names the current version
+    for tag in (etag, response.headers['ETag']):
+        revalidated = client.get('/api/transactions', headers=dict(GZIP, **{'If-None-Match': tag}))
+        assert revalidated.status_code == 304
+    client.post('/api/transactions', json={'amount': 1, 'type': 'income', 'date': '2024-01-02'})
+    assert client.get('/api/transactions', headers=dict(GZIP, **{'If-None-Match': response.headers['ETag']})) \
+        .status_code == 200
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_small_bodies_are_not_compressed(client):
+    response = client.get('/api/balance', headers=GZIP)
+    assert len(response.get_data()) < compression.MIN_SIZE
+    assert 'Content-Encoding' not in response.headers
+    assert 'Content-Encoding' not in client.get('/api/transactions?limit=1', headers=GZIP).headers
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_repeated_reads_hit_the_cache(client, monkeypatch):
+    first = client.get('/api/transactions', headers=GZIP)
+    assert main.compressor.cache.used == len(first.get_data())
+
+    # A hit neither runs the view nor compresses again
+    def fail(*args, **kwargs):
+        raise AssertionError('not served from the cache')
+    monkeypatch.setattr(main, 'transaction_encoder', fail)
+    monkeypatch.setattr(compression.gzip, 'compress', fail)
+    second = client.get('/api/transactions', headers=GZIP)
+    assert second.status_code == 200
+    assert second.get_data() == first.get_data()
+    assert second.headers['ETag'] == first.headers['ETag']
+    assert second.headers['Content-Encoding'] == 'gzip'
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_ndjson_stream_is_compressed_in_chunks(client):
+    response = client.get('/api/transactions?format=ndjson', headers=GZIP)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    lines = gzip.decompress(response.get_data()).splitlines()
+    assert len(lines) == 50
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_users_never_share_cached_bodies(app, client, monkeypatch):
+    # Two ledgers at the same version have the same ETag
+    monkeypatch.setattr(repository.Shard, 'etag', property(lambda shard: 'same-1'))
+    alice = client.get('/api/transactions', headers=GZIP)
+    bob = login(app, 'bob')
+    bob.post('/api/transactions/bulk', json=[
+        {'amount': i, 'description': 'other %d' % i, 'type': 'income', 'category': 'pay', 'date': '2024-01-02'}
+        for i in range(1, 51)])
+    response = bob.get('/api/transactions', headers=GZIP)
+    assert response.headers['ETag'] == alice.headers['ETag']
+    assert gzip.decompress(response.get_data()) == bob.get('/api/transactions').get_data()
+    assert response.get_data() != alice.get_data()
+    assert len(main.compressor.cache._entries) == 2
@@ -0,0 +1,109 @@
+import os
+import random
+import sys
+import threading
+
+import pytest
+
+from conftest import login
+from models import Transaction
+from repository import Shard
+from sqlite_repository import SQLiteRepository
+
+# Many threads of one user mixing POST, DELETE, process_recurring and reads
+# against a single shard. STRESS_THREADS and STRESS_OPS scale the run up.
+THREADS = int(os.environ.get('STRESS_THREADS', 16))
+OPS = int(os.environ.get('STRESS_OPS', 100))
+BACKENDS = ['memory', 'mapped', 'partitioned', 'sqlite']
+
+
+@pytest.fixture
+def frequent_switches():
+    # Threads switch every few bytecodes instead of every 5 ms, so short
+    # unguarded sections actually interleave
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+@pytest.mark.parametrize('app', BACKENDS, indirect=True)
+def test_concurrent_writes_keep_ledger_consistent(app, frequent_switches):
+    owner = login(app)
+    cookie = owner.get_cookie('session').value
+    created, deleted, generated, failures = [], [], [], []
+
+    def work(seed):
+        client = app.test_client()
+        client.set_cookie('session', cookie)
+        rnd = random.Random(seed)
+        mine = []
+        for _ in range(OPS):
+            roll = rnd.random()
+            if roll < 0.4:
+                recurring = rnd.random() < 0.05
+                response = client.post('/api/transactions', json={
+                    'amount': rnd.randint(1, 9999) / 100, 'description': 'stress',
+                    'type': rnd.choice(['income', 'expense']), 'category': 'c%d' % rnd.randint(0, 5),
+                    'date': '2024-%02d-%02d' % (rnd.randint(1, 12), rnd.randint(1, 28)),
+                    'is_recurring': recurring, 'recurrence_interval': 'monthly' if recurring else None})
+                if response.status_code != 201:
+                    failures.append(('post', response.status_code))
+                else:
+                    mine.append(response.json['id'])
+                    created.append(response.json['id'])
+            elif roll < 0.55 and mine:
+                transaction_id = mine.pop(rnd.randrange(len(mine)))
+                response = client.delete('/api/transactions/%d' % transaction_id)
+                if response.status_code != 204:
+                    failures.append(('delete', response.status_code))
+                else:
+                    deleted.append(transaction_id)
+            elif roll < 0.6:
+                response = client.post('/api/process_recurring_transactions')
+                if response.status_code >= 300:
+                    failures.append(('recurring', response.status_code))
+                else:
+                    generated.extend(t['id'] for t in response.json)
+            else:
+                balance = client.get('/api/balance').json
+                if balance['count'] < 0 or round(balance['income'] - balance['expense'], 2) != balance['balance']:
+                    failures.append(('balance', balance))
+
+    threads = [threading.Thread(target=work, args=(seed,)) for seed in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert failures == []
+    rows = owner.get('/api/transactions').json
+    ids = [t['id'] for t in rows]
+    # Ids are unique, never reused, and the ledger holds exactly what was
+    # added and not deleted
+    assert len(ids) == len(set(ids))
+    assert len(set(created + generated)) == len(created) + len(generated)
+    assert set(ids) == set(created + generated) - set(deleted)
+    # The incrementally kept totals match the rows
+    balance = owner.get('/api/balance').json
+    assert balance['count'] == len(rows)
+    assert balance['balance'] == round(sum(t['amount'] if t['type'] == 'income' else -t['amount'] for t in rows), 2)
+
+
+def test_resync_waits_for_readers(tmp_path):
+    # A write through another process makes the shard restart its change
+    # log, epoch and version, which readers must never see halfway through
+    shard = Shard(SQLiteRepository(str(tmp_path / 'ledger.db')))
+    other = SQLiteRepository(str(tmp_path / 'ledger.db'))
+    other.add_transaction(Transaction(None, 1.0, 'x', 'expense', 'food', '2024-01-01'))
+    with shard.lock.read():
+        epoch, version = shard.epoch, shard.version
+        sync = threading.Thread(target=shard.sync)
+        sync.start()
+        sync.join(0.2)
+        assert sync.is_alive()
+        assert (shard.epoch, shard.version) == (epoch, version)
+    sync.join()
+    assert shard.version == version + 1
+    other.close()
+    shard.repository.close()
@@ -0,0 +1,107 @@
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+
+import pytest
+
+from conftest import ROOT
+from mapped_repository import MappedRepository
+from models import Transaction
+from repository import MemoryRepository
+
+BACKENDS = ['memory', 'mapped', 'partitioned']
+
+# Acknowledges a few writes, then dies without closing anything, as a
+# crashed server would
+CRASH = textwrap.dedent('''
+    import os
+    import main
+    client = main.app.test_client()
+    client.post('/register', data={'username': 'alice', 'password': 'secret'})
+    for amount in (1, 2, 3):
+        response = client.post('/api/transactions', json={
+            'amount': amount, 'description': 'x', 'type': 'expense', 'category': 'food', 'date': '2024-01-01'})
+        assert response.status_code == 201
+    response = client.post('/api/transactions/bulk', json=[
+        {'amount': 4, 'description': 'x', 'type': 'income', 'category': 'pay', 'date': '2024-01-02'}])
+    assert response.status_code == 201
+    os._exit(0)
+''')
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_acknowledged_writes_survive_a_crash(backend, tmp_path):
+    env = dict(os.environ, LEDGER_DATA_DIR=str(tmp_path), LEDGER_BACKEND=backend,
+               PYTHONPATH=os.pathsep.join([ROOT] + sys.path))
+    subprocess.run([sys.executable, '-c', CRASH], cwd=ROOT, env=env, check=True)
+    reopen = ("import main\n"
+              "client = main.app.test_client()\n"
+              "client.post('/login', data={'username': 'alice', 'password': 'secret'})\n"
+              "print(sorted(t['amount'] for t in client.get('/api/transactions').json))\n")
+    output = subprocess.run([sys.executable, '-c', reopen], cwd=ROOT, env=env, check=True, capture_output=True,
+                            text=True).stdout
+    assert output.strip().splitlines()[-1] == '[1.0, 2.0, 3.0, 4.0]'
+
+
+def test_concurrent_compactions_do_not_collide(tmp_path):
+    # A background compaction and an explicit snapshot of the same ledger
+    # both write the state file; they must take turns
+    repository = MemoryRepository(str(tmp_path))
+    repository.add_transactions([Transaction(None, i / 100, 'x', 'expense', 'food', '2024-01-01')
+                                 for i in range(50000)])
+    errors = []
+
+    def compact():
+        try:
+            for _ in range(5):
+                repository.snapshot()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=compact) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    repository.close()
+    reopened = MemoryRepository(str(tmp_path))
+    assert reopened.balance()['count'] == 50000
+    reopened.close()
+
+
+def test_sealing_closes_the_replaced_mapping(tmp_path):
+    repository = MappedRepository(str(tmp_path))
+    repository.add_transactions([Transaction(None, 1, 'x', 'expense', 'food', '2024-01-01')])
+    repository.snapshot()
+    first = repository._sealed[0]
+    repository.add_transactions([Transaction(None, 2, 'x', 'expense', 'food', '2024-01-02')])
+    repository.snapshot()
+    # Readers may still be on the old file until the next write
+    assert not first._mapping.closed
+    repository.add_transactions([Transaction(None, 3, 'x', 'expense', 'food', '2024-01-03')])
+    assert first._mapping.closed
+    assert sorted(t.amount for t in repository.iter_transactions()) == [1, 2, 3]
+    repository.close()
+
+
+def test_entry_after_a_torn_first_entry_survives(tmp_path):
+    repository = MemoryRepository(str(tmp_path))
+    repository.add_transaction(Transaction(None, 1, 'x', 'expense', 'food', '2024-01-01'))
+    # A crash while writing the first entry of a segment started at seq 1
+    repository.log.close()
+    with open(str(tmp_path / ('ledger-%020d.log' % 1)), 'w') as f:
+        f.write('{"seq":2,"op":"add","data":{"id":')
+
+    # The reopened log appends to that same segment
+    repository = MemoryRepository(str(tmp_path))
+    assert repository.log.seq == 1
+    repository.add_transaction(Transaction(None, 2, 'x', 'expense', 'food', '2024-01-02'))
+    repository.add_transaction(Transaction(None, 3, 'x', 'expense', 'food', '2024-01-03'))
+    repository.log.close()
+
+    repository = MemoryRepository(str(tmp_path))
+    assert sorted(t.amount for t in repository.iter_transactions()) == [1, 2, 3]
+    repository.close()
@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+import main
+from conftest import login
+
+
+@pytest.fixture
+def client(app, monkeypatch):
+    # Small pages, so a short listing is streamed over several of them
+    monkeypatch.setattr(main, 'STREAM_CHUNK_SIZE', 2)
+    monkeypatch.setattr(main, 'MAX_STREAM_CHUNK_SIZE', 4)
+    client = login(app)
+    response = client.post('/api/transactions/bulk', json=[
+        {'amount': i, 'description': 'x', 'type': 'expense', 'category': 'food' if i % 3 else 'rent',
+         'date': '2024-01-%02d' % (12 - i // 2)} for i in range(1, 24)])
+    assert response.status_code == 201
+    return client
+
+
+@pytest.mark.parametrize('app', ['memory', 'sqlite'], indirect=True)
+def test_stream_matches_the_listing_in_date_order(client):
+    response = client.get('/api/transactions?format=ndjson')
+    assert response.mimetype == 'application/x-ndjson'
+    body = response.get_data()
+    assert body.endswith(b'\n')
+    lines = [json.loads(line) for line in body.splitlines()]
+    listing = client.get('/api/transactions').json
+    assert lines == sorted(listing, key=lambda t: (t['date'], t['id']))
+
+
+@pytest.mark.parametrize('app', ['memory', 'sqlite'], indirect=True)
+def test_stream_with_filters_and_fields(client):
+    body = client.get('/api/transactions?format=ndjson&category=rent&fields=amount').get_data()
+    assert [json.loads(line) for line in body.splitlines()] == [
+        {'amount': float(i)} for i in (21, 18, 15, 12, 9, 6, 3)]
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_stream_takes_no_page(client):
+    assert client.get('/api/transactions?format=ndjson&limit=5').status_code == 400
+    assert client.get('/api/transactions?format=ndjson&category=none').get_data() == b''
@@ -0,0 +1,70 @@
+import base64
+import json
+
+import pytest
+
+from conftest import add, login
+
+BACKENDS = ['memory', 'mapped', 'partitioned', 'sqlite']
+
+
+def walk(client, url):
+    # Every page from url on, following next links
+    pages = []
+    while url is not None:
+        response = client.get(url)
+        assert response.status_code == 200
+        pages.append([t['id'] for t in response.json['transactions']])
+        url = response.json['next']
+        if url is None:
+            assert 'Link' not in response.headers
+        else:
+            assert response.headers['Link'] == '<%s>; rel="next"' % url
+    return pages
+
+
+@pytest.mark.parametrize('app', BACKENDS, indirect=True)
+def test_next_links_walk_the_listing_in_date_order(app):
+    client = login(app)
+    for day in (5, 1, 3, 1, 9, 3, 2):
+        add(client, day, date='2024-03-%02d' % day)
+    add(client, 1, category='rent', date='2024-03-04')
+    listing = sorted(client.get('/api/transactions?category=food').json, key=lambda t: (t['date'], t['id']))
+
+    pages = walk(client, '/api/transactions?category=food&limit=3')
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert sum(pages, []) == [t['id'] for t in listing]
+
+
+@pytest.mark.parametrize('app', BACKENDS, indirect=True)
+def test_ties_on_date_are_broken_by_id(app):
+    client = login(app)
+    ids = [add(client, amount, date='2024-03-01')['id'] for amount in (5, 4, 3, 2, 1)]
+    first = client.get('/api/transactions?limit=2').json
+    assert [t['id'] for t in first['transactions']] == ids[:2]
+    # A row written mid-walk on the same day sorts after the cursor
+    late = add(client, 9, date='2024-03-01')['id']
+    assert sum(walk(client, first['next']), []) == ids[2:] + [late]
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+@pytest.mark.parametrize('cursor', [
+    'not a cursor',
+    base64.urlsafe_b64encode(b'[1, 2, 3]').decode(),
+    base64.urlsafe_b64encode(json.dumps(['2024-01-01', 'x']).encode()).decode(),
+    base64.urlsafe_b64encode(json.dumps(['2024-13-01', 1]).encode()).decode(),
+])
+def test_bad_cursor_is_rejected(app, cursor):
+    client = login(app)
+    response = client.get('/api/transactions', query_string={'cursor': cursor})
+    assert response.status_code == 400
+    assert 'cursor' in response.json['error']
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_limit_is_checked_and_clamped(app):
+    client = login(app)
+    for day in range(1, 4):
+        add(client, day, date='2024-03-%02d' % day)
+    assert client.get('/api/transactions?limit=abc').status_code == 400
+    assert len(client.get('/api/transactions?limit=0').json['transactions']) == 1
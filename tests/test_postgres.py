@@ -0,0 +1,86 @@
+import shutil
+import subprocess
+
+import pytest
+
+import main
+from conftest import login
+from repository import create_shard_registry
+
+psycopg2 = pytest.importorskip('psycopg2')
+pytestmark = pytest.mark.skipif(shutil.which('initdb') is None or shutil.which('pg_ctl') is None,
+                                reason='initdb/pg_ctl not on PATH')
+
+# Port of the throwaway cluster, away from the 5433 a local server uses
+PORT = 5439
+
+
+@pytest.fixture(scope='module')
+def postgres_server(tmp_path_factory):
+    from postgres_repository import start_local_server
+    directory = tmp_path_factory.mktemp('postgres')
+    yield start_local_server(str(directory), port=PORT)
+    subprocess.run(['pg_ctl', '-D', str(directory), '-m', 'fast', 'stop'], stdout=subprocess.DEVNULL)
+
+
+@pytest.fixture
+def database_url(postgres_server, monkeypatch):
+    # Every test starts from an empty cluster: user ids, and so the ledger
+    # schemas, repeat across tests
+    monkeypatch.setenv('DATABASE_URL', postgres_server)
+    yield postgres_server
+    with psycopg2.connect(postgres_server) as connection, connection.cursor() as cursor:
+        cursor.execute("SELECT nspname FROM pg_namespace WHERE nspname LIKE 'ledger\\_%'")
+        for (schema,) in cursor.fetchall():
+            cursor.execute('DROP SCHEMA "%s" CASCADE' % schema)
+    connection.close()
+
+
+def add(client, amount, kind='expense', category='food', date='2024-01-15'):
+    response = client.post('/api/transactions', json={
+        'amount': amount, 'description': 'x', 'type': kind, 'category': category, 'date': date})
+    assert response.status_code == 201
+    return response.json
+
+
+@pytest.mark.parametrize('app', ['postgres'], indirect=True)
+def test_crud_balance_and_summary(database_url, app):
+    client = login(app)
+    first = add(client, 12.5)
+    add(client, 100, kind='income', category='pay', date='2024-02-01')
+    response = client.post('/api/transactions/bulk', json=[
+        {'amount': 7.25, 'description': 'x', 'type': 'expense', 'category': 'food', 'date': '2024-02-03'}])
+    assert response.status_code == 201
+    assert [t['amount'] for t in client.get('/api/transactions').json] == [12.5, 100.0, 7.25]
+    assert client.get('/api/balance').json['balance'] == 80.25
+
+    summary = client.get('/api/summary?group_by=month,type').json
+    assert summary['source'] == 'database'
+    assert {(g['month'], g['type']): g['total'] for g in summary['groups']} == {
+        ('2024-01', 'expense'): 12.5, ('2024-02', 'income'): 100.0, ('2024-02', 'expense'): 7.25}
+
+    assert client.delete('/api/transactions/%d' % first['id']).status_code == 204
+    assert client.get('/api/transactions/%d' % first['id']).status_code == 404
+    balance = client.get('/api/balance').json
+    assert (balance['income'], balance['expense'], balance['balance'], balance['count']) == (100.0, 7.25, 92.75, 2)
+
+
+@pytest.mark.parametrize('app', ['postgres'], indirect=True)
+def test_etag_follows_writes_from_other_processes(database_url, app, monkeypatch):
+    client = login(app)
+    add(client, 1)
+    response = client.get('/api/transactions')
+    etag = response.headers['ETag']
+    assert client.get('/api/transactions', headers={'If-None-Match': etag}).status_code == 304
+
+    # A second registry on the same database stands in for another server
+    shards = main.shards
+    other = create_shard_registry()
+    monkeypatch.setattr(main, 'shards', other)
+    add(client, 2)
+    other.close()
+    monkeypatch.setattr(main, 'shards', shards)
+    response = client.get('/api/transactions', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert [t['amount'] for t in response.json] == [1.0, 2.0]
@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+import textwrap
+from datetime import date, timedelta
+
+import pytest
+
+from conftest import ROOT
+from models import Transaction, ValidationError
+from sqlite_repository import SQLiteRepository
+
+RULES = 20
+DAYS = 100
+
+# Waits for the go file, then materialises the rules of the ledger at argv[1]
+# and prints how many occurrences it inserted
+WORKER = textwrap.dedent('''
+    import os
+    import sys
+    import time
+    import main
+    from sqlite_repository import SQLiteRepository
+    repository = SQLiteRepository(sys.argv[1])
+    while not os.path.exists(sys.argv[2]):
+        time.sleep(0.001)
+    print(len(main.materialize_recurring_transactions(repository)))
+    repository.close()
+''')
+
+
+def test_two_processes_materialize_each_occurrence_once(tmp_path):
+    path = str(tmp_path / 'ledger.db')
+    start = (date.today() - timedelta(days=DAYS)).isoformat()
+    repository = SQLiteRepository(path)
+    repository.add_transactions_with_rules([
+        Transaction(None, 1.0, 'rule %d' % i, 'expense', 'rent', start, True, 'daily') for i in range(RULES)])
+
+    go = str(tmp_path / 'go')
+    env = dict(os.environ, LEDGER_DATA_DIR=str(tmp_path), PYTHONPATH=os.pathsep.join([ROOT] + sys.path))
+    workers = [subprocess.Popen([sys.executable, '-c', WORKER, path, go], cwd=ROOT, env=env,
+                                stdout=subprocess.PIPE, text=True) for _ in range(2)]
+    open(go, 'w').close()
+    inserted = [int(worker.communicate()[0].strip().splitlines()[-1]) for worker in workers]
+    assert all(worker.returncode == 0 for worker in workers)
+
+    # Every due day of every rule exists once, and only one worker inserted it
+    assert sum(inserted) == RULES * DAYS
+    rows = [t for t in repository.list_transactions() if not t.is_recurring]
+    assert len(rows) == RULES * DAYS
+    assert len({(t.description, t.date) for t in rows}) == RULES * DAYS
+    assert {rule.date for rule in repository.recurring_rules()} == {date.today().isoformat()}
+    repository.close()
+
+
+def test_recurring_transaction_and_rule_are_stored_together(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / 'ledger.db'))
+    stored = repository.add_transactions_with_rules([
+        Transaction(None, 5.0, 'gym', 'expense', 'fun', '2024-01-01', True, 'monthly'),
+        Transaction(None, 2.0, 'coffee', 'expense', 'food', '2024-01-01')])
+    assert [rule.id for rule in repository.recurring_rules()] == [stored[0].id]
+    repository.close()
+
+
+@pytest.mark.parametrize('value, expected', [
+    (True, True), (False, False), (None, False), ('true', True), ('1', True), ('false', False), ('0', False)])
+def test_is_recurring_accepts_booleans_and_flag_strings(value, expected):
+    transaction = Transaction.from_request({'amount': 1, 'is_recurring': value, 'recurrence_interval': 'monthly'})
+    assert transaction.is_recurring is expected
+    assert transaction.recurrence_interval == ('monthly' if expected else None)
+
+
+@pytest.mark.parametrize('value', ['no', 'False', '', 1, 0, [], {}])
+def test_is_recurring_rejects_anything_else(value):
+    with pytest.raises(ValidationError):
+        Transaction.from_request({'amount': 1, 'is_recurring': value, 'recurrence_interval': 'monthly'})
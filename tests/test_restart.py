@@ -0,0 +1,126 @@
+from datetime import date
+
+import pytest
+
+import main
+from conftest import login
+from mapped_repository import MappedRepository
+from models import Transaction
+from partitioned_repository import PartitionedRepository
+from repository import create_shard_registry
+
+MONTHS = ('2023-01-10', '2023-02-14', '2023-03-03', '2023-03-28')
+QUERIES = [
+    {},
+    {'category': 'rent'},
+    {'date_from': '2023-02-01', 'date_to': '2023-03-15'},
+    {'min_amount': 100, 'max_amount': 400},
+    {'category': 'food', 'transaction_type': 'expense', 'date_from': '2023-03-01'},
+    {'is_recurring': True},
+]
+
+
+def transactions(count, dates=MONTHS, first=0):
+    # Mixed categories, types, amounts and recurring rows over the dates
+    return [Transaction(None, (i * 37) % 500 + 0.25, 'row %d' % i, 'income' if i % 7 == 0 else 'expense',
+                        ('food', 'rent', 'pay')[i % 3], dates[i % len(dates)], i % 11 == 0,
+                        'monthly' if i % 11 == 0 else None)
+            for i in range(first, first + count)]
+
+
+def state(repository):
+    # What a restart must bring back: rows, totals, categories, rules and
+    # what the indexes answer
+    return {
+        'rows': sorted((t.to_dict() for t in repository.iter_transactions()), key=lambda t: t['id']),
+        'balance': repository.balance(),
+        'categories': sorted(repository.categories()),
+        'rules': sorted((r.to_dict() for r in repository.recurring_rules()), key=lambda r: r['id']),
+        'queries': [[t.id for t in repository.query_transactions(**filters)] for filters in QUERIES],
+        'page': [t.id for t in repository.page_transactions(limit=5, date_from='2023-02-01')],
+    }
+
+
+def test_mapped_ledger_reopens_as_it_was(tmp_path):
+    repository = MappedRepository(str(tmp_path))
+    sealed = repository.add_transactions_with_rules(transactions(40))
+    repository.snapshot()
+    tail = repository.add_transactions_with_rules(transactions(20, first=40))
+    # Tombstones in the file, a delete in the tail, and the newest id gone
+    repository.delete_transaction(sealed[3].id)
+    repository.delete_transactions([sealed[5].id, tail[0].id, tail[-1].id])
+    before = state(repository)
+    repository.close()
+
+    reopened = MappedRepository(str(tmp_path))
+    assert state(reopened) == before
+    # Ids are not reused
+    assert reopened.add_transaction(transactions(1)[0]).id == tail[-1].id + 1
+    # Sealing the tombstones away changes nothing either
+    before = state(reopened)
+    reopened.snapshot()
+    reopened.close()
+    reopened = MappedRepository(str(tmp_path))
+    assert state(reopened) == before
+    reopened.close()
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_snapshot_restore_and_restart_bring_the_ledger_back(app, tmp_path, monkeypatch):
+    login(app)
+    user_id = main.users.find('alice').id
+    repository = main.shards.get(user_id).repository
+    added = repository.add_transactions_with_rules(transactions(60))
+    repository.delete_transactions([added[4].id, added[-1].id])
+    before = state(repository)
+    plans = [repository.explain_query(**filters) for filters in QUERIES]
+    runner = app.test_cli_runner()
+    copy = str(tmp_path / 'alice.snapshot')
+    assert runner.invoke(args=['snapshot', 'alice', '--output', copy]).exit_code == 0
+
+    # Changes after the copy are undone by restoring it
+    repository.add_transactions_with_rules(transactions(5, first=60))
+    repository.delete_transaction(added[0].id)
+    assert runner.invoke(args=['restore', 'alice', copy]).exit_code == 0
+    assert state(repository) == before
+
+    # A restart loads the snapshot written on shutdown, indexes included
+    main.shards.close()
+    monkeypatch.setattr(main, 'shards', create_shard_registry())
+    reopened = main.shards.get(user_id).repository
+    assert reopened is not repository
+    assert reopened.log.seq == reopened.log.snapshot_seq
+    assert state(reopened) == before
+    assert [reopened.explain_query(**filters) for filters in QUERIES] == plans
+    assert reopened.add_transaction(transactions(1)[0]).id == added[-1].id + 1
+
+
+def test_partitioned_ledger_keeps_sealed_rows_hidden_across_restarts(tmp_path):
+    repository = PartitionedRepository(str(tmp_path))
+    old = repository.add_transactions_with_rules(transactions(40))
+    hot = repository.add_transactions_with_rules(transactions(10, dates=(date.today().isoformat(),), first=40))
+    # Seals the old months; their hot copies stay hidden until a writer
+    # trims them, and a reopen must not bring them back
+    repository.snapshot()
+    assert repository._cold[2]
+    before = state(repository)
+    assert len(before['rows']) == 50
+    repository.close()
+
+    repository = PartitionedRepository(str(tmp_path))
+    assert state(repository) == before
+    # Deletes of sealed rows only in the log, as after a crash
+    repository.delete_transaction(old[3].id)
+    repository.delete_transactions([old[5].id, hot[0].id, hot[-1].id])
+    before = state(repository)
+    repository.log.close()
+
+    repository = PartitionedRepository(str(tmp_path))
+    assert state(repository) == before
+    assert repository.get_transaction(old[3].id) is None
+    # And once a compaction has written them into the segments
+    repository.close()
+    repository = PartitionedRepository(str(tmp_path))
+    assert state(repository) == before
+    assert repository.add_transaction(transactions(1)[0]).id == hot[-1].id + 1
+    repository.close()
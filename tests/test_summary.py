@@ -0,0 +1,103 @@
+from datetime import date
+
+import pytest
+
+import main
+from conftest import add, login
+
+
+def groups(summary):
+    return {tuple(group[field] for field in summary['group_by']): (group['count'], group['total'], group['min'],
+                                                                   group['max'])
+            for group in summary['groups']}
+
+
+def listing_groups(listing):
+    # What groups(summary) is for group_by=category,type,month over the listing
+    expected = {}
+    for t in listing:
+        count, total, low, high = expected.get((t['category'], t['type'], t['date'][:7]), (0, 0, None, None))
+        expected[(t['category'], t['type'], t['date'][:7])] = (
+            count + 1, total + t['amount'], min(low, t['amount']) if low is not None else t['amount'],
+            max(high, t['amount']) if high is not None else t['amount'])
+    return expected
+
+
+@pytest.fixture
+def client(app):
+    client = login(app)
+    response = client.post('/api/transactions/bulk', json=[
+        {'amount': amount, 'description': 'x', 'type': kind, 'category': category, 'date': day}
+        for amount, kind, category, day in ((10, 'expense', 'food', '2024-01-05'), (15, 'expense', 'food', '2024-01-20'),
+                                            (900, 'expense', 'rent', '2024-01-01'), (2000, 'income', 'pay', '2024-01-31'),
+                                            (12.5, 'expense', 'food', '2024-02-03'))])
+    assert response.status_code == 201
+    return client
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+@pytest.mark.parametrize('query, source', [
+    ('', 'rollup'),
+    ('category=food&type=expense', 'rollup'),
+    ('from=2024-01-01&to=2024-01-31', 'rollup'),
+    ('from=2024-01-02&to=2024-01-31', 'scan'),
+    ('min_amount=11', 'scan'),
+    ('is_recurring=false', 'scan'),
+])
+def test_rollup_answers_whole_months_and_the_rest_is_scanned(client, query, source):
+    summary = client.get('/api/summary?group_by=category,type,month&' + query).json
+    assert summary['source'] == source
+    # Either way the groups are those of the listing
+    assert groups(summary) == listing_groups(client.get('/api/transactions?' + query).json)
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_grouping(client):
+    summary = client.get('/api/summary?group_by=month').json
+    assert groups(summary) == {('2024-01',): (4, 2925.0, 10.0, 2000.0), ('2024-02',): (1, 12.5, 12.5, 12.5)}
+    overall = client.get('/api/summary').json
+    assert (overall['count'], overall['total'], overall['groups'][0]['average']) == (5, 2937.5, 587.5)
+    assert client.get('/api/summary?group_by=day').status_code == 400
+
+
+@pytest.mark.parametrize('app', ['memory'], indirect=True)
+def test_bounds_are_recounted_after_deleting_one(client):
+    cell = '/api/summary?group_by=category,month&category=food&from=2024-01-01&to=2024-01-31'
+    assert groups(client.get(cell).json) == {('food', '2024-01'): (2, 25.0, 10.0, 15.0)}
+    middle = add(client, 12, date='2024-01-10')
+    low = next(t for t in client.get('/api/transactions?category=food').json if t['amount'] == 10)
+    assert client.delete('/api/transactions/%d' % low['id']).status_code == 204
+    summary = client.get(cell).json
+    assert summary['source'] == 'rollup'
+    assert groups(summary) == {('food', '2024-01'): (2, 27.0, 12.0, 15.0)}
+    assert client.delete('/api/transactions/%d' % middle['id']).status_code == 204
+    assert groups(client.get(cell).json) == {('food', '2024-01'): (1, 15.0, 15.0, 15.0)}
+
+
+@pytest.mark.parametrize('app', ['sqlite'], indirect=True)
+def test_shared_backends_aggregate_in_the_database(client):
+    summary = client.get('/api/summary?group_by=type').json
+    assert summary['source'] == 'database'
+    assert groups(summary) == {('expense',): (4, 937.5, 10.0, 900.0), ('income',): (1, 2000.0, 2000.0, 2000.0)}
+
+
+@pytest.mark.parametrize('app', ['partitioned'], indirect=True)
+def test_partitioned_rollup_starts_from_the_sealed_cells(client, monkeypatch):
+    repository = main.shards.get(main.users.find('alice').id).repository
+    repository.snapshot()
+    assert sorted(repository._cold[0]) == ['2024-01', '2024-02']
+    add(client, 7, date=date.today().isoformat())
+    # The smallest food row of January, now a tombstone in its segment
+    low = next(t for t in client.get('/api/transactions?category=food').json if t['amount'] == 10)
+    assert client.delete('/api/transactions/%d' % low['id']).status_code == 204
+
+    opened = []
+    get = repository._segments.get
+    monkeypatch.setattr(repository._segments, 'get', lambda name: opened.append(name) or get(name))
+    summary = client.get('/api/summary?group_by=category,type,month').json
+    assert summary['source'] == 'rollup'
+    # February is never read; January only for the tombstone and the
+    # food bounds it left unknown
+    assert opened and all(name.startswith('2024-01-') for name in opened)
+    assert groups(summary) == listing_groups(client.get('/api/transactions').json)
+    assert groups(summary)[('food', 'expense', '2024-01')] == (1, 15.0, 15.0, 15.0)
@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+from conftest import ROOT
+from users import UserStore
+
+SIGNUPS = 15
+
+# Waits for the go file, then signs up users named after argv[3] in the
+# store at argv[1]. A cheap hash keeps the sign-ups close together.
+WORKER = textwrap.dedent('''
+    import os
+    import sys
+    import time
+    import users
+    from werkzeug.security import generate_password_hash
+    users.generate_password_hash = lambda password: generate_password_hash(password, 'pbkdf2:sha256:1')
+    store = users.UserStore(sys.argv[1])
+    while not os.path.exists(sys.argv[2]):
+        time.sleep(0.001)
+    for i in range(%d):
+        assert store.create('%%s-%%d' %% (sys.argv[3], i), 'secret') is not None
+''' % SIGNUPS)
+
+
+def test_two_processes_never_hand_out_the_same_id(tmp_path):
+    path = str(tmp_path / 'users.json')
+    go = str(tmp_path / 'go')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT] + sys.path))
+    workers = [subprocess.Popen([sys.executable, '-c', WORKER, path, go, name], cwd=ROOT, env=env)
+               for name in ('a', 'b')]
+    open(go, 'w').close()
+    for worker in workers:
+        assert worker.wait(timeout=60) == 0
+
+    accounts = UserStore(path).all()
+    assert len(accounts) == 2 * SIGNUPS
+    assert sorted(int(user.id) for user in accounts) == list(range(1, 2 * SIGNUPS + 1))
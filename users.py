@@ -0,0 +1,90 @@
+import fcntl
+import json
+import os
+import threading
+
+from flask_login import UserMixin
+from werkzeug.security import check_password_hash, generate_password_hash
+
+LOCK_FILE = 'users.lock'
+
+
+class User(UserMixin):
+
+    def __init__(self, id, username, password_hash):
+        self.id = id
+        self.username = username
+        self.password_hash = password_hash
+
+    def check_password(self, password):
+        return check_password_hash(self.password_hash, password)
+
+
+class UserStore:
+    # Accounts kept in a small JSON file. The file is re-read whenever it
+    # changes on disk, so several server processes see each other's sign-ups.
+    # A sign-up holds an exclusive lock on users.lock next to the file from
+    # the re-read to the save, so two processes never hand out the same id
+    # or overwrite each other's new account.
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._users = {}
+        self._mtime = None
+
+    def _refresh(self, force=False):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if force or mtime != self._mtime:
+            with open(self.path, encoding='utf-8') as f:
+                records = json.load(f)
+            self._users = {r['id']: User(r['id'], r['username'], r['password_hash']) for r in records}
+            self._mtime = mtime
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump([{'id': u.id, 'username': u.username, 'password_hash': u.password_hash}
+                       for u in self._users.values()], f)
+        os.replace(tmp_path, self.path)
+        self._mtime = os.stat(self.path).st_mtime_ns
+
+    def get(self, user_id):
+        with self._lock:
+            self._refresh()
+            return self._users.get(user_id)
+
+    def all(self):
+        with self._lock:
+            self._refresh()
+            return list(self._users.values())
+
+    def find(self, username):
+        with self._lock:
+            self._refresh()
+            for user in self._users.values():
+                if user.username == username:
+                    return user
+            return None
+
+    def create(self, username, password):
+        # Returns None if the username is taken
+        password_hash = generate_password_hash(password)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock, open(os.path.join(directory, LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # The mtime may not have moved if another process saved within
+            # its resolution
+            self._refresh(force=True)
+            if any(u.username == username for u in self._users.values()):
+                return None
+            user_id = str(max((int(u) for u in self._users), default=0) + 1)
+            user = User(user_id, username, password_hash)
+            self._users[user_id] = user
+            self._save()
+            return user